@@ -0,0 +1,351 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.utils import resample
+from tqdm import tqdm
+
+from results_cache import cached, content_hash
+from subgroups import group_roc_metrics
+
+block_size = 100  # replicates per seeded block; fixed so that results do not depend on the number of workers
+
+
+def bootstrap_indices(targets: np.ndarray, n_bootstrap: int = 2000):
+    """
+    Replicate x sample index matrix of shape (n_bootstrap + 1, n_samples).
+    Row 0 is the original sample, rows 1.. are stratified resamples drawn exactly as in the per-replicate loop.
+    """
+    n_samples = targets.shape[0]
+    idx = np.empty((n_bootstrap + 1, n_samples), dtype=np.int64)
+    idx[0] = np.arange(n_samples)
+    for b in range(1, n_bootstrap + 1):
+        idx[b] = resample(np.arange(n_samples), stratify=targets)
+    return idx
+
+
+def stratified_indices(targets: np.ndarray, n_replicates: int, rng: np.random.Generator):
+    """
+    n_replicates stratified resamples from rng: every position is redrawn with replacement among the samples
+    of its own class, so each replicate keeps the class sizes (and targets[idx] == targets).
+    """
+    targets = np.asarray(targets)
+    idx = np.empty((n_replicates, targets.shape[0]), dtype=np.int64)
+    for c in np.unique(targets):
+        members = np.flatnonzero(targets == c)
+        idx[:, members] = members[rng.integers(0, len(members), size=(n_replicates, len(members)))]
+    return idx
+
+
+def shared_indices(n_samples: int, n_bootstrap: int = 2000, seed: int = 0, strata: np.ndarray = None):
+    """
+    Replicate x sample index matrix of shape (n_bootstrap + 1, n_samples) to be generated once and reused for all
+    labels and prediction files, so that metrics of different models (e.g. real vs fake images) or labels are
+    computed on the same resamples and their differences are paired. Row 0 is the original sample.
+    Rows are drawn in blocks from the same SeedSequence streams as run_bootstrap, so strata=targets reproduces
+    run_bootstrap(seed=seed) for that label; strata=None is an unstratified bootstrap.
+    """
+    strata = np.zeros(n_samples, dtype=np.int8) if strata is None else np.asarray(strata)
+    n_blocks = -(-n_bootstrap // block_size)
+    dtype = np.int32 if n_samples < 2**31 else np.int64
+    idx = np.empty((n_bootstrap + 1, n_samples), dtype=dtype)
+    idx[0] = np.arange(n_samples)
+    for k, seed_seq in enumerate(np.random.SeedSequence(seed).spawn(n_blocks)):
+        a, b = 1 + k * block_size, 1 + min((k + 1) * block_size, n_bootstrap)
+        idx[a:b] = stratified_indices(strata, b - a, np.random.default_rng(seed_seq))
+    return idx
+
+
+def _indices_sha256(idx: np.ndarray, rows: int = 100):
+    """
+    SHA-256 of the dtype, shape and contents of an index matrix, read a few rows at a time
+    """
+    h = hashlib.sha256(f"{idx.dtype.str}{idx.shape}".encode())
+    for start in range(0, idx.shape[0], rows):
+        h.update(np.ascontiguousarray(idx[start : start + rows]).tobytes())
+    return h.hexdigest()
+
+
+def _write_indices_hash(path, digest):
+    stat = os.stat(path)
+    with open(path + ".sha256.json", "w") as f:
+        json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}, f)
+
+
+def save_indices(path, idx: np.ndarray):
+    """
+    np.save, with the content hash of the matrix stored next to it (<path>.sha256.json, see indices_hash)
+    """
+    path = path if path.endswith(".npy") else path + ".npy"
+    np.save(path, idx)
+    _write_indices_hash(path, _indices_sha256(idx))
+
+
+def indices_hash(idx: np.ndarray):
+    """
+    Content hash of an index matrix for the cache keys of run_bootstrap. For a memory-mapped file (load_indices)
+    it is read from <path>.sha256.json while the file's size and mtime match, else computed once and stored there,
+    so the matrix is not read for every label and model.
+    """
+    path = getattr(idx, "filename", None)
+    if path is None:
+        return _indices_sha256(idx)
+    try:
+        with open(path + ".sha256.json") as f:
+            stored = json.load(f)
+        stat = os.stat(path)
+        if (stored["size"], stored["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            return stored["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+    digest = _indices_sha256(idx)
+    _write_indices_hash(path, digest)
+    return digest
+
+
+def load_indices(path, mmap: bool = True):
+    """
+    Index matrix saved with save_indices, memory-mapped by default. run_bootstrap passes the path of a memory-mapped
+    matrix to its worker processes, which map the file once and read only the rows of their blocks.
+    """
+    return np.load(path, mmap_mode="r" if mmap else None)
+
+
+def paired_differences(replicates_a: dict, replicates_b: dict):
+    """
+    Replicate-wise differences a - b of two run_bootstrap results computed on the same index matrix;
+    row 0 is the difference on the original sample, rows 1.. give its bootstrap distribution
+    """
+    return {key: replicates_a[key] - replicates_b[key] for key in replicates_a if key in replicates_b}
+
+
+_worker = {}
+
+
+def _init_worker(block_fn, stratify, data, indices=None):
+    """
+    indices: replicate x sample index matrix, or the path of a saved one (memory-mapped in the worker)
+    """
+    if isinstance(indices, str):
+        indices = load_indices(indices)
+    _worker.update(block_fn=block_fn, stratify=stratify, data=data, indices=indices)
+
+
+def _run_block(task):
+    """
+    task: (n_replicates, seed_seq, rows), rows the (start, stop) range of the block in the worker's indices,
+    or None to draw the block from seed_seq
+    """
+    n_replicates, seed_seq, rows = task
+    if rows is None:
+        idx = stratified_indices(_worker["stratify"], n_replicates, np.random.default_rng(seed_seq))
+    else:
+        idx = _worker["indices"][rows[0] : rows[1]]  # int32 for shared index matrices, used as is
+    return _worker["block_fn"](idx, **_worker["data"])
+
+
+def run_bootstrap(
+    block_fn,
+    stratify: np.ndarray,
+    n_bootstrap: int = 2000,
+    seed: int = None,
+    n_jobs: int = 1,
+    cache_dir: str = None,
+    indices: np.ndarray = None,
+    **data,
+):
+    """
+    Evaluate block_fn(idx, **data) -> {key: array of len(idx)} on the original sample (row 0) and n_bootstrap
+    resamples stratified by the labels in stratify, returning {key: array of shape (n_bootstrap + 1,)}.
+
+    seed=None keeps the legacy draws from the global NumPy RNG. With a seed, each block of block_size replicates
+    draws from its own SeedSequence-spawned stream, so the replicates, and hence all results, are bit-identical
+    for any n_jobs. n_jobs > 1 spreads the blocks over a process pool; block_fn must be picklable (module level).
+
+    With a seed and a cache_dir, the replicate arrays are cached under the hash of block_fn, the contents of
+    stratify and data (predictions, targets, group codes and names, ...), n_bootstrap and seed, so re-running
+    on unchanged inputs only loads them. Legacy draws (seed=None) are not reproducible and never cached.
+
+    indices: a fixed index matrix from shared_indices (row 0 the original sample); stratify, n_bootstrap and seed
+    are then ignored and the replicates are the rows of indices.
+    """
+    stratify = np.asarray(stratify)
+    if (seed is not None or indices is not None) and cache_dir is not None:
+        if indices is not None:
+            key = content_hash(block_fn, indices_hash(indices), data)
+        else:
+            key = content_hash(block_fn, stratify, n_bootstrap, seed, block_size, data)
+        return cached(
+            cache_dir,
+            key,
+            lambda: run_bootstrap(block_fn, stratify, n_bootstrap, seed, n_jobs, indices=indices, **data),
+        )
+    if indices is not None:
+        if indices.shape[1] != stratify.shape[0]:
+            raise ValueError(f"Index matrix is for {indices.shape[1]} samples, got {stratify.shape[0]}")
+        n_bootstrap = indices.shape[0] - 1
+    n_blocks = -(-n_bootstrap // block_size)
+    sizes = [min(block_size, n_bootstrap - k * block_size) for k in range(n_blocks)]
+    if seed is None or indices is not None:
+        if indices is None:
+            indices = bootstrap_indices(stratify, n_bootstrap)
+        # row 0 is the original sample, the blocks are rows 1..
+        bounds = 1 + np.cumsum([0] + sizes)
+        tasks = [(n, None, (a, b)) for n, a, b in zip(sizes, bounds[:-1], bounds[1:])]
+    else:
+        seeds = np.random.SeedSequence(seed).spawn(n_blocks)
+        tasks = [(n, s, None) for n, s in zip(sizes, seeds)]
+
+    _init_worker(block_fn, stratify, data, indices)
+    blocks = [block_fn(np.arange(stratify.shape[0])[None, :], **data)]
+    if n_jobs is None or n_jobs == 1:
+        blocks += [_run_block(t) for t in tqdm(tasks)]
+    else:
+        # workers get the matrix once: a memory-mapped one by its path, so it is not copied into every process
+        shared = indices.filename if isinstance(indices, np.memmap) and indices.filename else indices
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_worker, initargs=(block_fn, stratify, data, shared)
+        ) as pool:
+            blocks += list(tqdm(pool.map(_run_block, tasks), total=len(tasks)))
+
+    return {key: np.concatenate([b[key] for b in blocks]) for key in blocks[0]}
+
+
+def _gather(values, idx):
+    """
+    values[b, idx[b, i]] with idx == -1 mapping to 0, for cumulative counts
+    """
+    padded = np.concatenate([np.zeros((values.shape[0], 1), values.dtype), values], axis=1)
+    return np.take_along_axis(padded, idx + 1, axis=1)
+
+
+class SortedReplicates:
+    """
+    Scores and targets of a block of replicates, sorted by decreasing score per replicate, with the tie structure
+    that roc_curve uses: a threshold sits at the last position of every block of equal scores.
+    """
+
+    def __init__(self, targets, predictions, idx):
+        scores = predictions[idx]
+        order = np.argsort(scores, axis=1)[:, ::-1]
+        self.idx = np.take_along_axis(idx, order, axis=1)
+        self.scores = np.take_along_axis(scores, order, axis=1)
+        self.targets = targets[self.idx]
+
+        n_rep, n = self.scores.shape
+        pos = np.broadcast_to(np.arange(n), (n_rep, n))
+        self.is_threshold = np.ones((n_rep, n), dtype=bool)
+        self.is_threshold[:, :-1] = self.scores[:, :-1] != self.scores[:, 1:]
+        # last threshold before i (end of the previous tie block) and first threshold at or after i (end of own block)
+        last = np.maximum.accumulate(np.where(self.is_threshold, pos, -1), axis=1)
+        self.prev_threshold = np.concatenate([np.full((n_rep, 1), -1), last[:, :-1]], axis=1)
+        self.block_end = np.minimum.accumulate(
+            np.where(self.is_threshold, pos, n)[:, ::-1], axis=1
+        )[:, ::-1]
+
+    def rank_auc(self):
+        """
+        Mann-Whitney AUC per replicate (ties count 1/2)
+        """
+        pos = self.targets == 1
+        neg = ~pos
+        cum_neg = np.cumsum(neg, axis=1)
+        n_neg = cum_neg[:, -1]
+        n_pos = pos.sum(axis=1)
+        neg_upto_block_end = _gather(cum_neg, self.block_end)
+        neg_before_block = _gather(cum_neg, self.prev_threshold)
+        # negatives scored lower + half of the tied negatives, summed over positives
+        u = np.where(
+            pos,
+            (n_neg[:, None] - neg_upto_block_end)
+            + 0.5 * (neg_upto_block_end - neg_before_block),
+            0.0,
+        ).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return u / (n_pos * n_neg)
+
+    def roc_at_target_fpr(self, target_fpr):
+        """
+        FPR, TPR and threshold of the ROC point closest to target_fpr, on the same points as
+        roc_curve(drop_intermediate=True) including the prepended (0, 0) point
+        """
+        n_rep, n = self.scores.shape
+        rows = np.arange(n_rep)
+        tps = np.cumsum(self.targets == 1, axis=1)
+        fps = np.arange(1, n + 1) - tps
+
+        # drop collinear intermediate thresholds as roc_curve does
+        prev_t = self.prev_threshold
+        next_t = np.concatenate([self.block_end[:, 1:], np.full((n_rep, 1), n)], axis=1)
+        has_prev, has_next = prev_t >= 0, next_t < n
+        prev_c, next_c = np.maximum(prev_t, 0), np.minimum(next_t, n - 1)
+        d2_fps = (np.take_along_axis(fps, next_c, 1) - fps) - (fps - np.take_along_axis(fps, prev_c, 1))
+        d2_tps = (np.take_along_axis(tps, next_c, 1) - tps) - (tps - np.take_along_axis(tps, prev_c, 1))
+        keep = self.is_threshold & (~has_prev | ~has_next | (d2_fps != 0) | (d2_tps != 0))
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fpr = fps / fps[:, -1:]
+            tpr = tps / tps[:, -1:]
+        dist = np.where(keep, np.abs(fpr - target_fpr), np.inf)
+        dist = np.concatenate([np.full((n_rep, 1), np.abs(0.0 - target_fpr)), dist], axis=1)
+        best = np.argmin(dist, axis=1)
+
+        at = np.maximum(best - 1, 0)
+        origin = best == 0
+        return (
+            np.where(origin, 0.0, fpr[rows, at]),
+            np.where(origin, 0.0, tpr[rows, at]),
+            np.where(origin, np.inf, self.scores[rows, at]),
+        )
+
+
+def bootstrap_roc_metrics(
+    targets: np.ndarray,
+    predictions: np.ndarray,
+    partitions: list,
+    idx: np.ndarray,
+    target_fpr: float = 0.2,
+    chunk_size: int = None,
+):
+    """
+    AUC, and FPR/TPR/Youden at the global threshold with FPR closest to target_fpr, for every replicate in idx,
+    for all samples ("all") and for every group of the partitions (subgroups.Partition, see subgroups.encode).
+    Returns {metric: {group: array of shape (n_replicates,)}}.
+    """
+    targets, predictions = np.asarray(targets), np.asarray(predictions)
+    n_rep, n_samples = idx.shape
+    if chunk_size is None:
+        chunk_size = max(1, 2_000_000 // n_samples)
+
+    names = ["all"] + [name for partition in partitions for name in partition.names]
+    results = {m: {g: np.empty(n_rep) for g in names} for m in ["AUC", "TPR", "FPR", "Youden"]}
+
+    for start in range(0, n_rep, chunk_size):
+        stop = min(start + chunk_size, n_rep)
+        block = SortedReplicates(targets, predictions, idx[start:stop])
+
+        fpr, tpr, threshold = block.roc_at_target_fpr(target_fpr)
+        results["AUC"]["all"][start:stop] = block.rank_auc()
+        results["FPR"]["all"][start:stop] = fpr
+        results["TPR"]["all"][start:stop] = tpr
+        results["Youden"]["all"][start:stop] = tpr - fpr
+
+        for partition in partitions:
+            stats = group_roc_metrics(block, partition, threshold)
+            for g, name in enumerate(partition.names):
+                results["AUC"][name][start:stop] = stats["AUC"][:, g]
+                results["FPR"][name][start:stop] = stats["FPR"][:, g]
+                results["TPR"][name][start:stop] = stats["TPR"][:, g]
+                results["Youden"][name][start:stop] = stats["TPR"][:, g] - stats["FPR"][:, g]
+
+    return results
+
+
+def full_experiment_block(idx, targets, predictions, partitions, target_fpr):
+    """
+    Block function for run_bootstrap: bootstrap_roc_metrics flattened to {(metric, group): array}
+    """
+    metrics = bootstrap_roc_metrics(targets, predictions, partitions, idx, target_fpr)
+    return {(m, g): v for m, per_group in metrics.items() for g, v in per_group.items()}
@@ -0,0 +1,100 @@
+import numpy as np
+from scipy.stats import norm, rankdata
+
+
+def delong_auc(targets: np.ndarray, predictions: np.ndarray):
+    """
+    Mann-Whitney AUC (ties count 1/2) and its DeLong covariance, in O(n log n) via midranks (Sun & Xu, 2014).
+    predictions is (n_samples,) or (n_models, n_samples) for models scored on the same samples.
+    Returns aucs of shape (n_models,) and their covariance of shape (n_models, n_models).
+    """
+    targets = np.asarray(targets)
+    predictions = np.atleast_2d(np.asarray(predictions, dtype=np.float64))
+    pos, neg = predictions[:, targets == 1], predictions[:, targets != 1]
+    m, n = pos.shape[1], neg.shape[1]
+    k = predictions.shape[0]
+    if m == 0 or n == 0:
+        return np.full(k, np.nan), np.full((k, k), np.nan)
+
+    tx = rankdata(pos, axis=1)
+    ty = rankdata(neg, axis=1)
+    tz = rankdata(np.concatenate([pos, neg], axis=1), axis=1)
+    aucs = (tz[:, :m].sum(axis=1) - m * (m + 1) / 2) / (m * n)
+
+    # structural components: share of negatives below each positive, of positives above each negative
+    v10 = (tz[:, :m] - tx) / n
+    v01 = 1 - (tz[:, m:] - ty) / m
+    s10 = np.atleast_2d(np.cov(v10)) if m > 1 else np.full((k, k), np.nan)
+    s01 = np.atleast_2d(np.cov(v01)) if n > 1 else np.full((k, k), np.nan)
+    return aucs, s10 / m + s01 / n
+
+
+def _normal_ci(estimate, variance, level, lower=-np.inf, upper=np.inf):
+    z = norm.ppf(1 - (1 - level) / 2)
+    se = np.sqrt(variance)
+    return np.clip(estimate - z * se, lower, upper), np.clip(estimate + z * se, lower, upper)
+
+
+def _p_value(difference, variance):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return 2 * norm.sf(np.abs(difference) / np.sqrt(variance))
+
+
+def auc_ci(targets: np.ndarray, predictions: np.ndarray, level: float = 0.95):
+    """
+    AUC with its DeLong (normal) confidence interval, clipped to [0, 1]
+    """
+    aucs, cov = delong_auc(targets, predictions)
+    low, high = _normal_ci(aucs[0], cov[0, 0], level, 0, 1)
+    return aucs[0], low, high
+
+
+def subgroup_auc_ci(targets: np.ndarray, predictions: np.ndarray, groups: dict, level: float = 0.95):
+    """
+    auc_ci for all samples ("all") and for each subgroup (name -> boolean mask over the samples)
+    """
+    targets, predictions = np.asarray(targets), np.asarray(predictions)
+    results = {"all": auc_ci(targets, predictions, level)}
+    for name, mask in groups.items():
+        mask = np.asarray(mask)
+        results[name] = auc_ci(targets[mask], predictions[mask], level)
+    return results
+
+
+def paired_auc_difference(
+    targets: np.ndarray,
+    predictions_a: np.ndarray,
+    predictions_b: np.ndarray,
+    level: float = 0.95,
+):
+    """
+    AUC(a) - AUC(b) for two models scored on the same samples, with DeLong CI and two-sided p-value
+    """
+    aucs, cov = delong_auc(targets, np.stack([predictions_a, predictions_b]))
+    difference = aucs[0] - aucs[1]
+    variance = cov[0, 0] + cov[1, 1] - 2 * cov[0, 1]
+    low, high = _normal_ci(difference, variance, level, -1, 1)
+    return difference, low, high, _p_value(difference, variance)
+
+
+def subgroup_auc_difference(
+    targets: np.ndarray,
+    predictions: np.ndarray,
+    mask_a: np.ndarray,
+    mask_b: np.ndarray,
+    level: float = 0.95,
+):
+    """
+    AUC(group a) - AUC(group b) of one model, with DeLong CI and two-sided p-value.
+    The groups must be disjoint, so that the two AUCs are independent and their variances add up.
+    """
+    targets, predictions = np.asarray(targets), np.asarray(predictions)
+    mask_a, mask_b = np.asarray(mask_a), np.asarray(mask_b)
+    if np.any(mask_a & mask_b):
+        raise ValueError("Subgroups must be disjoint to compare their AUCs")
+    auc_a, var_a = delong_auc(targets[mask_a], predictions[mask_a])
+    auc_b, var_b = delong_auc(targets[mask_b], predictions[mask_b])
+    difference = auc_a[0] - auc_b[0]
+    variance = var_a[0, 0] + var_b[0, 0]
+    low, high = _normal_ci(difference, variance, level, -1, 1)
+    return difference, low, high, _p_value(difference, variance)
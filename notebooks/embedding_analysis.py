@@ -0,0 +1,179 @@
+import hashlib
+import os
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+
+from results_cache import cached, content_hash
+
+chunk_rows = 8192  # rows per streamed chunk; bounds the memory of every step besides the stored results
+
+
+def csv_to_store(csv_path, store_path, num_features, chunksize=chunk_rows):
+    """
+    Convert the first num_features columns of an embeddings csv to a float32 .npy file, chunk by chunk
+    """
+    n = sum(len(chunk) for chunk in pd.read_csv(csv_path, usecols=[0], chunksize=10**6))
+    store = np.lib.format.open_memmap(store_path + ".tmp", mode="w+", dtype=np.float32, shape=(n, num_features))
+    start = 0
+    for chunk in pd.read_csv(csv_path, usecols=range(num_features), dtype=np.float32, chunksize=chunksize):
+        store[start : start + len(chunk)] = chunk.values
+        start += len(chunk)
+    store.flush()
+    del store
+    os.replace(store_path + ".tmp", store_path)
+
+
+def open_store(data_dir, num_features, split="test"):
+    """
+    Memory-mapped embeddings (n_samples, num_features) of a model directory: embeddings.<split>.npy as saved by
+    the prediction scripts, converted once from embeddings.<split>.csv if missing
+    """
+    store_path = os.path.join(data_dir, f"embeddings.{split}.npy")
+    if not os.path.exists(store_path):
+        csv_to_store(os.path.join(data_dir, f"embeddings.{split}.csv"), store_path, num_features)
+    return np.load(store_path, mmap_mode="r")
+
+
+def _chunks(n, size=chunk_rows):
+    for start in range(0, n, size):
+        yield slice(start, min(start + size, n))
+
+
+def store_hash(x):
+    """
+    SHA-256 of the shape and contents of an array, read chunk by chunk
+    """
+    h = hashlib.sha256(f"{x.dtype.str}{x.shape}".encode())
+    for rows in _chunks(len(x)):
+        h.update(np.ascontiguousarray(x[rows]).tobytes())
+    return h.hexdigest()
+
+
+def fit_pca(x, n_components=50, method="incremental", seed=42):
+    """
+    PCA scores (float32) and the share of the total variance of each component.
+    incremental: IncrementalPCA fitted and applied chunk by chunk, memory independent of the number of samples;
+    randomized: randomized SVD on all samples at once (in memory).
+    """
+    n_components = min(n_components, *x.shape)
+    if method == "incremental":
+        pca = IncrementalPCA(n_components=n_components)
+        for rows in _chunks(len(x), max(chunk_rows, n_components)):
+            if rows.stop - rows.start >= n_components:  # partial_fit needs at least n_components rows
+                pca.partial_fit(x[rows])
+        scores = np.empty((len(x), n_components), dtype=np.float32)
+        for rows in _chunks(len(x)):
+            scores[rows] = pca.transform(x[rows])
+    elif method == "randomized":
+        pca = PCA(n_components=n_components, svd_solver="randomized", random_state=seed)
+        scores = pca.fit_transform(np.asarray(x, dtype=np.float32)).astype(np.float32)
+    else:
+        raise ValueError(f"PCA method must be incremental or randomized, not {method}")
+    return {"scores": scores, "explained_variance_ratio": pca.explained_variance_ratio_}
+
+
+def tsne_layout(scores, n_landmarks=5000, n_neighbors=10, seed=42):
+    """
+    2-D t-SNE layout of all samples in bounded time and memory: t-SNE (as in chexpert.explorer.ipynb) on at most
+    n_landmarks random samples, every other sample placed at the inverse-distance weighted mean of the layout
+    positions of its n_neighbors nearest landmarks in PCA space. With fewer samples than n_landmarks this is
+    plain t-SNE on all of them.
+    """
+    n = len(scores)
+    rng = np.random.default_rng(seed)
+    landmarks = np.sort(rng.choice(n, min(n, n_landmarks), replace=False))
+    tsne = TSNE(n_components=2, init="random", learning_rate="auto", random_state=seed)
+    landmark_layout = tsne.fit_transform(scores[landmarks]).astype(np.float32)
+
+    layout = np.empty((n, 2), dtype=np.float32)
+    layout[landmarks] = landmark_layout
+    others = np.setdiff1d(np.arange(n), landmarks)
+    if len(others):
+        neighbors = NearestNeighbors(n_neighbors=min(n_neighbors, len(landmarks))).fit(scores[landmarks])
+        for rows in _chunks(len(others)):
+            distance, index = neighbors.kneighbors(scores[others[rows]])
+            weights = 1 / np.maximum(distance, 1e-12)
+            weights /= weights.sum(axis=1, keepdims=True)
+            layout[others[rows]] = np.einsum("nk,nkd->nd", weights, landmark_layout[index])
+    return {"layout": layout, "landmarks": landmarks}
+
+
+def projections(
+    data_dir,
+    model,
+    num_features,
+    n_components=50,
+    pca_method="incremental",
+    n_landmarks=5000,
+    n_neighbors=10,
+    seed=42,
+    cache_dir=".cache/embeddings",
+    timer=print,
+):
+    """
+    PCA scores and t-SNE layout of the test-set embeddings of a model, cached under cache_dir keyed by model,
+    embedding hash and parameters (the t-SNE entry by the PCA key, so that it is recomputed on its own)
+    """
+    start = perf_counter()
+    embeds = open_store(data_dir, num_features)
+    embedding_hash = store_hash(embeds)
+    timer(f"Embeddings {embeds.shape} ({perf_counter() - start:.1f}s)")
+
+    start = perf_counter()
+    pca_key = content_hash("pca", model, embedding_hash, n_components, pca_method, seed)
+    pca = cached(cache_dir, pca_key, lambda: fit_pca(embeds, n_components, pca_method, seed))
+    timer(f"PCA, {pca['scores'].shape[1]} components ({perf_counter() - start:.1f}s)")
+
+    start = perf_counter()
+    tsne_key = content_hash("tsne", pca_key, n_landmarks, n_neighbors, seed)
+    tsne = cached(cache_dir, tsne_key, lambda: tsne_layout(pca["scores"], n_landmarks, n_neighbors, seed))
+    timer(f"t-SNE, {len(tsne['landmarks'])} landmarks ({perf_counter() - start:.1f}s)")
+    return {**pca, **tsne}
+
+
+def layout_frame(result, n_modes=4):
+    """
+    Columns as used by the explorer notebook: PCA Mode 1..n_modes, t-SNE Dimension 1/2
+    """
+    frame = pd.DataFrame({f"PCA Mode {i + 1}": result["scores"][:, i] for i in range(n_modes)})
+    frame["t-SNE Dimension 1"] = result["layout"][:, 0]
+    frame["t-SNE Dimension 2"] = result["layout"][:, 1]
+    return frame
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="PCA and t-SNE projections of all test-set embeddings of a model")
+    parser.add_argument("--model", default="densenet-resample")
+    parser.add_argument("--data_dir", default="", help="default: ../prediction/chexpert/disease/<model>")
+    parser.add_argument("--num_features", default=1024, type=int, help="1024 for DenseNet-121, 512 for ResNet-34")
+    parser.add_argument("--n_components", default=50, type=int)
+    parser.add_argument("--pca", default="incremental", choices=["incremental", "randomized"])
+    parser.add_argument("--n_landmarks", default=5000, type=int)
+    parser.add_argument("--n_neighbors", default=10, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--cache_dir", default=".cache/embeddings", help="'' disables caching")
+    parser.add_argument("--out", default="", help="default: <model>.embeddings.layout.csv")
+    args = parser.parse_args()
+
+    result = projections(
+        args.data_dir or os.path.join("../prediction/chexpert/disease", args.model),
+        args.model,
+        args.num_features,
+        args.n_components,
+        args.pca,
+        args.n_landmarks,
+        args.n_neighbors,
+        args.seed,
+        args.cache_dir or None,
+    )
+    retained = np.cumsum(result["explained_variance_ratio"])
+    print(f"Retained variance: {retained[min(3, len(retained) - 1)]:.3f} (4 modes), {retained[-1]:.3f} (all)")
+    out = args.out or f"{args.model}.embeddings.layout.csv"
+    layout_frame(result).to_csv(out, index=False)
+    print(f"Saved as {out}")
@@ -0,0 +1,236 @@
+import json
+import os
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import MiniBatchKMeans
+
+from embedding_analysis import chunk_rows, open_store, store_hash
+
+index_version = 1
+
+
+def _prepare(x, metric):
+    x = np.asarray(x, dtype=np.float32)
+    if metric == "cosine":
+        x = x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+    return x
+
+
+def _top_k(distances, ids, k):
+    """
+    k smallest distances (sorted) and their ids, per row of distances and ids (same shape)
+    """
+    k = min(k, distances.shape[1])
+    part = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    part_distances = np.take_along_axis(distances, part, axis=1)
+    order = np.argsort(part_distances, axis=1, kind="stable")
+    part = np.take_along_axis(part, order, axis=1)
+    return np.take_along_axis(part_distances, order, axis=1), np.take_along_axis(ids, part, axis=1)
+
+
+def exact_search(store, queries, k=10, metric="l2"):
+    """
+    Exact k nearest rows of store (squared euclidean, or cosine distance 1 - cos) for every query, by chunked
+    matrix products over the (memory-mapped) store. Returns distances and row ids, each (n_queries, k).
+    """
+    queries = _prepare(np.atleast_2d(queries), metric)
+    best_distances = np.full((len(queries), 0), np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(store), chunk_rows):
+        x = _prepare(store[start : start + chunk_rows], metric)
+        distances = np.sum(x**2, axis=1)[None, :] - 2 * queries @ x.T
+        ids = np.arange(start, start + len(x))
+        best_distances, best_ids = _top_k(
+            np.concatenate([best_distances, distances], axis=1),
+            np.concatenate([best_ids, np.broadcast_to(ids, distances.shape)], axis=1),
+            k,
+        )
+    return np.maximum(best_distances + np.sum(queries**2, axis=1, keepdims=True), 0), best_ids
+
+
+class IVFIndex:
+    """
+    Inverted-file index: the rows are clustered by k-means into n_lists lists, stored contiguously per list, and
+    a query is compared exactly with the rows of its n_probe closest lists only. Files of index_dir:
+    centroids.npy, offsets.npy (list boundaries), ids.npy (row id per stored vector), vectors.npy (memory-mapped),
+    sq_norms.npy and meta.json.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.metric = self.meta["metric"]
+        self.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"))
+        self.ids = np.load(os.path.join(index_dir, "ids.npy"))
+        self.sq_norms = np.load(os.path.join(index_dir, "sq_norms.npy"))
+        self.vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r")
+
+    @staticmethod
+    def build(store, index_dir, n_lists=None, metric="l2", seed=42, source_hash=None):
+        """
+        Cluster the rows of store (k-means on a sample of at most 64 rows per list) and write the index
+        """
+        n = len(store)
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = _prepare(store[np.sort(rng.choice(n, min(n, 64 * n_lists), replace=False))], metric)
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=4096, n_init=1, random_state=seed).fit(sample)
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+
+        assignment = np.empty(n, dtype=np.int64)
+        for start in range(0, n, chunk_rows):
+            x = _prepare(store[start : start + chunk_rows], metric)
+            distances = np.sum(centroids**2, axis=1)[None, :] - 2 * x @ centroids.T
+            assignment[start : start + len(x)] = np.argmin(distances, axis=1)
+        ids = np.argsort(assignment, kind="stable")
+        offsets = np.searchsorted(assignment[ids], np.arange(n_lists + 1))
+
+        os.makedirs(index_dir, exist_ok=True)
+        vectors = np.lib.format.open_memmap(
+            os.path.join(index_dir, "vectors.npy"), mode="w+", dtype=np.float32, shape=(n, store.shape[1])
+        )
+        sq_norms = np.empty(n, dtype=np.float32)
+        for start in range(0, n, chunk_rows):
+            rows = ids[start : start + chunk_rows]
+            x = _prepare(store[np.sort(rows)], metric)[np.argsort(np.argsort(rows))]
+            vectors[start : start + len(rows)] = x
+            sq_norms[start : start + len(rows)] = np.sum(x**2, axis=1)
+        vectors.flush()
+        del vectors
+        np.save(os.path.join(index_dir, "centroids.npy"), centroids)
+        np.save(os.path.join(index_dir, "offsets.npy"), offsets)
+        np.save(os.path.join(index_dir, "ids.npy"), ids)
+        np.save(os.path.join(index_dir, "sq_norms.npy"), sq_norms)
+        meta = {"version": index_version, "n": n, "n_lists": n_lists, "metric": metric, "source_hash": source_hash}
+        with open(os.path.join(index_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        return IVFIndex(index_dir)
+
+    def search(self, queries, k=10, n_probe=8):
+        """
+        Approximate k nearest row ids (and distances as in exact_search) for every query
+        """
+        queries = _prepare(np.atleast_2d(queries), self.metric)
+        centroid_distances = np.sum(self.centroids**2, axis=1)[None, :] - 2 * queries @ self.centroids.T
+        n_probe = min(n_probe, len(self.centroids))
+        probes = np.argpartition(centroid_distances, n_probe - 1, axis=1)[:, :n_probe]
+
+        all_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        all_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, (query, lists) in enumerate(zip(queries, probes)):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            if len(rows) == 0:
+                continue
+            distances = self.sq_norms[rows] - 2 * np.asarray(self.vectors[rows]) @ query
+            found_distances, found_ids = _top_k(distances[None, :], self.ids[rows][None, :], k)
+            all_distances[q, : found_ids.shape[1]] = np.maximum(found_distances[0] + query @ query, 0)
+            all_ids[q, : found_ids.shape[1]] = found_ids[0]
+        return all_distances, all_ids
+
+
+def evaluate(index, store, k=10, n_probe=8, n_queries=200, seed=0):
+    """
+    recall@k of index.search against exact_search, and per-query latency in ms of both, on random store rows
+    """
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(store[np.sort(rng.choice(len(store), min(n_queries, len(store)), replace=False))])
+    latency = {"ivf": [], "exact": []}
+    recalls = []
+    for query in queries:
+        start = perf_counter()
+        _, approximate = index.search(query, k, n_probe)
+        latency["ivf"].append(1000 * (perf_counter() - start))
+        start = perf_counter()
+        _, exact = exact_search(store, query, k, index.metric)
+        latency["exact"].append(1000 * (perf_counter() - start))
+        recalls.append(len(np.intersect1d(approximate[0], exact[0])) / exact.shape[1])
+    report = {f"recall@{k}": float(np.mean(recalls))}
+    for name, times in latency.items():
+        report[f"{name}_ms_median"] = float(np.median(times))
+        report[f"{name}_ms_p95"] = float(np.percentile(times, 95))
+    return report
+
+
+def load_or_build(store, index_dir, n_lists=None, metric="l2", seed=42):
+    """
+    The index of index_dir if it was built from the same embeddings with the same settings, else a new one
+    """
+    source_hash = store_hash(store)
+    meta_path = os.path.join(index_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if (
+            meta.get("version") == index_version
+            and meta["source_hash"] == source_hash
+            and meta["metric"] == metric
+            and (n_lists is None or meta["n_lists"] == n_lists)
+        ):
+            return IVFIndex(index_dir)
+    return IVFIndex.build(store, index_dir, n_lists, metric, seed, source_hash)
+
+
+def neighbours_frame(distances, ids, metadata=None):
+    """
+    One row per (query, rank) with the neighbour's row id and distance, joined with the metadata rows
+    (the sample csv the embeddings were computed on, in the same order)
+    """
+    frame = pd.DataFrame(
+        {
+            "query": np.repeat(np.arange(ids.shape[0]), ids.shape[1]),
+            "rank": np.tile(np.arange(1, ids.shape[1] + 1), ids.shape[0]),
+            "row": ids.ravel(),
+            "distance": distances.ravel(),
+        }
+    )
+    if metadata is not None:
+        frame = frame.join(metadata.reset_index(drop=True), on="row")
+    return frame
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Approximate (IVF) nearest-neighbour search over exported embeddings")
+    parser.add_argument("--data_dir", required=True, help="model directory with embeddings.<split>.npy/csv")
+    parser.add_argument("--split", default="test")
+    parser.add_argument("--num_features", default=1024, type=int, help="1024 for DenseNet-121, 512 for ResNet-34")
+    parser.add_argument("--index_dir", default="", help="default: <data_dir>/index.<split>")
+    parser.add_argument("--metric", default="l2", choices=["l2", "cosine"])
+    parser.add_argument("--n_lists", default=None, type=int, help="default: sqrt(n_samples)")
+    parser.add_argument("--n_probe", default=8, type=int)
+    parser.add_argument("--k", default=10, type=int)
+    parser.add_argument("--query_rows", default=[], nargs="*", type=int, help="rows of the store to query")
+    parser.add_argument("--exact", action="store_true", help="exact search instead of the index")
+    parser.add_argument("--evaluate", action="store_true", help="report recall@k and latency")
+    parser.add_argument("--metadata", default="", help="sample csv of the embeddings, joined to the neighbours")
+    parser.add_argument("--out", default="", help="csv for the neighbours")
+    args = parser.parse_args()
+
+    store = open_store(args.data_dir, args.num_features, args.split)
+    start = perf_counter()
+    index = load_or_build(store, args.index_dir or os.path.join(args.data_dir, f"index.{args.split}"),
+                          args.n_lists, args.metric)
+    print(f"Index of {store.shape} with {len(index.centroids)} lists ready in {perf_counter() - start:.2f}s")
+
+    if args.evaluate:
+        report = evaluate(index, store, args.k, args.n_probe)
+        print(", ".join(f"{name}: {value:.3f}" for name, value in report.items()))
+
+    if args.query_rows:
+        queries = np.asarray(store[np.asarray(args.query_rows)])
+        start = perf_counter()
+        if args.exact:
+            distances, ids = exact_search(store, queries, args.k, args.metric)
+        else:
+            distances, ids = index.search(queries, args.k, args.n_probe)
+        print(f"{len(queries)} queries in {1000 * (perf_counter() - start):.1f} ms")
+        metadata = pd.read_csv(args.metadata) if args.metadata else None
+        neighbours = neighbours_frame(distances, ids, metadata)
+        neighbours.insert(1, "query_row", np.asarray(args.query_rows)[neighbours["query"].values])
+        if args.out:
+            neighbours.to_csv(args.out, index=False)
+        print(neighbours.to_string(max_rows=50))
@@ -0,0 +1,201 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import cho_factor, cho_solve
+from sklearn.linear_model import LogisticRegression
+from tabulate import tabulate
+
+from delong import auc_ci
+from embedding_analysis import _chunks, open_store
+from results_disease_detection import asian, black, female, male, white
+from subgroups import age_bin, age_bins
+
+# attribute -> classes, in the order of the probe outputs; samples with other values (e.g. race "Other") are left out
+age_bin_names = [f"<={age_bins[1]}"] + [f"{lo + 1}-{hi}" for lo, hi in zip(age_bins[1:-2], age_bins[2:-1])]
+age_bin_names += [f">{age_bins[-2]}"]
+probe_classes = {"sex": [female, male], "race": [white, asian, black], "age_bin": age_bin_names}
+
+
+def probe_targets(data: pd.DataFrame, attributes=tuple(probe_classes)):
+    """
+    Class index per sample (-1: not one of the classes) for every attribute
+    """
+    targets = {}
+    for attribute in attributes:
+        if attribute == "age_bin":
+            codes = age_bin(data.age)
+            targets[attribute] = np.where(np.isnan(codes), -1, codes).astype(np.int64)
+        else:
+            lookup = {value: code for code, value in enumerate(probe_classes[attribute])}
+            targets[attribute] = data[attribute].map(lookup).fillna(-1).values.astype(np.int64)
+    return targets
+
+
+def standardize(x_fit, x_eval):
+    """
+    Both sets scaled by the per-feature mean and standard deviation of x_fit, as float32 in memory
+    """
+    mean = np.zeros(x_fit.shape[1])
+    sq_mean = np.zeros(x_fit.shape[1])
+    for rows in _chunks(len(x_fit)):
+        chunk = np.asarray(x_fit[rows], dtype=np.float64)
+        mean += chunk.sum(axis=0) / len(x_fit)
+        sq_mean += (chunk**2).sum(axis=0) / len(x_fit)
+    std = np.sqrt(np.maximum(sq_mean - mean**2, 0))
+    std[std == 0] = 1
+
+    def scale(x):
+        out = np.empty(x.shape, dtype=np.float32)
+        for rows in _chunks(len(x)):
+            out[rows] = (x[rows] - mean) / std
+        return out
+
+    return scale(x_fit), scale(x_eval)
+
+
+def ridge_probes(x_fit, targets_fit, x_eval, alpha=1.0):
+    """
+    Closed-form ridge regression on the one-hot classes of all attributes: one Cholesky factorization of
+    X'X + alpha * n * I per distinct set of labelled samples, solved for all classes of those attributes at once.
+    Returns attribute -> scores (n_eval, n_classes).
+    """
+    groups = []  # (mask of labelled samples, attributes)
+    for attribute, codes in targets_fit.items():
+        mask = codes >= 0
+        for group_mask, attributes in groups:
+            if np.array_equal(group_mask, mask):
+                attributes.append(attribute)
+                break
+        else:
+            groups.append((mask, [attribute]))
+
+    scores = {}
+    for mask, attributes in groups:
+        x = x_fit[mask]
+        mean = x.mean(axis=0)
+        x = x - mean
+        gram = (x.T @ x).astype(np.float64)
+        gram[np.diag_indices_from(gram)] += alpha * len(x)
+        onehot = [np.eye(len(probe_classes[a]))[targets_fit[a][mask]] for a in attributes]
+        y = np.concatenate(onehot, axis=1)
+        weights = cho_solve(cho_factor(gram), x.T.astype(np.float64) @ (y - y.mean(axis=0)))
+        outputs = (x_eval - mean) @ weights.astype(np.float32)
+        splits = np.cumsum([o.shape[1] for o in onehot])[:-1]
+        scores.update(zip(attributes, np.split(outputs, splits, axis=1)))
+    return scores
+
+
+def logistic_probe(x_fit, codes_fit, x_eval, attribute, alpha=1.0, max_iter=500):
+    """
+    L2-regularized (multinomial) logistic regression fitted with L-BFGS; class probabilities (n_eval, n_classes of
+    attribute), zero for classes without samples in x_fit
+    """
+    mask = codes_fit >= 0
+    model = LogisticRegression(C=1 / alpha, solver="lbfgs", max_iter=max_iter)
+    model.fit(x_fit[mask], codes_fit[mask])
+    scores = np.zeros((len(x_eval), len(probe_classes[attribute])), dtype=np.float32)
+    scores[:, model.classes_] = model.predict_proba(x_eval)
+    return scores
+
+
+def probe_aucs(scores, codes_eval, attribute, level=0.95, codes_fit=None):
+    """
+    One-vs-rest AUC of every class (a single row for two classes) with DeLong CI, as tidy rows. Classes without
+    samples in the eval split, or in the fit split (codes_fit, if given), are left out.
+    """
+    rows = []
+    mask = codes_eval >= 0
+    classes = probe_classes[attribute]
+    fitted = set(range(len(classes))) if codes_fit is None else set(np.unique(codes_fit[codes_fit >= 0]).tolist())
+    for c in range(1, 2) if len(classes) == 2 else range(len(classes)):
+        y = (codes_eval[mask] == c).astype(np.int64)
+        if y.min() == y.max() or c not in fitted:
+            continue
+        auc, low, high = auc_ci(y, scores[mask, c], level)
+        rows.append(
+            {
+                "attribute": attribute,
+                "class": classes[c],
+                "n": int(mask.sum()),
+                "n_class": int(y.sum()),
+                "AUC": auc,
+                "ci_low": low,
+                "ci_high": high,
+            }
+        )
+    return rows
+
+
+def run_probes(data_dir, data_fit, data_eval, num_features, solver="ridge", alpha=1.0, level=0.95, pool=None,
+               fit_split="val", eval_split="test"):
+    """
+    Probe AUCs of one model: probes fitted on the fit_split embeddings of data_dir (rows of data_fit), evaluated
+    on the eval_split embeddings (rows of data_eval). L-BFGS fits run on pool, one attribute per task.
+    """
+    x_fit, x_eval = open_store(data_dir, num_features, fit_split), open_store(data_dir, num_features, eval_split)
+    for x, data, split in [(x_fit, data_fit, fit_split), (x_eval, data_eval, eval_split)]:
+        if len(x) != len(data):
+            raise ValueError(f"{data_dir}: {len(x)} {split} embeddings but {len(data)} rows of metadata")
+    x_fit, x_eval = standardize(x_fit, x_eval)
+    targets_fit, targets_eval = probe_targets(data_fit), probe_targets(data_eval)
+
+    if solver == "ridge":
+        scores = ridge_probes(x_fit, targets_fit, x_eval, alpha)
+    elif solver == "lbfgs":
+        if pool is None:
+            scores = {a: logistic_probe(x_fit, codes, x_eval, a, alpha) for a, codes in targets_fit.items()}
+        else:
+            futures = {
+                a: pool.submit(logistic_probe, x_fit, codes, x_eval, a, alpha) for a, codes in targets_fit.items()
+            }
+            scores = {a: future.result() for a, future in futures.items()}
+    else:
+        raise ValueError(f"Probe solver must be ridge or lbfgs, not {solver}")
+    return [
+        row for a in targets_fit for row in probe_aucs(scores[a], targets_eval[a], a, level, targets_fit[a])
+    ]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Linear probes for sex, race and age bin on stored embeddings")
+    parser.add_argument(
+        "--model_dirs",
+        nargs="+",
+        default=["../prediction/chexpert/disease/densenet-all"],
+        help="directories containing embeddings.val/test.npy (or .csv)",
+    )
+    parser.add_argument("--fit_data", default="../datafiles/chexpert/chexpert.sample.val.csv")
+    parser.add_argument("--eval_data", default="../datafiles/chexpert/chexpert.sample.test.csv")
+    parser.add_argument("--num_features", default=1024, type=int, help="1024 for DenseNet-121, 512 for ResNet-34")
+    parser.add_argument("--solver", default="ridge", choices=["ridge", "lbfgs"])
+    parser.add_argument("--alpha", default=1.0, type=float, help="L2 penalty (ridge: per sample; lbfgs: 1/C)")
+    parser.add_argument("--level", default=0.95, type=float)
+    parser.add_argument("--n_jobs", default=4, type=int, help="threads; models (and lbfgs attributes) in parallel")
+    parser.add_argument("--out", default="embedding_probes.csv")
+    args = parser.parse_args()
+
+    data_fit, data_eval = pd.read_csv(args.fit_data), pd.read_csv(args.eval_data)
+
+    def probe_model(model_dir, pool):
+        start = perf_counter()
+        rows = run_probes(model_dir, data_fit, data_eval, args.num_features, args.solver, args.alpha, args.level,
+                          pool)
+        name = model_dir.rstrip("/").split("/")[-1]
+        print(f"{name}: {perf_counter() - start:.1f}s")
+        return [{"model": name, **row} for row in rows]
+
+    # model tasks wait on attribute tasks, so they get their own pool
+    with ThreadPoolExecutor(args.n_jobs) as model_pool, ThreadPoolExecutor(args.n_jobs) as probe_pool:
+        futures = [model_pool.submit(probe_model, model_dir, probe_pool) for model_dir in args.model_dirs]
+        results = pd.DataFrame([row for future in futures for row in future.result()])
+    results["solver"] = args.solver
+    results["level"] = args.level
+    results.to_csv(args.out, index=False)
+    print(f"\nSaved {len(results)} rows to {args.out}")
+    table = results.assign(
+        AUC=[f"{auc:.2f} ({low:.2f}-{high:.2f})" for auc, low, high in results[["AUC", "ci_low", "ci_high"]].values]
+    ).pivot_table(index=["attribute", "class"], columns="model", values="AUC", aggfunc="first", sort=False)
+    print(tabulate(table, headers=table.columns))
@@ -0,0 +1,105 @@
+import os
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+labels = [
+    "No Finding",
+    "Enlarged Cardiomediastinum",
+    "Cardiomegaly",
+    "Lung Opacity",
+    "Lung Lesion",
+    "Edema",
+    "Consolidation",
+    "Pneumonia",
+    "Atelectasis",
+    "Pneumothorax",
+    "Pleural Effusion",
+    "Pleural Other",
+    "Fracture",
+    "Support Devices",
+]
+
+# file name part -> split, for sample files without a split column (as written by the sample notebooks)
+split_suffixes = {".train": "train", ".val": "validate", ".test": "test"}
+categorical_share = 0.5  # string columns with fewer distinct values than this share of rows become categorical
+
+
+def split_of_file(path):
+    name = os.path.basename(path)
+    for suffix, split in split_suffixes.items():
+        if suffix + "." in name:
+            return split
+    raise ValueError(f"{path} has no split column and no {'/'.join(split_suffixes)} in its name")
+
+
+def compact(df: pd.DataFrame):
+    """
+    Smallest lossless dtypes: labels as float32 (1/0/-1/nan), integers downcast, and repeated strings (split,
+    demographics, patient ids, ...) as categorical. Paths and other unique strings stay strings.
+    """
+    df = df.drop(columns=[c for c in df.columns if str(c).startswith("Unnamed: ")])
+    for column in df.columns:
+        values = df[column]
+        if column in labels:
+            df[column] = values.astype(np.float32)
+        elif pd.api.types.is_integer_dtype(values):
+            df[column] = pd.to_numeric(values, downcast="integer")
+        elif pd.api.types.is_string_dtype(values) or values.dtype == object:
+            if values.nunique() < categorical_share * len(values):
+                df[column] = values.astype("category")
+    return df
+
+
+def build_manifest(paths, split_col="split"):
+    """
+    One table of all samples from one or more sample csv files; a file without split column is taken to be
+    the split in its name (e.g. .train.csv)
+    """
+    frames = []
+    for path in paths:
+        frame = pd.read_csv(path)
+        if split_col not in frame:
+            frame[split_col] = split_of_file(path)
+        frames.append(frame)
+    df = pd.concat(frames, ignore_index=True)
+    df[split_col] = pd.Categorical(df[split_col], categories=list(split_suffixes.values()))
+    return compact(df)
+
+
+def write_manifest(df: pd.DataFrame, path):
+    if path.endswith(".feather"):
+        df.to_feather(path)
+    else:
+        df.to_parquet(path, index=False)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Single columnar manifest (Parquet/Feather) from sample csv files")
+    parser.add_argument(
+        "--input",
+        nargs="+",
+        default=[
+            f"../datafiles/chexpert/chexpert.sample_128_from_train_filtered_True.{split}.csv"
+            for split in ["train", "val", "test"]
+        ],
+        help="full sample with split column, or the .train/.val/.test csv files",
+    )
+    parser.add_argument("--out", default="../datafiles/chexpert/chexpert.sample_128.manifest.parquet")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    df = build_manifest(args.input)
+    csv_seconds = perf_counter() - start
+    write_manifest(df, args.out)
+
+    start = perf_counter()
+    df = pd.read_feather(args.out) if args.out.endswith(".feather") else pd.read_parquet(args.out)
+    manifest_seconds = perf_counter() - start
+    csv_mb = sum(os.path.getsize(path) for path in args.input) / 2**20
+    print(f"{len(df)} samples, {df.memory_usage(deep=True).sum() / 2**20:.1f} MB in memory")
+    print(f"csv:      {csv_mb:.1f} MB, read in {csv_seconds:.2f}s")
+    print(f"manifest: {os.path.getsize(args.out) / 2**20:.1f} MB, read in {manifest_seconds:.2f}s ({args.out})")
+    print(df[[c for c in ["split", "race", "sex"] if c in df]].value_counts(sort=False))
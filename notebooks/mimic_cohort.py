@@ -0,0 +1,293 @@
+import os
+import resource
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from sklearn.utils import shuffle
+
+from patient_split import assign_split, leaked_patients
+
+white = "White"
+asian = "Asian"
+black = "Black"
+
+# race as documented in admissions.csv -> race in the study data, in the order of race_label
+races = {"WHITE": white, "ASIAN": asian, "BLACK/AFRICAN AMERICAN": black}
+sexes = {"M": "Male", "F": "Female"}
+views = ["AP", "PA"]
+
+labels = [
+    "No Finding",
+    "Enlarged Cardiomediastinum",
+    "Cardiomegaly",
+    "Lung Opacity",
+    "Lung Lesion",
+    "Edema",
+    "Consolidation",
+    "Pneumonia",
+    "Atelectasis",
+    "Pneumothorax",
+    "Pleural Effusion",
+    "Pleural Other",
+    "Fracture",
+    "Support Devices",
+]
+
+preproc_dir = "preproc_224x224/"
+
+# columns not listed are left to pandas; float columns keep float64 so that the csv output is unchanged
+metadata_dtypes = {
+    "dicom_id": "str",
+    "subject_id": np.int32,
+    "study_id": np.int32,
+    "PerformedProcedureStepDescription": "category",
+    "ViewPosition": "category",
+    "Rows": np.int32,
+    "Columns": np.int32,
+    "StudyDate": np.int32,
+    "ProcedureCodeSequence_CodeMeaning": "category",
+    "ViewCodeSequence_CodeMeaning": "category",
+    "PatientOrientationCodeSequence_CodeMeaning": "category",
+}
+diagnosis_dtypes = {"subject_id": np.int32, "study_id": np.int32, **{label: np.float32 for label in labels}}
+admissions_dtypes = {"subject_id": np.int32, "ethnicity": "category"}
+patients_dtypes = {
+    "subject_id": np.int32,
+    "gender": "category",
+    "anchor_age": np.int16,
+    "anchor_year": np.int16,
+    "anchor_year_group": "category",
+}
+
+
+class StageTimer:
+    """
+    Wall time and peak resident memory (of the process so far) after each stage
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.start = perf_counter()
+
+    def __call__(self, stage):
+        now = perf_counter()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+        self.rows.append({"stage": stage, "seconds": now - self.start, "peak_rss_mb": peak})
+        self.start = now
+
+    def report(self):
+        table = pd.DataFrame(self.rows).set_index("stage")
+        table.loc["total"] = [table["seconds"].sum(), table["peak_rss_mb"].max()]
+        return table.round(2)
+
+
+def _concat(chunks):
+    """
+    pd.concat that keeps categorical columns categorical when the chunks found different categories
+    """
+    chunks = list(chunks)
+    frame = pd.concat(chunks, ignore_index=True)
+    for column, dtype in chunks[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype) and not isinstance(frame[column].dtype, pd.CategoricalDtype):
+            frame[column] = union_categoricals([chunk[column] for chunk in chunks], sort_categories=True)
+    return frame
+
+
+def read_filtered(path, dtypes, keep=None, chunksize=10**6, usecols=None):
+    """
+    Read a csv in chunks, keeping the rows of each chunk where keep(chunk) is true
+    """
+    chunks = pd.read_csv(path, dtype=dtypes, usecols=usecols, chunksize=chunksize)
+    return _concat(chunk[keep(chunk)] if keep is not None else chunk for chunk in chunks)
+
+
+def read_ethnicity(path, chunksize=10**6):
+    """
+    Documented ethnicity per patient from admissions.csv: the distinct (subject_id, ethnicity) pairs in order of
+    appearance, and a boolean mask of the pairs whose patient has more than one documented ethnicity
+    """
+    pairs = _concat(
+        chunk.drop_duplicates()
+        for chunk in pd.read_csv(path, dtype=admissions_dtypes, usecols=list(admissions_dtypes), chunksize=chunksize)
+    )
+    pairs = pairs.drop_duplicates(ignore_index=True)
+    return pairs, pairs.subject_id.duplicated(keep=False).values
+
+
+def inconsistent_combinations(pairs, inconsistent):
+    """
+    Counts of the sets of documented ethnicities of the patients with inconsistent race information, named by the
+    sorted ethnicities joined by "_". Every patient's set is a bit mask over the ethnicity codes.
+    """
+    pairs = pairs[inconsistent].sort_values("subject_id", kind="stable")
+    ethnicity = pairs.ethnicity.cat.remove_unused_categories()
+    categories = np.asarray(ethnicity.cat.categories)
+    order = np.argsort(categories)
+    bits = np.left_shift(1, np.argsort(order)[ethnicity.cat.codes.values]).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, pairs.subject_id.values[1:] != pairs.subject_id.values[:-1]])
+    counts = pd.Series(np.bitwise_or.reduceat(bits, starts)).value_counts()
+    names = ["_".join(categories[order][(mask >> np.arange(len(order))) & 1 == 1]) for mask in counts.index]
+    return pd.Series(counts.values, index=pd.Index(names, name="ethnicity"), name="count")
+
+
+def build_cohort(data_dir, chunksize=10**6, timer=None):
+    """
+    Study population of mimic.sample.ipynb (before splitting): frontal (AP/PA) images with CheXpert labels of
+    patients with one consistently documented race among White, Asian and Black, with age at the study,
+    race/sex/disease labels and image paths. Rows and columns are in the order of the notebook.
+    """
+    timer = timer or (lambda stage: None)
+
+    pairs, inconsistent = read_ethnicity(os.path.join(data_dir, "admissions.csv"), chunksize)
+    ethnicity_df = pairs[~inconsistent & pairs.ethnicity.isin(list(races)).values]
+    subjects = ethnicity_df.subject_id.values
+    timer("admissions")
+
+    metadata_df = read_filtered(
+        os.path.join(data_dir, "mimic-cxr-2.0.0-metadata.csv"),
+        metadata_dtypes,
+        lambda chunk: chunk.ViewPosition.isin(views).values & chunk.subject_id.isin(subjects).values,
+        chunksize,
+    )
+    timer("metadata")
+    diagnosis_df = read_filtered(
+        os.path.join(data_dir, "mimic-cxr-2.0.0-chexpert.csv"),
+        diagnosis_dtypes,
+        lambda chunk: chunk.subject_id.isin(subjects).values,
+        chunksize,
+    )
+    timer("chexpert labels")
+    patients_df = pd.read_csv(os.path.join(data_dir, "patients.csv"), dtype=patients_dtypes)
+    timer("patients")
+
+    df = pd.merge(metadata_df, diagnosis_df, on=["subject_id", "study_id"])
+    df = pd.merge(df, ethnicity_df.rename(columns={"ethnicity": "race"}), on="subject_id")
+    df = pd.merge(df, patients_df, on="subject_id")
+    del metadata_df, diagnosis_df
+    df = df.rename(columns={"gender": "sex", "anchor_age": "age"})
+    df["age"] = df["age"] + (np.floor(df["StudyDate"] / 10000) - df["anchor_year"])
+
+    df["race"] = df["race"].map(races).astype(pd.CategoricalDtype(list(races.values())))
+    df["race_label"] = df["race"].cat.codes.astype(np.int8)
+    df["sex"] = df["sex"].map(sexes)
+    df["sex_label"] = df["sex"].map({"Male": 0, "Female": 1})
+
+    # Pleural Effusion over No Finding; Other where No Finding is not set
+    no_finding, effusion = df[labels[0]].values, df[labels[10]].values
+    disease = np.where(np.isnan(no_finding), "Other", no_finding.astype(object))
+    disease[no_finding == 1] = labels[0]
+    disease[effusion == 1] = labels[10]
+    disease_label = disease.copy()
+    for code, name in enumerate([labels[0], labels[10], "Other"]):
+        disease_label[disease == name] = code
+    df["disease"] = disease
+    df["disease_label"] = disease_label
+
+    df["subject_id"] = df["subject_id"].astype(str)
+    df["study_id"] = df["study_id"].astype(str)
+    folder = "p" + df["subject_id"].str[0:2] + "/p" + df["subject_id"] + "/s" + df["study_id"] + "/"
+    image = df["dicom_id"] + ".jpg"
+    df.insert(2, "path", folder + image)
+    df["path_preproc"] = preproc_dir + "s" + df["study_id"] + "_" + image
+    timer("cohort")
+    return df
+
+
+def preprocess_images(df, img_data_dir, size=(224, 224)):
+    """
+    Resize the images to size into img_data_dir/preproc_224x224/ (skipping existing files), as in the notebook
+    """
+    from skimage.io import imread, imsave
+    from skimage.transform import resize
+    from tqdm import tqdm
+
+    os.makedirs(os.path.join(img_data_dir, preproc_dir), exist_ok=True)
+    for path, path_preproc in zip(tqdm(df["path"]), df["path_preproc"]):
+        out_path = os.path.join(img_data_dir, path_preproc)
+        if not os.path.exists(out_path):
+            image = resize(imread(os.path.join(img_data_dir, path)), output_shape=size, preserve_range=True)
+            imsave(out_path, image.astype(np.uint8))
+
+
+def random_split(df, seed=42, train_percent=0.6, valid_percent=0.1):
+    """
+    Random patient-wise train/validate/test split, and row shuffle, of mimic.sample.ipynb: with the same seed the
+    same random numbers are drawn in the same order as the notebook's np.random.seed(42) and sklearn shuffles
+    """
+    random_state = np.random.RandomState(seed)
+    unique_sub_id = shuffle(df.subject_id.unique(), random_state=random_state)
+    value1 = round(len(unique_sub_id) * train_percent)
+    value3 = value1 + round(len(unique_sub_id) * valid_percent)
+
+    df = shuffle(df, random_state=random_state)
+    split = pd.Series("test", index=unique_sub_id)
+    split.iloc[:value1] = "train"
+    split.iloc[value1:value3] = "validate"
+    df.insert(5, "split", split.reindex(df.subject_id.values).values)
+    return df
+
+
+def write_samples(df, data_dir):
+    """
+    mimic.sample.csv and its per-split and per-group subsets, as written by the notebook
+    """
+    path = os.path.join(data_dir, "mimic.sample.csv")
+    df.to_csv(path)
+
+    # the subsets are written from the re-read full sample (previous index as "Unnamed: 0", types as inferred from
+    # the csv, e.g. disease_label as float if some No Finding is 0), so that they stay identical to the notebook's
+    df = pd.read_csv(path)
+    subsets = {
+        "train": df.split.values == "train",
+        "val": df.split.values == "validate",
+        "test": df.split.values == "test",
+    }
+    white_rows, male_rows = (df.race == white).values, (df.sex == "Male").values
+    subsets.update(
+        {
+            "train.white": subsets["train"] & white_rows,
+            "val.white": subsets["val"] & white_rows,
+            "train.male": subsets["train"] & male_rows,
+            "val.male": subsets["val"] & male_rows,
+        }
+    )
+    for name, mask in subsets.items():
+        df[mask].to_csv(os.path.join(data_dir, f"mimic.sample.{name}.csv"))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="MIMIC-CXR study data (mimic.sample.*.csv) from the MIMIC-CXR/-IV csv files")
+    parser.add_argument("--data_dir", default="../datafiles/mimic/")
+    parser.add_argument("--out_dir", default="", help="default: data_dir")
+    parser.add_argument("--chunksize", default=10**6, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument(
+        "--split",
+        default="random",
+        choices=["random", "hash"],
+        help="random: shuffled 60/10/30 split of the notebook; hash: by patient id, stable when data is added",
+    )
+    parser.add_argument("--img_data_dir", default="", help="also resize the images found here to 224x224")
+    args = parser.parse_args()
+
+    timer = StageTimer()
+    df = build_cohort(args.data_dir, args.chunksize, timer)
+    print("Total images after inclusion/exclusion criteria: " + str(len(df)))
+    print("Total patients after inclusion/exclusion criteria: " + str(df.subject_id.nunique()))
+    if args.img_data_dir:
+        preprocess_images(df, args.img_data_dir)
+        timer("preprocessing")
+
+    if args.split == "hash":
+        df.insert(5, "split", np.asarray(assign_split(df.subject_id.values)))
+    else:
+        df = random_split(df, args.seed)
+    print(df.split.value_counts())
+    print(f"Patients in more than one split: {len(leaked_patients(df.subject_id.values, df.split.values))}")
+    timer("split")
+    write_samples(df, args.out_dir or args.data_dir)
+    timer("write")
+    print(timer.report())
@@ -0,0 +1,123 @@
+import os
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+split_names = ["train", "validate", "test"]
+split_fractions = [0.6, 0.1, 0.3]
+hash_key = "patient-split-v1"  # 16 characters; changing it reassigns every patient
+id_columns = ["patient_id", "subject_id"]
+
+
+def patient_buckets(ids, key: str = hash_key):
+    """
+    Position in [0, 1) of every patient id from a keyed SipHash of its string form, so that it depends only on
+    the id itself (not on the other ids or their order) and is the same across runs and machines.
+    Every distinct id is hashed once.
+    """
+    codes, uniques = pd.factorize(np.asarray(ids))
+    hashes = pd.util.hash_array(np.asarray(uniques).astype(str).astype(object), hash_key=key, categorize=False)
+    return ((hashes >> np.uint64(11)).astype(np.float64) / 2.0**53)[codes]
+
+
+def assign_split(ids, fractions=split_fractions, names=split_names, key: str = hash_key):
+    """
+    Split name per patient id: train/validate/test with probabilities fractions, the same for all rows of a
+    patient and unchanged when new patients are added. Returns a Categorical of names.
+    """
+    edges = np.cumsum(fractions) / np.sum(fractions)
+    codes = np.searchsorted(edges, patient_buckets(ids, key), side="right")
+    return pd.Categorical.from_codes(np.minimum(codes, len(names) - 1), categories=names)
+
+
+def patient_id_column(columns):
+    for column in id_columns:
+        if column in columns:
+            return column
+    raise ValueError(f"No patient id column ({', '.join(id_columns)}) in {list(columns)}")
+
+
+def leaked_patients(ids, splits):
+    """
+    Patients that occur in more than one split, with their splits joined by "," (empty if there is no leakage).
+    Linear time: one presence mask over the patients per split.
+    """
+    id_codes, unique_ids = pd.factorize(np.asarray(ids))
+    split_codes, unique_splits = pd.factorize(np.asarray(splits))
+    splits_of_patient = np.zeros(len(unique_ids), dtype=np.int64)  # bit s set if the patient is in split s
+    for s in range(len(unique_splits)):
+        present = np.zeros(len(unique_ids), dtype=bool)
+        present[id_codes[split_codes == s]] = True
+        splits_of_patient |= present.astype(np.int64) << s
+    leaked = np.flatnonzero(splits_of_patient & (splits_of_patient - 1))  # more than one bit set
+    names = {
+        mask: ",".join(str(unique_splits[s]) for s in range(len(unique_splits)) if mask >> s & 1)
+        for mask in np.unique(splits_of_patient[leaked])
+    }
+    return pd.Series(
+        [names[mask] for mask in splits_of_patient[leaked]],
+        index=pd.Index(np.asarray(unique_ids)[leaked], name="patient"),
+        dtype=object,
+    )
+
+
+def leaked_patients_files(paths, id_col=None, split_col=None, chunksize=10**6):
+    """
+    leaked_patients over csv files, e.g. the .train/.val/.test files of a sample: the split is split_col if given,
+    else the file. Only the needed columns are read, in chunks.
+    """
+    ids, splits = [], []
+    for path in paths:
+        column = id_col or patient_id_column(pd.read_csv(path, nrows=0).columns)
+        usecols = [column] + ([split_col] if split_col else [])
+        for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunksize):
+            chunk = chunk.drop_duplicates()
+            ids.append(chunk[column].astype(str).values)
+            splits.append(chunk[split_col].values if split_col else np.full(len(chunk), os.path.basename(path)))
+    return leaked_patients(np.concatenate(ids), np.concatenate(splits))
+
+
+def assign_file(path, out, id_col=None, column="split", chunksize=10**6, key: str = hash_key):
+    """
+    Stream a csv into out with the split column set (replaced in place if it exists, else appended)
+    """
+    counts = pd.Series(0, index=split_names)
+    header = True
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        split = assign_split(chunk[id_col or patient_id_column(chunk.columns)].values, key=key)
+        chunk[column] = np.asarray(split)
+        chunk.to_csv(out, mode="w" if header else "a", header=header, index=False)
+        counts += pd.Series(split).value_counts().reindex(split_names)
+        header = False
+    return counts
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Patient-level train/validate/test split by hashing the patient id")
+    parser.add_argument("--input", nargs="+", required=True, help="csv file(s)")
+    parser.add_argument("--out", default="", help="assign: output csv (default: input with '.hashsplit')")
+    parser.add_argument("--check", action="store_true", help="only check the inputs for patients in several splits")
+    parser.add_argument("--id_col", default=None, help="default: patient_id or subject_id")
+    parser.add_argument("--split_col", default="split")
+    parser.add_argument("--chunksize", default=10**6, type=int)
+    args = parser.parse_args()
+    if args.out and len(args.input) > 1:
+        parser.error("--out needs a single input")
+
+    start = perf_counter()
+    if args.check:
+        # a split column in every file is checked within and across files, otherwise the files are the splits
+        has_split = all(args.split_col in pd.read_csv(path, nrows=0).columns for path in args.input)
+        leaked = leaked_patients_files(args.input, args.id_col, args.split_col if has_split else None, args.chunksize)
+        print(f"{len(leaked)} patients in more than one split ({perf_counter() - start:.2f}s)")
+        if len(leaked):
+            print(leaked.value_counts())
+            raise SystemExit(1)
+    else:
+        for path in args.input:
+            out = args.out or path.replace(".csv", ".hashsplit.csv")
+            counts = assign_file(path, out, args.id_col, args.split_col, args.chunksize)
+            print(f"{path} -> {out} ({perf_counter() - start:.2f}s)")
+            print(counts)
@@ -0,0 +1,162 @@
+import os
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from subgroups import age_bin, age_bins
+
+group_col = "race_label"
+label_col = "disease_label"
+age_col = "age_bin"
+sample_size_factor = 3
+output_suffix = "resample"
+
+
+def resample_age_bin(age):
+    """
+    age_bin with missing ages in the last bin, as the bin_age of the original notebook, so that those rows are
+    still drawn
+    """
+    codes = age_bin(age)
+    return np.where(np.isnan(codes), len(age_bins) - 2, codes).astype(np.int64)
+
+
+def weighted_choice_within(codes: np.ndarray, weights: np.ndarray, sizes: np.ndarray, rng: np.random.Generator):
+    """
+    For every group g = 0..len(sizes)-1, draw sizes[g] rows with replacement among the rows with codes == g,
+    with probability proportional to weights (as WeightedRandomSampler per group). All groups are drawn at once:
+    the cumulative weights are normalized to [g, g + 1) per group and searched with uniform draws u + g.
+    Returns row positions, ordered by group.
+    """
+    codes, weights = np.asarray(codes), np.asarray(weights, dtype=np.float64)
+    order = np.argsort(codes, kind="stable")
+    sorted_codes, sorted_weights = codes[order], weights[order]
+    totals = np.bincount(sorted_codes, weights=sorted_weights, minlength=len(sizes))
+    group_start = np.concatenate([[0.0], np.cumsum(totals)[:-1]])
+    cumulative = np.cumsum(sorted_weights) - group_start[sorted_codes]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cumulative = cumulative / totals[sorted_codes] + sorted_codes
+    # make every group end exactly at g + 1, so that rounding never selects a row of the next group
+    is_end = np.ones(len(codes), dtype=bool)
+    is_end[:-1] = sorted_codes[:-1] != sorted_codes[1:]
+    cumulative[is_end] = sorted_codes[is_end] + 1
+
+    draw_groups = np.repeat(np.arange(len(sizes)), sizes)
+    positions = np.searchsorted(cumulative, rng.random(len(draw_groups)) + draw_groups, side="right")
+    return order[positions]
+
+
+def _ratio_weights(frame: pd.DataFrame, within: list, target: pd.Series, column: str):
+    """
+    Per-row weight target share / observed share of the row's value of column, where the observed share is taken
+    within the row's `within` group and target is indexed by column or by (conditioning columns, column)
+    """
+    observed = frame.groupby(within, sort=False)[column].value_counts(normalize=True)
+    observed = observed.reindex(pd.MultiIndex.from_frame(frame[within + [column]])).values
+    target_index = target.index.names
+    if len(target_index) > 1:
+        wanted = target.reindex(pd.MultiIndex.from_frame(frame[target_index])).values
+    else:
+        wanted = target.reindex(frame[column]).values
+    return wanted / observed
+
+
+def resample_indices(
+    df: pd.DataFrame,
+    sample_size_factor: int = sample_size_factor,
+    seed: int = 42,
+    group_col: str = group_col,
+    label_col: str = label_col,
+    age_col: str = age_col,
+):
+    """
+    Row positions of df for the resampled test set of chexpert.resample.ipynb:
+    1. draw sample_size_factor * len(df) rows with equal proportions of group_col (race),
+    2. within each group, redraw the group's rows so that label_col (disease) has the overall prevalence of df,
+    3. within each (group, label), redraw its rows so that age_col has the overall age distribution of that label.
+    The result is ordered by group (in order of appearance) and label (in order of appearance in df).
+    """
+    rng = np.random.default_rng(seed)
+    data = df[[group_col, label_col, age_col]].reset_index(drop=True)
+
+    # 1. equal proportion per group
+    n_samples = len(data) * sample_size_factor
+    group_share = data[group_col].map(data[group_col].value_counts(normalize=True)).values
+    ids = weighted_choice_within(np.zeros(len(data), dtype=np.int64), 1 / group_share, [n_samples], rng)
+
+    # 2. overall label prevalence within each group
+    frame = data.iloc[ids].reset_index(drop=True)
+    group_codes, _ = pd.factorize(frame[group_col])
+    overall_label = data[label_col].value_counts(normalize=True)
+    weights = _ratio_weights(frame, [group_col], overall_label, label_col)
+    ids = ids[weighted_choice_within(group_codes, weights, np.bincount(group_codes), rng)]
+
+    # 3. overall age distribution of each label within each (group, label)
+    frame = data.iloc[ids].reset_index(drop=True)
+    group_codes, _ = pd.factorize(frame[group_col])
+    label_codes = pd.Categorical(frame[label_col], categories=data[label_col].unique()).codes
+    codes = group_codes * (label_codes.max() + 1) + label_codes
+    overall_age = data.groupby(label_col, sort=False)[age_col].value_counts(normalize=True)
+    weights = _ratio_weights(frame, [group_col, label_col], overall_age, age_col)
+    ids = ids[weighted_choice_within(codes, weights, np.bincount(codes), rng)]
+
+    return ids
+
+
+def summary(
+    df: pd.DataFrame,
+    ids: np.ndarray,
+    group_col: str = group_col,
+    label_col: str = label_col,
+    age_col: str = age_col,
+):
+    """
+    Group sizes, label prevalence per group and age distribution per (group, label) of the resampled set
+    """
+    resampled = df.iloc[ids]
+    return (
+        resampled.groupby(group_col).size(),
+        resampled.groupby([group_col, label_col]).size().unstack(),
+        resampled.groupby([group_col, label_col])[age_col].value_counts(normalize=True).unstack(),
+    )
+
+
+def load_resampled(sample_csv: str, ids_path: str = ""):
+    """
+    Rows of the resampled set: the sample csv at the row ids saved by resample_indices (default path: the csv with
+    'resample' and .idx.npy, as written by chexpert.resample.ipynb and this script)
+    """
+    df = pd.read_csv(sample_csv).drop(columns="Unnamed: 0", errors="ignore")
+    ids = np.load(ids_path or sample_csv.replace("sample", output_suffix).replace(".csv", ".idx.npy"))
+    return df.iloc[ids].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Resampled test set (equal race proportions, prevalence and age) as row ids")
+    parser.add_argument("--input", default="../datafiles/chexpert/chexpert.sample_128.test.csv")
+    parser.add_argument("--out", default="", help="npy file for the row ids (default: input with 'resample')")
+    parser.add_argument("--factor", default=sample_size_factor, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument(
+        "--materialize", action="store_true", help="also write the resampled rows as csv, as the notebook did"
+    )
+    args = parser.parse_args()
+
+    start = perf_counter()
+    df = pd.read_csv(args.input)
+    df = df.drop(columns="Unnamed: 0", errors="ignore")
+    if age_col not in df:
+        df[age_col] = resample_age_bin(df["age"])
+    ids = resample_indices(df, args.factor, args.seed)
+
+    out = args.out or args.input.replace("sample", output_suffix).replace(".csv", ".idx.npy")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    np.save(out, ids)
+    if args.materialize:
+        df.iloc[ids].to_csv(args.input.replace("sample", output_suffix))
+    print(f"Resampled {len(df)} -> {len(ids)} rows in {perf_counter() - start:.2f}s, row ids saved to {out}")
+
+    sizes, prevalence, age = summary(df, ids)
+    print(sizes, prevalence, age.round(3), sep="\n\n")
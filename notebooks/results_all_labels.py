@@ -0,0 +1,320 @@
+import os
+from argparse import ArgumentParser
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+
+from bootstrap_metrics import (
+    full_experiment_block,
+    load_indices,
+    paired_differences,
+    run_bootstrap,
+    save_indices,
+    shared_indices,
+)
+from delong import paired_auc_difference, subgroup_auc_ci, subgroup_auc_difference
+from results_disease_detection import asian, black, female, labels, male, target_fpr, white
+from subgroups import age_bin, encode_groups
+
+# values kept per attribute (others, e.g. race "Other", are in no group); attributes without levels keep all values
+group_levels = {"race": [white, asian, black], "sex": [female, male]}
+
+
+def ci_from_bootstrap(estimates: np.ndarray, level: float = 0.95):
+    """
+    Sample estimate (row 0) and the percentile CI over the bootstrap replicates (rows 1..); replicates without
+    a defined value (e.g. no positives of a subgroup in an unstratified resample) are left out
+    """
+    alpha = (1 - level) / 2
+    return (
+        estimates[0],
+        np.nanquantile(estimates[1:], alpha),
+        np.nanquantile(estimates[1:], 1 - alpha),
+    )
+
+
+def get_partitions(data: pd.DataFrame, specs: list):
+    """
+    Group partitions for specs like ["race", "sex", "race,sex,age_bin"]; age_bin is derived from age
+    """
+    specs = [spec.split(",") for spec in specs]
+    if any("age_bin" in spec for spec in specs) and "age_bin" not in data:
+        data = data.assign(age_bin=age_bin(data.age))
+    return encode_groups(data, specs, group_levels)
+
+
+def get_masks(partitions: list):
+    return {
+        name: partition.codes == g for partition in partitions for g, name in enumerate(partition.names)
+    }
+
+
+def delong_rows(targets, predictions, partitions, level=0.95):
+    """
+    DeLong AUC CIs per subgroup and AUC differences between the (disjoint) groups of each partition
+    """
+    rows = []
+    masks = get_masks(partitions)
+    for group, (auc, low, high) in subgroup_auc_ci(targets, predictions, masks, level).items():
+        rows.append(
+            {"group": group, "metric": "AUC (DeLong)", "estimate": auc, "ci_low": low, "ci_high": high}
+        )
+    for partition in partitions:
+        for a, b in combinations(partition.names, 2):
+            diff, low, high, p = subgroup_auc_difference(targets, predictions, masks[a], masks[b], level)
+            rows.append(
+                {
+                    "group": f"{a} - {b}",
+                    "metric": "AUC difference (DeLong)",
+                    "estimate": diff,
+                    "ci_low": low,
+                    "ci_high": high,
+                    "p_value": p,
+                }
+            )
+    return rows
+
+
+def evaluate_model(
+    predictions: pd.DataFrame,
+    partitions: list,
+    n_bootstrap: int = 2000,
+    level: float = 0.95,
+    seed: int = 42,
+    n_jobs: int = 1,
+    cache_dir: str = None,
+    ci_method: str = "bootstrap",
+    indices: np.ndarray = None,
+    replicates: dict = None,
+):
+    """
+    AUC/TPR/FPR/Youden for every label and subgroup of one prediction file, as tidy rows.
+    ci_method: bootstrap (all metrics), delong (analytic AUC CIs and subgroup differences only) or both.
+    indices: shared index matrix used for all labels instead of per-label stratified draws.
+    replicates: if given, filled with the bootstrap replicates per label id (for paired differences).
+    """
+    rows = []
+    for label_id, label in enumerate(labels):
+        targets = predictions["target_" + str(label_id)].values
+        if targets.min() == targets.max():
+            print(f"Skipping {label}: only one class in the targets")
+            continue
+        info = {"label_id": label_id, "label": label}
+        if ci_method in ["delong", "both"]:
+            preds = predictions["class_" + str(label_id)].values
+            rows += [{**info, **r} for r in delong_rows(targets, preds, partitions, level)]
+        if ci_method not in ["bootstrap", "both"]:
+            continue
+        metrics = run_bootstrap(
+            full_experiment_block,
+            targets,
+            n_bootstrap,
+            seed=seed,
+            n_jobs=n_jobs,
+            cache_dir=cache_dir,
+            indices=indices,
+            targets=targets,
+            predictions=predictions["class_" + str(label_id)].values,
+            partitions=partitions,
+            target_fpr=target_fpr,
+        )
+        if replicates is not None:
+            replicates[label_id] = metrics
+        for (metric, group), estimates in metrics.items():
+            estimate, low, high = ci_from_bootstrap(estimates, level)
+            rows.append(
+                {
+                    **info,
+                    "group": group,
+                    "metric": metric,
+                    "estimate": estimate,
+                    "ci_low": low,
+                    "ci_high": high,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def compare_models(predictions: dict, partitions: list, level: float = 0.95):
+    """
+    Paired DeLong AUC differences of every model to the first one, per label and subgroup, as tidy rows
+    """
+    n_samples = len(next(iter(predictions.values())))
+    groups = {"all": np.ones(n_samples, dtype=bool), **get_masks(partitions)}
+    (reference, ref_pred), *others = predictions.items()
+    rows = []
+    for name, pred in others:
+        for label_id, label in enumerate(labels):
+            targets = ref_pred["target_" + str(label_id)].values
+            if not np.array_equal(targets, pred["target_" + str(label_id)].values):
+                raise ValueError(f"{name} and {reference} have different targets for {label}")
+            for group, mask in groups.items():
+                diff, low, high, p = paired_auc_difference(
+                    targets[mask],
+                    pred["class_" + str(label_id)].values[mask],
+                    ref_pred["class_" + str(label_id)].values[mask],
+                    level,
+                )
+                rows.append(
+                    {
+                        "model": f"{name} - {reference}",
+                        "label_id": label_id,
+                        "label": label,
+                        "group": group,
+                        "metric": "AUC difference (DeLong)",
+                        "estimate": diff,
+                        "ci_low": low,
+                        "ci_high": high,
+                        "p_value": p,
+                    }
+                )
+    return pd.DataFrame(rows)
+
+
+def bootstrap_differences(replicates: dict, level: float = 0.95):
+    """
+    Paired bootstrap differences of every model to the first one, per label, group and metric, as tidy rows.
+    replicates: model -> label id -> run_bootstrap result, all computed on the same shared index matrix.
+    """
+    (reference, ref_reps), *others = replicates.items()
+    rows = []
+    for name, reps in others:
+        for label_id in ref_reps:
+            if label_id not in reps:
+                continue
+            for (metric, group), estimates in paired_differences(reps[label_id], ref_reps[label_id]).items():
+                estimate, low, high = ci_from_bootstrap(estimates, level)
+                rows.append(
+                    {
+                        "model": f"{name} - {reference}",
+                        "label_id": label_id,
+                        "label": labels[label_id],
+                        "group": group,
+                        "metric": f"{metric} difference (bootstrap)",
+                        "estimate": estimate,
+                        "ci_low": low,
+                        "ci_high": high,
+                    }
+                )
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Bootstrap CIs for all CheXpert labels, subgroups and metrics of several models"
+    )
+    parser.add_argument(
+        "--model_dirs",
+        nargs="+",
+        default=["../prediction/chexpert/disease/densenet-all"],
+        help="directories containing predictions.test.csv",
+    )
+    parser.add_argument("--data", default="../datafiles/chexpert/chexpert.sample.test.csv")
+    parser.add_argument("--out", default="results_all_labels.csv")
+    parser.add_argument("--n_bootstrap", default=2000, type=int)
+    parser.add_argument("--level", default=0.95, type=float)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--n_jobs", default=1, type=int)
+    parser.add_argument(
+        "--cache_dir",
+        default=".cache/bootstrap",
+        help="replicate arrays are reused from here on unchanged inputs; empty string disables",
+    )
+    parser.add_argument(
+        "--ci_method",
+        default="bootstrap",
+        choices=["bootstrap", "delong", "both"],
+        help="delong gives analytic AUC CIs only; both reports them next to the bootstrap as a cross-check",
+    )
+    parser.add_argument(
+        "--shared_indices",
+        default="",
+        help="npy file with one replicate x sample index matrix for all labels and models (created if missing); "
+        "enables paired bootstrap differences between models",
+    )
+    parser.add_argument(
+        "--stratify",
+        default="",
+        help="metadata column the shared index matrix is stratified by (default: unstratified)",
+    )
+    parser.add_argument(
+        "--groups",
+        nargs="+",
+        default=["race", "sex"],
+        help="subgroup attributes; comma-separated attributes are intersected, e.g. race,sex,age_bin",
+    )
+    args = parser.parse_args()
+
+    data_characteristics = pd.read_csv(args.data)
+    partitions = get_partitions(data_characteristics, args.groups)
+
+    indices = None
+    if args.shared_indices:
+        n_samples = len(data_characteristics)
+        if os.path.exists(args.shared_indices):
+            indices = load_indices(args.shared_indices)
+            if indices.shape != (args.n_bootstrap + 1, n_samples):
+                raise ValueError(
+                    f"{args.shared_indices} has shape {indices.shape}, expected {(args.n_bootstrap + 1, n_samples)}"
+                )
+        else:
+            strata = data_characteristics[args.stratify].astype(str).values if args.stratify else None
+            indices = shared_indices(n_samples, args.n_bootstrap, args.seed, strata)
+            save_indices(args.shared_indices, indices)
+            indices = load_indices(args.shared_indices)
+
+    results = []
+    predictions = {}
+    replicates = {}
+    for model_dir in args.model_dirs:
+        print(f"\nEvaluating {model_dir}")
+        cnn_pred = pd.read_csv(model_dir.rstrip("/") + "/predictions.test.csv")
+        if len(cnn_pred) != len(data_characteristics):
+            raise ValueError(
+                f"{model_dir}: {len(cnn_pred)} predictions but {len(data_characteristics)} rows in {args.data}"
+            )
+        name = model_dir.rstrip("/").split("/")[-1]
+        res = evaluate_model(
+            cnn_pred,
+            partitions,
+            n_bootstrap=args.n_bootstrap,
+            level=args.level,
+            seed=args.seed,
+            n_jobs=args.n_jobs,
+            cache_dir=args.cache_dir or None,
+            ci_method=args.ci_method,
+            indices=indices,
+            replicates=replicates.setdefault(name, {}),
+        )
+        res.insert(0, "model", name)
+        results.append(res)
+        predictions[name] = cnn_pred
+
+    if args.ci_method != "bootstrap" and len(predictions) > 1:
+        results.append(compare_models(predictions, partitions, args.level))
+    if indices is not None and len(replicates) > 1:
+        results.append(bootstrap_differences(replicates, args.level))
+
+    results = pd.concat(results, ignore_index=True)
+    results["n_bootstrap"] = args.n_bootstrap
+    results["level"] = args.level
+    results.to_csv(args.out, index=False)
+    print(f"\nSaved {len(results)} rows to {args.out}")
+
+    auc_metric = "AUC" if args.ci_method != "delong" else "AUC (DeLong)"
+    auc_table = results[results.metric == auc_metric].pivot_table(
+        index=["model", "label"], columns="group", values="estimate", sort=False
+    )[[name for partition in partitions for name in partition.names] + ["all"]]
+    print(tabulate(auc_table, headers=auc_table.columns, floatfmt=".2f"))
+
+    if args.ci_method == "both":
+        # cross-check: width of the bootstrap and DeLong AUC intervals on the same predictions
+        width = results.assign(width=results.ci_high - results.ci_low)
+        width = width[width.metric.isin(["AUC", "AUC (DeLong)"])].pivot_table(
+            index=["model", "label", "group"], columns="metric", values="width", sort=False
+        )
+        width["ratio"] = width["AUC (DeLong)"] / width["AUC"]
+        print("\nAUC CI width, bootstrap vs DeLong")
+        print(tabulate(width.groupby("group", sort=False).mean(), headers=width.columns, floatfmt=".3f"))
@@ -0,0 +1,101 @@
+import hashlib
+import inspect
+import json
+import os
+import sys
+
+import numpy as np
+
+# bump when the format of the cached entries changes; code changes are covered by the key (see _code_files)
+cache_version = 1
+code_dir = os.path.dirname(os.path.abspath(__file__))  # the analysis modules whose source is part of the keys
+
+
+def _code_files(namespace, files):
+    """
+    Source files of the modules in code_dir that a module namespace (or a function's globals) uses, recursively:
+    imported modules and the modules defining imported functions and classes
+    """
+    for value in list(namespace.values()):
+        name = value.__name__ if inspect.ismodule(value) else getattr(value, "__module__", None)
+        module = sys.modules.get(name) if isinstance(name, str) else None
+        path = getattr(module, "__file__", None)
+        if path and path not in files and os.path.dirname(os.path.abspath(path)) == code_dir:
+            files.add(path)
+            _code_files(vars(module), files)
+    return files
+
+
+def _update(h, value):
+    if hasattr(value, "__array__"):
+        value = np.ascontiguousarray(value)
+        if value.dtype == object:
+            value = value.astype(str)
+        h.update(f"array{value.dtype.str}{value.shape}".encode())
+        h.update(value.tobytes())
+    elif isinstance(value, dict):
+        h.update(f"dict{len(value)}".encode())
+        for k in sorted(value, key=str):
+            _update(h, k)
+            _update(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(f"{type(value).__name__}{len(value)}".encode())
+        for v in value:
+            _update(h, v)
+    elif callable(value):
+        h.update(f"callable{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', '')}".encode())
+        try:
+            h.update(inspect.getsource(value).encode())
+        except (OSError, TypeError):  # no source file, e.g. defined interactively: the bytecode, or only the name
+            code = getattr(value, "__code__", None)
+            if code is not None:
+                h.update(code.co_code + repr(code.co_consts).encode())
+        # the functions it calls: the source of the analysis modules it uses (bootstrap_metrics.py, subgroups.py, ...)
+        for path in sorted(_code_files(getattr(value, "__globals__", {}), set())):
+            with open(path, "rb") as f:
+                h.update(os.path.basename(path).encode() + f.read())
+    else:
+        h.update(f"{type(value).__name__}:{value!r}".encode())
+
+
+def content_hash(*parts):
+    """
+    SHA-256 over the contents of arrays (dtype, shape, bytes), containers, functions (name and source,
+    and the source of the analysis modules they use) and scalars
+    """
+    h = hashlib.sha256()
+    _update(h, (cache_version,) + parts)
+    return h.hexdigest()
+
+
+def save_replicates(path, replicates: dict):
+    """
+    Store {key: array} with tuple or string keys as .npz; written to a temporary file first so that
+    interrupted or concurrent runs never leave a partial entry
+    """
+    keys = list(replicates)
+    arrays = {f"r{i}": np.asarray(replicates[k]) for i, k in enumerate(keys)}
+    tmp = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp, keys=json.dumps([list(k) if isinstance(k, tuple) else k for k in keys]), **arrays)
+    os.replace(tmp, path)
+
+
+def load_replicates(path):
+    with np.load(path, allow_pickle=False) as f:
+        keys = json.loads(str(f["keys"]))
+        return {tuple(k) if isinstance(k, list) else k: f[f"r{i}"] for i, k in enumerate(keys)}
+
+
+def cached(cache_dir, key, compute):
+    """
+    compute() -> {key: array}, stored under cache_dir/<key>.npz and loaded from there on later calls
+    """
+    if cache_dir is None:
+        return compute()
+    path = os.path.join(cache_dir, key + ".npz")
+    if os.path.exists(path):
+        return load_replicates(path)
+    result = compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    save_replicates(path, result)
+    return result
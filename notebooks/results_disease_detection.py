@@ -1,11 +1,10 @@
-from collections import defaultdict
-
 import numpy as np
 import pandas as pd
-from sklearn.metrics import auc, recall_score, roc_auc_score, roc_curve
-from sklearn.utils import resample
 from tabulate import tabulate
-from tqdm import tqdm
+
+from bootstrap_metrics import full_experiment_block, run_bootstrap
+from delong import subgroup_auc_ci
+from subgroups import encode_groups
 
 target_fpr = 0.2
 
@@ -41,65 +40,39 @@ def get_boostrap_ci_for_full_experiment(
     sex: np.ndarray,
     n_bootstrap: int = 2000,
     level: float = 0.95,
+    seed: int = None,
+    n_jobs: int = 1,
+    cache_dir: str = None,
 ):
     """
     Get all CIs for FPR/TPR/Youden/AUC per subgroup for a global threshold with target fpr of 0.2
+    With a seed, replicates use per-block SeedSequence streams and can run on n_jobs processes
     """
-    n_samples = targets.shape[0]
-
-    all_fpr, all_tpr, all_roc_auc, all_youden = (
-        defaultdict(list),
-        defaultdict(list),
-        defaultdict(list),
-        defaultdict(list),
+    # Replicates are evaluated block-wise with array operations, groups as integer codes
+    partitions = encode_groups(
+        {"race": race, "sex": sex},
+        ["race", "sex"],
+        levels={"race": [white, asian, black], "sex": [male, female]},
+    )
+    metrics = run_bootstrap(
+        full_experiment_block,
+        targets,
+        n_bootstrap,
+        seed=seed,
+        n_jobs=n_jobs,
+        cache_dir=cache_dir,
+        targets=np.asarray(targets),
+        predictions=np.asarray(predictions),
+        partitions=partitions,
+        target_fpr=target_fpr,
+    )
+    groups = ["all"] + [name for partition in partitions for name in partition.names]
+    all_roc_auc, all_tpr, all_fpr, all_youden = (
+        {g: metrics[("AUC", g)] for g in groups},
+        {g: metrics[("TPR", g)] for g in groups},
+        {g: metrics[("FPR", g)] for g in groups},
+        {g: metrics[("Youden", g)] for g in groups},
     )
-
-    for b in tqdm(range(n_bootstrap + 1)):
-
-        # GET BOOTSTRAP SAMPLE
-        # At the first iteration, store the sample estimate without resampling.
-        idx = (
-            resample(np.arange(n_samples), stratify=targets)
-            if b > 0
-            else np.arange(n_samples)
-        )
-
-        sample_target, sample_pred = targets[idx], predictions[idx]
-        sample_race, sample_sex = race[idx], sex[idx]
-
-        fpr, tpr, thres = roc_curve(sample_target, sample_pred)
-        all_roc_auc["all"].append(auc(fpr, tpr))
-
-        # Computing global threshold
-        idx_target_fpr_threshold = np.argmin(np.abs(fpr - target_fpr))
-        op = thres[idx_target_fpr_threshold]
-        all_fpr["all"].append(fpr[idx_target_fpr_threshold])
-        all_tpr["all"].append(tpr[idx_target_fpr_threshold])
-        all_youden["all"].append(
-            (tpr[idx_target_fpr_threshold] - fpr[idx_target_fpr_threshold])
-        )
-
-        # Getting race subbroups results
-        for r in [white, asian, black]:
-            targets_r, preds_r = (
-                sample_target[sample_race == r],
-                sample_pred[sample_race == r],
-            )
-            all_roc_auc[r].append(roc_auc_score(targets_r, preds_r))
-            all_fpr[r].append(1 - recall_score(targets_r, preds_r >= op, pos_label=0))
-            all_tpr[r].append(recall_score(targets_r, preds_r >= op, pos_label=1))
-            all_youden[r].append(all_tpr[r][-1] - all_fpr[r][-1])
-
-        # Getting sex subgroup results
-        for s in [male, female]:
-            targets_s, preds_s = (
-                sample_target[sample_sex == s],
-                sample_pred[sample_sex == s],
-            )
-            all_roc_auc[s].append(roc_auc_score(targets_s, preds_s))
-            all_fpr[s].append(1 - recall_score(targets_s, preds_s >= op, pos_label=0))
-            all_tpr[s].append(recall_score(targets_s, preds_s >= op, pos_label=1))
-            all_youden[s].append(all_tpr[s][-1] - all_fpr[s][-1])
 
     def _get_pretty_string_from_bootstrap_estimates(boostrap_estimates: np.ndarray):
         alpha = (1 - level) / 2
@@ -141,6 +114,26 @@ def get_boostrap_ci_for_full_experiment(
     }
 
 
+def get_delong_ci_for_auc(
+    targets: np.ndarray,
+    predictions: np.ndarray,
+    race: np.ndarray,
+    sex: np.ndarray,
+    level: float = 0.95,
+):
+    """
+    Analytic DeLong CIs for the AUC per subgroup, in the same format as get_boostrap_ci_for_full_experiment
+    """
+    groups = {r: np.asarray(race) == r for r in [white, asian, black]}
+    groups.update({s: np.asarray(sex) == s for s in [male, female]})
+    aucs = subgroup_auc_ci(targets, predictions, groups, level)
+    return {
+        "AUC (DeLong)": {
+            g: f"{auc: .2f} ({low:.2f}-{high:.2f})" for g, (auc, low, high) in aucs.items()
+        }
+    }
+
+
 if __name__ == "__main__":
 
     # PATH TO PREDICTION AND DATA CHARACTERISTICS FILE
@@ -152,6 +145,10 @@ if __name__ == "__main__":
     # PARAMETERS FOR CI
     n_bootstrap = 2000
     ci_level = 0.95
+    seed = 42  # int: per-block SeedSequence streams, reproducible and cached; None: legacy unseeded draws, never cached
+    n_jobs = 1  # number of processes, results are identical for any value when a seed is set
+    cache_dir = ".cache/bootstrap"  # replicate arrays of seeded runs are reused from here, None disables
+    ci_method = "bootstrap"  # bootstrap, delong (AUC only, analytic), both (bootstrap and DeLong AUC side by side)
 
     # GET RESULTS
     for label in [0, 10]:
@@ -160,13 +157,27 @@ if __name__ == "__main__":
         race = data_characteristics.race.values
         sex = data_characteristics.sex.values
 
-        results = get_boostrap_ci_for_full_experiment(
-            targets=targets,
-            predictions=preds,
-            race=race,
-            sex=sex,
-            n_bootstrap=n_bootstrap,
-        )
+        results = {}
+        if ci_method in ["bootstrap", "both"]:
+            results.update(
+                get_boostrap_ci_for_full_experiment(
+                    targets=targets,
+                    predictions=preds,
+                    race=race,
+                    sex=sex,
+                    n_bootstrap=n_bootstrap,
+                    level=ci_level,
+                    seed=seed,
+                    n_jobs=n_jobs,
+                    cache_dir=cache_dir,
+                )
+            )
+        if ci_method in ["delong", "both"]:
+            results.update(
+                get_delong_ci_for_auc(
+                    targets=targets, predictions=preds, race=race, sex=sex, level=ci_level
+                )
+            )
 
         columns_as_in_manuscript = [white, asian, black, female, male, "all"]
         res_df = pd.DataFrame.from_dict(results, orient="index")[
@@ -1,59 +1,62 @@
-from collections import defaultdict
-
 import numpy as np
 import pandas as pd
-from sklearn.metrics import auc, roc_curve
-from sklearn.utils import resample
 from tabulate import tabulate
-from tqdm import tqdm
+
+from bootstrap_metrics import SortedReplicates, run_bootstrap
+from delong import subgroup_auc_ci
+from subgroups import Partition, group_roc_metrics
 
 white = "White"
 asian = "Asian"
 black = "Black"
 
 
+def split_race_block(idx: np.ndarray, targets_race: np.ndarray, predictions: np.ndarray):
+    """
+    One-vs-rest AUC and the Youden-optimal FPR/TPR per race for every replicate (row) in idx
+    """
+    everyone = Partition(np.zeros(len(targets_race), dtype=np.int64), ["all"])
+    results = {}
+    for race, pos_label in zip([white, asian, black], [0, 1, 2]):
+        y = (targets_race == pos_label).astype(np.int64)
+        stats = group_roc_metrics(SortedReplicates(y, predictions[:, pos_label], idx), everyone)
+        results[("AUC", race)] = stats["AUC"][:, 0]
+        results[("FPR", race)] = stats["FPR_opt"][:, 0]
+        results[("TPR", race)] = stats["TPR_opt"][:, 0]
+        results[("Youden", race)] = stats["Youden_opt"][:, 0]
+    return results
+
+
 def get_boostrap_ci_for_split_race_experiment(
     targets_race: np.ndarray,
     predictions: np.ndarray,
     n_bootstrap: int = 2000,
     level: float = 0.95,
+    seed: int = None,
+    n_jobs: int = 1,
+    cache_dir: str = None,
 ):
     """
     Get all CIs for FPR/TPR/Youden/AUC per subgroup for SPLIT - race experiment
+    With a seed, replicates use per-block SeedSequence streams and can run on n_jobs processes
     """
-    n_samples = targets_race.shape[0]
-
+    metrics = run_bootstrap(
+        split_race_block,
+        targets_race,
+        n_bootstrap,
+        seed=seed,
+        n_jobs=n_jobs,
+        cache_dir=cache_dir,
+        targets_race=np.asarray(targets_race),
+        predictions=np.asarray(predictions),
+    )
     all_fpr, all_tpr, all_roc_auc, all_youden = (
-        defaultdict(list),
-        defaultdict(list),
-        defaultdict(list),
-        defaultdict(list),
+        {r: metrics[("FPR", r)] for r in [white, asian, black]},
+        {r: metrics[("TPR", r)] for r in [white, asian, black]},
+        {r: metrics[("AUC", r)] for r in [white, asian, black]},
+        {r: metrics[("Youden", r)] for r in [white, asian, black]},
     )
 
-    for b in tqdm(range(n_bootstrap + 1)):
-
-        # GET BOOTSTRAP SAMPLE
-        # At the first iteration, store the sample estimate without resampling.
-        idx = (
-            resample(np.arange(n_samples), stratify=targets_race)
-            if b > 0
-            else np.arange(n_samples)
-        )
-
-        sample_race, sample_pred = targets_race[idx], predictions[idx]
-
-        for race, pos_label in zip([white, asian, black], [0, 1, 2]):
-            y = np.array(sample_race)
-            y[sample_race != pos_label] = 0
-            y[sample_race == pos_label] = 1
-            fpr, tpr, _ = roc_curve(y, sample_pred[:, pos_label])
-            all_roc_auc[race].append(auc(fpr, tpr))
-            youden = tpr - fpr
-            opt_youden_idx = np.argmax(youden)
-            all_fpr[race].append(fpr[opt_youden_idx])
-            all_tpr[race].append(tpr[opt_youden_idx])
-            all_youden[race].append(youden[opt_youden_idx])
-
     def _get_pretty_string_from_bootstrap_estimates(boostrap_estimates: np.ndarray):
         alpha = (1 - level) / 2
         return f"{boostrap_estimates[0]: .2f} ({np.quantile(boostrap_estimates[1:], alpha):.2f}-{np.quantile(boostrap_estimates[1:], 1 - alpha):.2f})"
@@ -82,6 +85,22 @@ def get_boostrap_ci_for_split_race_experiment(
     }
 
 
+def get_delong_ci_for_auc(targets_race: np.ndarray, predictions: np.ndarray, level: float = 0.95):
+    """
+    Analytic DeLong CIs for the one-vs-rest AUC per race, in the same format as
+    get_boostrap_ci_for_split_race_experiment
+    """
+    results = {}
+    for race, pos_label in zip([white, asian, black], [0, 1, 2]):
+        y = (np.asarray(targets_race) == pos_label).astype(np.int64)
+        results[race] = subgroup_auc_ci(y, np.asarray(predictions)[:, pos_label], {}, level)["all"]
+    return {
+        "AUC (DeLong)": {
+            race: f"{auc: .2f} ({low:.2f}-{high:.2f})" for race, (auc, low, high) in results.items()
+        }
+    }
+
+
 if __name__ == "__main__":
 
     # PATH TO PREDICTION AND DATA CHARACTERISTICS FILE
@@ -93,6 +112,10 @@ if __name__ == "__main__":
     # PARAMETERS FOR CI
     n_bootstrap = 2000
     ci_level = 0.95
+    seed = 42  # int: per-block SeedSequence streams, reproducible and cached; None: legacy unseeded draws, never cached
+    n_jobs = 1  # number of processes, results are identical for any value when a seed is set
+    cache_dir = ".cache/bootstrap"  # replicate arrays of seeded runs are reused from here, None disables
+    ci_method = "bootstrap"  # bootstrap, delong (AUC only, analytic), both (bootstrap and DeLong AUC side by side)
 
     # GET RESULTS
     preds_race = np.stack(
@@ -100,9 +123,20 @@ if __name__ == "__main__":
     ).transpose()
     targets_race = np.array(cnn_pred_race["target"])
 
-    results = get_boostrap_ci_for_split_race_experiment(
-        targets_race=targets_race, predictions=preds_race, n_bootstrap=n_bootstrap,
-    )
+    results = {}
+    if ci_method in ["bootstrap", "both"]:
+        results.update(
+            get_boostrap_ci_for_split_race_experiment(
+                targets_race=targets_race,
+                predictions=preds_race,
+                n_bootstrap=n_bootstrap,
+                seed=seed,
+                n_jobs=n_jobs,
+                cache_dir=cache_dir,
+            )
+        )
+    if ci_method in ["delong", "both"]:
+        results.update(get_delong_ci_for_auc(targets_race=targets_race, predictions=preds_race, level=ci_level))
 
     columns_as_in_manuscript = [white, asian, black]
     res_df = pd.DataFrame.from_dict(results, orient="index")[columns_as_in_manuscript]
@@ -1,63 +1,63 @@
-from collections import defaultdict
-
 import numpy as np
 import pandas as pd
-from sklearn.metrics import auc, roc_curve
-from sklearn.utils import resample
 from tabulate import tabulate
-from tqdm import tqdm
+
+from bootstrap_metrics import SortedReplicates, run_bootstrap
+from delong import subgroup_auc_ci
+from subgroups import Partition, encode, group_roc_metrics
 
 white = "White"
 asian = "Asian"
 black = "Black"
 
 
+def split_sex_block(idx: np.ndarray, targets_sex: np.ndarray, predictions: np.ndarray, partition: Partition):
+    """
+    AUC and the Youden-optimal FPR/TPR of the sex prediction within each race for every replicate (row) in idx
+    """
+    block = SortedReplicates(targets_sex, predictions[:, 1], idx)
+    stats = group_roc_metrics(block, partition)
+    results = {}
+    for g, r in enumerate(partition.names):
+        results[("AUC", r)] = stats["AUC"][:, g]
+        results[("FPR", r)] = stats["FPR_opt"][:, g]
+        results[("TPR", r)] = stats["TPR_opt"][:, g]
+        results[("Youden", r)] = stats["Youden_opt"][:, g]
+    return results
+
+
 def get_boostrap_ci_for_split_sex_experiment(
     targets_sex: np.ndarray,
     predictions: np.ndarray,
     race: np.ndarray,
     n_bootstrap: int = 2000,
     level: float = 0.95,
+    seed: int = None,
+    n_jobs: int = 1,
+    cache_dir: str = None,
 ):
     """
     Get all CIs for FPR/TPR/Youden/AUC per subgroup for SPLIT - sex experiment
+    With a seed, replicates use per-block SeedSequence streams and can run on n_jobs processes
     """
-    n_samples = targets_sex.shape[0]
-
+    metrics = run_bootstrap(
+        split_sex_block,
+        targets_sex,
+        n_bootstrap,
+        seed=seed,
+        n_jobs=n_jobs,
+        cache_dir=cache_dir,
+        targets_sex=np.asarray(targets_sex),
+        predictions=np.asarray(predictions),
+        partition=encode({"race": race}, "race", levels={"race": [white, asian, black]}),
+    )
     all_fpr, all_tpr, all_roc_auc, all_youden = (
-        defaultdict(list),
-        defaultdict(list),
-        defaultdict(list),
-        defaultdict(list),
+        {r: metrics[("FPR", r)] for r in [white, asian, black]},
+        {r: metrics[("TPR", r)] for r in [white, asian, black]},
+        {r: metrics[("AUC", r)] for r in [white, asian, black]},
+        {r: metrics[("Youden", r)] for r in [white, asian, black]},
     )
 
-    for b in tqdm(range(n_bootstrap + 1)):
-
-        # GET BOOTSTRAP SAMPLE
-        # At the first iteration, store the sample estimate without resampling.
-        idx = (
-            resample(np.arange(n_samples), stratify=targets_sex)
-            if b > 0
-            else np.arange(n_samples)
-        )
-
-        sample_sex, sample_pred, sample_race = (
-            targets_sex[idx],
-            predictions[idx],
-            race[idx],
-        )
-
-        for r in [white, asian, black]:
-            fpr, tpr, _ = roc_curve(
-                sample_sex[sample_race == r], sample_pred[sample_race == r, 1]
-            )
-            all_roc_auc[r].append(auc(fpr, tpr))
-            youden = tpr - fpr
-            opt_youden_idx = np.argmax(youden)
-            all_fpr[r].append(fpr[opt_youden_idx])
-            all_tpr[r].append(tpr[opt_youden_idx])
-            all_youden[r].append(youden[opt_youden_idx])
-
     def _get_pretty_string_from_bootstrap_estimates(boostrap_estimates: np.ndarray):
         alpha = (1 - level) / 2
         return f"{boostrap_estimates[0]: .2f} ({np.quantile(boostrap_estimates[1:], alpha):.2f}-{np.quantile(boostrap_estimates[1:], 1 - alpha):.2f})"
@@ -86,6 +86,20 @@ def get_boostrap_ci_for_split_sex_experiment(
     }
 
 
+def get_delong_ci_for_auc(targets_sex: np.ndarray, predictions: np.ndarray, race: np.ndarray, level: float = 0.95):
+    """
+    Analytic DeLong CIs for the AUC of the sex prediction within each race, in the same format as
+    get_boostrap_ci_for_split_sex_experiment
+    """
+    groups = {r: np.asarray(race) == r for r in [white, asian, black]}
+    aucs = subgroup_auc_ci(targets_sex, np.asarray(predictions)[:, 1], groups, level)
+    return {
+        "AUC (DeLong)": {
+            g: f"{auc: .2f} ({low:.2f}-{high:.2f})" for g, (auc, low, high) in aucs.items()
+        }
+    }
+
+
 if __name__ == "__main__":
 
     # PATH TO PREDICTION AND DATA CHARACTERISTICS FILE
@@ -97,14 +111,31 @@ if __name__ == "__main__":
     # PARAMETERS FOR CI
     n_bootstrap = 2000
     ci_level = 0.95
+    seed = 42  # int: per-block SeedSequence streams, reproducible and cached; None: legacy unseeded draws, never cached
+    n_jobs = 1  # number of processes, results are identical for any value when a seed is set
+    cache_dir = ".cache/bootstrap"  # replicate arrays of seeded runs are reused from here, None disables
+    ci_method = "bootstrap"  # bootstrap, delong (AUC only, analytic), both (bootstrap and DeLong AUC side by side)
 
     # GET RESULTS
-    results = get_boostrap_ci_for_split_sex_experiment(
-        targets_sex=cnn_pred.target.values,
-        predictions=cnn_pred[["class_0", "class_1"]].values,
-        race=data_characteristics.race.values,
-        n_bootstrap=n_bootstrap,
-    )
+    targets_sex = cnn_pred.target.values
+    preds_sex = cnn_pred[["class_0", "class_1"]].values
+    race = data_characteristics.race.values
+
+    results = {}
+    if ci_method in ["bootstrap", "both"]:
+        results.update(
+            get_boostrap_ci_for_split_sex_experiment(
+                targets_sex=targets_sex,
+                predictions=preds_sex,
+                race=race,
+                n_bootstrap=n_bootstrap,
+                seed=seed,
+                n_jobs=n_jobs,
+                cache_dir=cache_dir,
+            )
+        )
+    if ci_method in ["delong", "both"]:
+        results.update(get_delong_ci_for_auc(targets_sex=targets_sex, predictions=preds_sex, race=race, level=ci_level))
 
     columns_as_in_manuscript = [white, asian, black]
     res_df = pd.DataFrame.from_dict(results, orient="index")[columns_as_in_manuscript]
@@ -0,0 +1,133 @@
+from collections import namedtuple
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+# same bins as bin_age in chexpert.resample.ipynb: <=20, 21-30, ..., 71-80, >80
+age_bins = [-np.inf, 20, 30, 40, 50, 60, 70, 80, np.inf]
+
+# codes: integer group per sample (-1: in no group), names: group name per code
+Partition = namedtuple("Partition", ["codes", "names"])
+
+
+def age_bin(age):
+    """
+    Age bin 0..7 as in chexpert.resample.ipynb
+    """
+    return pd.cut(np.asarray(age, dtype=float), bins=age_bins, labels=False)
+
+
+def encode(data, attributes, levels=None):
+    """
+    Partition of the rows of data (DataFrame or dict of arrays) into the combinations of values of the attributes,
+    e.g. ["race"] or ["race", "sex", "age_bin"] for intersectional groups. levels maps an attribute to the values
+    to keep, in order; rows with other values are in no group. Combinations that do not occur are dropped.
+    Group names are the values joined by ", " (a single attribute keeps its plain values).
+    """
+    if isinstance(attributes, str):
+        attributes = [attributes]
+    levels = levels or {}
+    codes = np.zeros(len(data[attributes[0]]), dtype=np.int64)
+    values = []
+    for attribute in attributes:
+        column = pd.Series(np.asarray(data[attribute]))
+        lv = levels.get(attribute)
+        if lv is None:
+            lv = sorted(column.dropna().unique())
+        attribute_codes = pd.Categorical(column, categories=lv).codes.astype(np.int64)
+        codes = np.where((codes < 0) | (attribute_codes < 0), -1, codes * len(lv) + attribute_codes)
+        values.append(lv)
+
+    names = [", ".join(str(v) for v in combination) for combination in product(*values)]
+    present = np.unique(codes[codes >= 0])
+    remap = np.full(len(names), -1, dtype=np.int64)
+    remap[present] = np.arange(len(present))
+    codes = np.where(codes >= 0, remap[np.maximum(codes, 0)], -1)
+    return Partition(codes, [names[c] for c in present])
+
+
+def encode_groups(data, specs, levels=None):
+    """
+    One Partition per spec, where a spec is an attribute name or a list of attribute names (an intersection)
+    """
+    return [encode(data, spec, levels) for spec in specs]
+
+
+def group_roc_metrics(block, partition: Partition, threshold=None):
+    """
+    Per-group statistics of a block of score-sorted replicates (bootstrap_metrics.SortedReplicates) for all groups
+    of a partition at once. Samples are stably re-sorted by group code, so that every (replicate, group) pair is
+    a contiguous segment that keeps the decreasing score order, and all statistics are segment reductions
+    (cumulative sums and bincount), independent of the number of groups.
+
+    Returns {statistic: array of shape (n_replicates, n_groups)} with
+    - AUC: Mann-Whitney AUC (ties count 1/2),
+    - FPR/TPR at threshold (per replicate, score >= threshold), if given,
+    - FPR_opt/TPR_opt/Youden_opt: the ROC point with maximal Youden's index as picked by argmax on roc_curve.
+    """
+    n_rep, n = block.scores.shape
+    n_groups = len(partition.names)
+    n_keys = n_rep * (n_groups + 1)
+
+    codes = np.asarray(partition.codes)[block.idx]
+    codes = np.where(codes < 0, n_groups, codes)  # samples in no group go to a last, discarded segment
+    order = np.argsort(codes, axis=1, kind="stable")
+    codes = np.take_along_axis(codes, order, axis=1)
+    scores = np.take_along_axis(block.scores, order, axis=1).ravel()
+    pos = (np.take_along_axis(block.targets, order, axis=1) == 1).ravel()
+    neg = ~pos
+    key = (np.arange(n_rep)[:, None] * (n_groups + 1) + codes).ravel()
+
+    # segments and their tie blocks; a threshold sits at the last position of every block of equal scores
+    is_end = np.ones(n_rep * n, dtype=bool)
+    is_end[:-1] = key[:-1] != key[1:]
+    is_start = np.roll(is_end, 1)
+    starts = np.flatnonzero(is_start)
+    seg = np.cumsum(is_start) - 1
+    is_threshold = is_end.copy()
+    is_threshold[:-1] |= scores[:-1] != scores[1:]
+    positions = np.arange(n_rep * n)
+    block_end = np.minimum.accumulate(np.where(is_threshold, positions, n_rep * n)[::-1])[::-1]
+    prev_threshold = np.concatenate([[-1], np.maximum.accumulate(np.where(is_threshold, positions, -1))[:-1]])
+
+    cum_pos, cum_neg = np.cumsum(pos), np.cumsum(neg)
+    padded_neg = np.concatenate([[0], cum_neg])
+    base_pos = (cum_pos - pos)[starts][seg]
+    base_neg = (cum_neg - neg)[starts][seg]
+    n_pos_seg = np.bincount(key, weights=pos, minlength=n_keys)
+    n_neg_seg = np.bincount(key, weights=neg, minlength=n_keys)
+
+    # negatives scored lower within the segment + half of the tied negatives, summed over positives
+    neg_upto_block_end = padded_neg[block_end + 1]
+    neg_before_block = padded_neg[prev_threshold + 1]  # at a segment start: the previous segment's last count
+    u = np.where(
+        pos,
+        (base_neg + n_neg_seg[key] - neg_upto_block_end) + 0.5 * (neg_upto_block_end - neg_before_block),
+        0.0,
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        results = {"AUC": np.bincount(key, weights=u, minlength=n_keys) / (n_pos_seg * n_neg_seg)}
+
+        if threshold is not None:
+            predicted = scores >= np.repeat(threshold, n)
+            tp = np.bincount(key, weights=pos & predicted, minlength=n_keys)
+            tn = np.bincount(key, weights=neg & ~predicted, minlength=n_keys)
+            results["FPR"] = 1 - np.where(n_neg_seg > 0, tn / n_neg_seg, 0.0)
+            results["TPR"] = np.where(n_pos_seg > 0, tp / n_pos_seg, 0.0)
+
+        # Youden-optimal point; roc_curve starts at (0, 0) and ends at (1, 1), so the maximum is >= 0 and the
+        # origin wins when it is 0, as argmax returns the first maximum
+        tpr = (cum_pos - base_pos) / n_pos_seg[key]
+        fpr = (cum_neg - base_neg) / n_neg_seg[key]
+        youden = np.where(is_threshold, tpr - fpr, -np.inf)
+        best = np.maximum.reduceat(youden, starts)
+        first = np.minimum.reduceat(np.where(youden == best[seg], positions, n_rep * n - 1), starts)
+        origin = ~(best > 0)
+        empty = (n_pos_seg == 0) | (n_neg_seg == 0)  # no ROC curve, Youden's index is nan
+        for name, values in [("FPR_opt", fpr), ("TPR_opt", tpr), ("Youden_opt", youden)]:
+            results[name] = np.zeros(n_keys)
+            results[name][key[starts]] = np.where(origin, 0.0, values[first])
+            results[name][empty] = np.nan
+
+    return {k: v.reshape(n_rep, n_groups + 1)[:, :n_groups] for k, v in results.items()}
@@ -2,21 +2,20 @@ import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, Dataset
 import pandas as pd
 import numpy as np
 import torchvision
-import torchvision.transforms as T
 from torchvision import models
 import pytorch_lightning as pl
 
 from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.callbacks import ModelCheckpoint
-from skimage.io import imread
 from skimage.io import imsave
 from tqdm import tqdm
 from argparse import ArgumentParser
 
+from chexpert_core import CheXpertDataModule
+
 image_size = (224, 224)
 num_classes_disease = 14
 num_classes_sex = 2
@@ -28,109 +27,14 @@ num_workers = 4
 img_data_dir = '<path_to_data>/CheXpert-v1.0/'
 
 
-class CheXpertDataset(Dataset):
-    def __init__(self, csv_file_img, image_size, augmentation=False, pseudo_rgb = True):
-        self.data = pd.read_csv(csv_file_img)
-        self.image_size = image_size
-        self.do_augment = augmentation
-        self.pseudo_rgb = pseudo_rgb
-
-        self.labels = [
-            'No Finding',
-            'Enlarged Cardiomediastinum',
-            'Cardiomegaly',
-            'Lung Opacity',
-            'Lung Lesion',
-            'Edema',
-            'Consolidation',
-            'Pneumonia',
-            'Atelectasis',
-            'Pneumothorax',
-            'Pleural Effusion',
-            'Pleural Other',
-            'Fracture',
-            'Support Devices']
-
-        self.augment = T.Compose([
-            T.RandomHorizontalFlip(p=0.5),
-            T.RandomApply(transforms=[T.RandomAffine(degrees=15, scale=(0.9, 1.1))], p=0.5),
-        ])
-
-        self.samples = []
-        for idx, _ in enumerate(tqdm(range(len(self.data)), desc='Loading Data')):
-            img_path = img_data_dir + self.data.loc[idx, 'path_preproc']
-            img_label_disease = np.zeros(len(self.labels), dtype='float32')
-            for i in range(0, len(self.labels)):
-                img_label_disease[i] = np.array(self.data.loc[idx, self.labels[i].strip()] == 1, dtype='float32')
-
-            img_label_sex = np.array(self.data.loc[idx, 'sex_label'], dtype='int64')
-            img_label_race = np.array(self.data.loc[idx, 'race_label'], dtype='int64')
-
-            sample = {'image_path': img_path, 'label_disease': img_label_disease, 'label_sex': img_label_sex, 'label_race': img_label_race}
-            self.samples.append(sample)
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, item):
-        sample = self.get_sample(item)
-
-        image = torch.from_numpy(sample['image']).unsqueeze(0)
-        label_disease = torch.from_numpy(sample['label_disease'])
-        label_sex = torch.from_numpy(sample['label_sex'])
-        label_race = torch.from_numpy(sample['label_race'])
-
-        if self.do_augment:
-            image = self.augment(image)
-
-        if self.pseudo_rgb:
-            image = image.repeat(3, 1, 1)
-
-        return {'image': image, 'label_disease': label_disease, 'label_sex': label_sex, 'label_race': label_race}
-
-    def get_sample(self, item):
-        sample = self.samples[item]
-        image = imread(sample['image_path']).astype(np.float32)
-
-        return {'image': image, 'label_disease': sample['label_disease'], 'label_sex': sample['label_sex'], 'label_race': sample['label_race']}
-
-
-class CheXpertDataModule(pl.LightningDataModule):
-    def __init__(self, csv_train_img, csv_val_img, csv_test_img, image_size, pseudo_rgb, batch_size, num_workers):
-        super().__init__()
-        self.csv_train_img = csv_train_img
-        self.csv_val_img = csv_val_img
-        self.csv_test_img = csv_test_img
-        self.image_size = image_size
-        self.batch_size = batch_size
-        self.num_workers = num_workers
-
-        self.train_set = CheXpertDataset(self.csv_train_img, self.image_size, augmentation=True, pseudo_rgb=pseudo_rgb)
-        self.val_set = CheXpertDataset(self.csv_val_img, self.image_size, augmentation=False, pseudo_rgb=pseudo_rgb)
-        self.test_set = CheXpertDataset(self.csv_test_img, self.image_size, augmentation=False, pseudo_rgb=pseudo_rgb)
-
-        print('#train: ', len(self.train_set))
-        print('#val:   ', len(self.val_set))
-        print('#test:  ', len(self.test_set))
-
-    def train_dataloader(self):
-        return DataLoader(self.train_set, self.batch_size, shuffle=True, num_workers=self.num_workers)
-
-    def val_dataloader(self):
-        return DataLoader(self.val_set, self.batch_size, shuffle=False, num_workers=self.num_workers)
-
-    def test_dataloader(self):
-        return DataLoader(self.test_set, self.batch_size, shuffle=False, num_workers=self.num_workers)
-
-
 class ResNet(pl.LightningModule):
-    def __init__(self, num_classes_disease, num_classes_sex, num_classes_race, class_weights_race):
+    def __init__(self, num_classes_disease, num_classes_sex, num_classes_race, class_weights_race, pretrained=True):
         super().__init__()
         self.num_classes_disease = num_classes_disease
         self.num_classes_sex = num_classes_sex
         self.num_classes_race = num_classes_race
         self.class_weights_race = torch.FloatTensor(class_weights_race)
-        self.backbone = models.resnet34(pretrained=True)
+        self.backbone = models.resnet34(pretrained=pretrained)
         num_features = self.backbone.fc.in_features
         self.fc_disease = nn.Linear(num_features, self.num_classes_disease)
         self.fc_sex = nn.Linear(num_features, self.num_classes_sex)
@@ -189,13 +93,13 @@ class ResNet(pl.LightningModule):
 
 
 class DenseNet(pl.LightningModule):
-    def __init__(self, num_classes_disease, num_classes_sex, num_classes_race, class_weights_race):
+    def __init__(self, num_classes_disease, num_classes_sex, num_classes_race, class_weights_race, pretrained=True):
         super().__init__()
         self.num_classes_disease = num_classes_disease
         self.num_classes_sex = num_classes_sex
         self.num_classes_race = num_classes_race
         self.class_weights_race = torch.FloatTensor(class_weights_race)
-        self.backbone = models.densenet121(pretrained=True)
+        self.backbone = models.densenet121(pretrained=pretrained)
         num_features = self.backbone.classifier.in_features
         self.fc_disease = nn.Linear(num_features, self.num_classes_disease)
         self.fc_sex = nn.Linear(num_features, self.num_classes_sex)
@@ -354,13 +258,15 @@ def main(hparams):
     pl.seed_everything(42, workers=True)
 
     # data
-    data = CheXpertDataModule(csv_train_img='../datafiles/chexpert/chexpert.sample.train.csv',
+    data = CheXpertDataModule(img_data_dir=img_data_dir,
+                              csv_train_img='../datafiles/chexpert/chexpert.sample.train.csv',
                               csv_val_img='../datafiles/chexpert/chexpert.sample.val.csv',
                               csv_test_img='../datafiles/chexpert/chexpert.sample.test.csv',
                               image_size=image_size,
                               pseudo_rgb=True,
                               batch_size=batch_size,
-                              num_workers=num_workers)
+                              num_workers=num_workers,
+                              targets={'label_disease': 'disease', 'label_sex': 'sex_label', 'label_race': 'race_label'})
 
     # model
     model_type = DenseNet
@@ -393,7 +299,7 @@ def main(hparams):
     trainer.logger._default_hp_metric = False
     trainer.fit(model, data)
 
-    model = model_type.load_from_checkpoint(trainer.checkpoint_callback.best_model_path, num_classes_disease=num_classes_disease, num_classes_sex=num_classes_sex, num_classes_race=num_classes_race, class_weights_race=class_weights_race)
+    model = model_type.load_from_checkpoint(trainer.checkpoint_callback.best_model_path, num_classes_disease=num_classes_disease, num_classes_sex=num_classes_sex, num_classes_race=num_classes_race, class_weights_race=class_weights_race, pretrained=False)
 
     use_cuda = torch.cuda.is_available()
     device = torch.device("cuda:" + str(hparams.dev) if use_cuda else "cpu")
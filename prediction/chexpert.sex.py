@@ -1,22 +1,17 @@
 import os
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils.data import DataLoader, Dataset
 import pandas as pd
 import numpy as np
-import torchvision
-import torchvision.transforms as T
-from torchvision import models
 import pytorch_lightning as pl
 
 from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.callbacks import ModelCheckpoint
-from skimage.io import imread
 from skimage.io import imsave
 from tqdm import tqdm
 from argparse import ArgumentParser
 
+from chexpert_core import CheXpertDataModule, DenseNet, ResNet
+
 device_type = "mps"
 random_seed = 42
 img_size = 128
@@ -48,212 +43,6 @@ elif mode == "test":
     run_embeddings = False
 
 
-class CheXpertDataset(Dataset):
-    def __init__(self, img_data_dir, csv_file_img, image_size, augmentation=False, pseudo_rgb=True, path_col="path_preproc"):
-        self.data = pd.read_csv(csv_file_img)
-        self.image_size = image_size
-        self.do_augment = augmentation
-        self.pseudo_rgb = pseudo_rgb
-        self.path_col = path_col
-        self.img_data_dir = img_data_dir
-
-        self.augment = T.Compose([
-            T.RandomHorizontalFlip(p=0.5),
-            T.RandomApply(transforms=[T.RandomAffine(degrees=15, scale=(0.9, 1.1))], p=0.5),
-        ])
-
-        self.samples = []
-        for idx, _ in enumerate(tqdm(range(len(self.data)), desc='Loading Data')):
-            img_path = self.img_data_dir + self.data.loc[idx, self.path_col]
-            img_label = np.array(self.data.loc[idx, 'sex_label'], dtype='int64')
-
-            sample = {'image_path': img_path, 'label': img_label}
-            self.samples.append(sample)
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, item):
-        sample = self.get_sample(item)
-
-        image = torch.from_numpy(sample['image'])
-        if len(image.shape) == 2:
-            image = image.unsqueeze(0)
-        label = torch.from_numpy(sample['label'])
-
-        if self.do_augment:
-            image = self.augment(image)
-
-        if self.pseudo_rgb:
-            if image.shape[2] == 3:
-                image = image.permute(2, 0, 1)
-            elif image.shape[0] == 3:
-                image = image
-            elif image.shape[0] == 1:
-                image = image.repeat(3, 1, 1)
-            else:
-                raise ValueError(f"Image shape {image.shape} not supported")
-
-        return {'image': image, 'label': label}
-
-    def get_sample(self, item):
-        sample = self.samples[item]
-        image = imread(sample['image_path']).astype(np.float32)
-
-        return {'image': image, 'label': sample['label']}
-
-
-class CheXpertDataModule(pl.LightningDataModule):
-    def __init__(
-        self,
-        img_data_dir,
-        csv_train_img,
-        csv_val_img,
-        csv_test_img,
-        image_size,
-        pseudo_rgb,
-        batch_size,
-        num_workers,
-        path_col_test="path_preproc",
-    ):
-        super().__init__()
-        self.csv_train_img = csv_train_img
-        self.csv_val_img = csv_val_img
-        self.csv_test_img = csv_test_img
-        self.image_size = image_size
-        self.batch_size = batch_size
-        self.num_workers = num_workers
-        self.path_col_test = path_col_test
-        self.img_data_dir = img_data_dir
-
-        self.train_set = CheXpertDataset(
-            self.img_data_dir,
-            self.csv_train_img,
-            self.image_size,
-            augmentation=True,
-            pseudo_rgb=pseudo_rgb,
-        )
-        self.val_set = CheXpertDataset(self.img_data_dir,
-            self.csv_val_img, self.image_size, augmentation=False, pseudo_rgb=pseudo_rgb
-        )
-        self.test_set = CheXpertDataset(
-            self.img_data_dir,
-            self.csv_test_img,
-            self.image_size,
-            augmentation=False,
-            pseudo_rgb=pseudo_rgb,
-            path_col=self.path_col_test
-        )
-
-        print('#train: ', len(self.train_set))
-        print('#val:   ', len(self.val_set))
-        print('#test:  ', len(self.test_set))
-
-    def train_dataloader(self):
-        return DataLoader(self.train_set, self.batch_size, shuffle=True, num_workers=self.num_workers)
-
-    def val_dataloader(self):
-        return DataLoader(self.val_set, self.batch_size, shuffle=False, num_workers=self.num_workers)
-
-    def test_dataloader(self):
-        return DataLoader(self.test_set, self.batch_size, shuffle=False, num_workers=self.num_workers)
-
-
-class ResNet(pl.LightningModule):
-    def __init__(self, num_classes):
-        super().__init__()
-        self.num_classes = num_classes
-        self.model = models.resnet34(pretrained=True)
-        # freeze_model(self.model)
-        num_features = self.model.fc.in_features
-        self.model.fc = nn.Linear(num_features, self.num_classes)
-
-    def forward(self, x):
-        return self.model.forward(x)
-
-    def configure_optimizers(self):
-        params_to_update = []
-        for param in self.parameters():
-            if param.requires_grad == True:
-                params_to_update.append(param)
-        optimizer = torch.optim.Adam(params_to_update, lr=0.001)
-        return optimizer
-
-    def unpack_batch(self, batch):
-        return batch['image'], batch['label']
-
-    def process_batch(self, batch):
-        img, lab = self.unpack_batch(batch)
-        out = self.forward(img)
-        loss = F.cross_entropy(out, lab)
-        return loss
-
-    def training_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log('train_loss', loss)
-        grid = torchvision.utils.make_grid(batch['image'][0:4, ...], nrow=2, normalize=True)
-        self.logger.experiment.add_image('images', grid, self.global_step)
-        return loss
-
-    def validation_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log('val_loss', loss)
-
-    def test_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log('test_loss', loss)
-
-
-class DenseNet(pl.LightningModule):
-    def __init__(self, num_classes):
-        super().__init__()
-        self.num_classes = num_classes
-        self.model = models.densenet121(pretrained=True)
-        # freeze_model(self.model)
-        num_features = self.model.classifier.in_features
-        self.model.classifier = nn.Linear(num_features, self.num_classes)
-
-    def forward(self, x):
-        return self.model.forward(x)
-
-    def configure_optimizers(self):
-        params_to_update = []
-        for param in self.parameters():
-            if param.requires_grad == True:
-                params_to_update.append(param)
-        optimizer = torch.optim.Adam(params_to_update, lr=0.001)
-        return optimizer
-
-    def unpack_batch(self, batch):
-        return batch['image'], batch['label']
-
-    def process_batch(self, batch):
-        img, lab = self.unpack_batch(batch)
-        out = self.forward(img)
-        loss = F.cross_entropy(out, lab)
-        return loss
-
-    def training_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log('train_loss', loss)
-        grid = torchvision.utils.make_grid(batch['image'][0:4, ...], nrow=2, normalize=True)
-        self.logger.experiment.add_image('images', grid, self.global_step)
-        return loss
-
-    def validation_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log('val_loss', loss)
-
-    def test_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log('test_loss', loss)
-
-
-def freeze_model(model):
-    for param in model.parameters():
-        param.requires_grad = False
-
-
 def test(model, data_loader, device):
     model.eval()
     preds = []
@@ -295,11 +84,12 @@ def main(hparams):
         batch_size=batch_size,
         num_workers=num_workers,
         path_col_test=path_col_test,
+        targets={'label': 'sex_label'},
     )
 
     # model
     model_type = eval(MODEL_TYPE)
-    model = model_type(num_classes=num_classes)
+    model = model_type(num_classes=num_classes, multi_label=False)
 
     # Create output directory
     out_dir = 'chexpert/sex/' + out_name
@@ -330,12 +120,14 @@ def main(hparams):
         trainer.logger._default_hp_metric = False
         trainer.fit(model, data)
 
-        model = model_type.load_from_checkpoint(trainer.checkpoint_callback.best_model_path, num_classes=num_classes)
+        model = model_type.load_from_checkpoint(trainer.checkpoint_callback.best_model_path, num_classes=num_classes, multi_label=False, pretrained=False)
 
     elif mode == "test":
         model = model_type.load_from_checkpoint(
             os.path.join(out_dir, "best.ckpt") if model_path is None else model_path,
             num_classes=num_classes,
+            multi_label=False,
+            pretrained=False,
         )
 
     else:
@@ -0,0 +1,148 @@
+"""
+Dataset, data module and models shared by the training scripts, the server, Grad-CAM and the notebooks.
+Importing this module has no side effects and imports only numpy: the torch Dataset (chexpert_data.py) and the
+Lightning data module and models (chexpert_modules.py) are imported on first access, as are pandas, torch,
+torchvision and skimage inside the functions that need them. Works from prediction/ (import chexpert_core) and
+from the repository root (from prediction.chexpert_core import ...).
+"""
+import importlib
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+labels = [
+    "No Finding",
+    "Enlarged Cardiomediastinum",
+    "Cardiomegaly",
+    "Lung Opacity",
+    "Lung Lesion",
+    "Edema",
+    "Consolidation",
+    "Pneumonia",
+    "Atelectasis",
+    "Pneumothorax",
+    "Pleural Effusion",
+    "Pleural Other",
+    "Fracture",
+    "Support Devices",
+]
+demographic_columns = ["race", "sex", "age", "patient_id"]  # kept on the datasets for subgroup metrics
+
+# attribute -> module defining it, imported by __getattr__ on first access
+_lazy_attributes = {
+    "CheXpertDataset": "chexpert_data",
+    "CheXpertDataModule": "chexpert_modules",
+    "ResNet": "chexpert_modules",
+    "DenseNet": "chexpert_modules",
+    "SplitResNet": "chexpert_modules",
+    "SplitDenseNet": "chexpert_modules",
+}
+
+
+def __getattr__(name):
+    if name not in _lazy_attributes:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # relative to the package when imported as prediction.chexpert_core, else a top-level sibling
+    module = importlib.import_module(("." if __package__ else "") + _lazy_attributes[name], __package__ or None)
+    value = globals()[name] = getattr(module, name)
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes))
+
+
+def read_table(path, columns=None):
+    """
+    Sample table from a csv file or a columnar manifest (.parquet or .feather, see notebooks/manifest.py)
+    """
+    import pandas as pd
+
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    if path.endswith(".feather"):
+        return pd.read_feather(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def select_rows(data, indices=None, query=None):
+    """
+    Row positions of a view of data: the rows for which query (a DataFrame.eval expression such as
+    "split == 'train' and race == 'White'") is true, then the positions indices among those (e.g. resampled row ids)
+    """
+    rows = np.arange(len(data))
+    if query:
+        rows = rows[np.asarray(data.eval(query), dtype=bool)]
+    if indices is not None:
+        rows = rows[np.asarray(indices)]
+    return rows
+
+
+def freeze_model(model):
+    for param in model.parameters():
+        param.requires_grad = False
+
+
+def load_checkpoint(model_type, checkpoint_path, mmap=True, **kwargs):
+    """
+    Load a Lightning checkpoint without ImageNet weight initialization.
+    The architecture is built with pretrained=False (no download, works offline) and the checkpoint
+    state dict is mapped straight onto it; with mmap=True the weights are memory-mapped from the file.
+    """
+    import inspect
+    import torch
+
+    model = model_type(pretrained=False, **kwargs)
+    load_args = inspect.signature(torch.load).parameters
+    load_kwargs = {"map_location": "cpu"}
+    if "weights_only" in load_args:
+        load_kwargs["weights_only"] = False  # Lightning checkpoints also store loop and callback states
+    mmap = mmap and "mmap" in load_args
+    if mmap:
+        load_kwargs["mmap"] = True
+    checkpoint = torch.load(checkpoint_path, **load_kwargs)
+    if mmap:
+        model.load_state_dict(checkpoint["state_dict"], assign=True)
+    else:
+        model.load_state_dict(checkpoint["state_dict"])
+    return model
+
+
+def synchronize(device):
+    import torch
+
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def import_seconds(statement, repeats=3, cwd=None):
+    """
+    Best wall time of running statement in a fresh interpreter (cold start, including interpreter startup)
+    """
+    code = f"import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.split()[-1]))
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Cold-start import time of the prediction modules")
+    parser.add_argument(
+        "--statements",
+        nargs="+",
+        default=[
+            "import chexpert_core",
+            "from chexpert_core import CheXpertDataset",
+            "from chexpert_core import DenseNet, load_checkpoint",
+            "import chexpert_disease",
+        ],
+    )
+    parser.add_argument("--repeats", default=3, type=int)
+    args = parser.parse_args()
+
+    for statement in args.statements:
+        print(f"{import_seconds(statement, args.repeats):6.2f}s  {statement}")
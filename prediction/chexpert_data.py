@@ -0,0 +1,232 @@
+import io
+import os
+from time import perf_counter
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, default_collate
+
+# only torch: DataLoader worker processes that unpickle the dataset import this module, not Lightning
+try:  # imported as prediction.chexpert_data (notebooks)
+    from .chexpert_core import demographic_columns, labels, read_table, select_rows
+except ImportError:  # imported from prediction/ (scripts)
+    from chexpert_core import demographic_columns, labels, read_table, select_rows
+
+
+def _decode_skimage(source):
+    from skimage.io import imread
+
+    return imread(source if isinstance(source, str) else io.BytesIO(source))
+
+
+def _decode_pil(source):
+    from PIL import Image
+
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+        return np.asarray(image)
+
+
+def _decode_torchvision(source):
+    from torchvision.io import decode_image, read_file
+
+    if isinstance(source, str) and not os.path.exists(source):
+        raise FileNotFoundError(source)  # like the other decoders (read_file raises RuntimeError)
+    data = read_file(source) if isinstance(source, str) else torch.frombuffer(bytearray(source), dtype=torch.uint8)
+    image = decode_image(data)  # C x H x W
+    return image[0].numpy() if image.shape[0] == 1 else image.permute(1, 2, 0).numpy()
+
+
+# image file (path or encoded bytes) -> H x W (x C) array; all decode JPEG and PNG and raise FileNotFoundError
+# for a missing file
+decoders = {"skimage": _decode_skimage, "pil": _decode_pil, "torchvision": _decode_torchvision}
+
+
+class PackedImages:
+    """
+    Encoded image files packed into one file, images.bin, with their byte offsets (offsets.npy) and relative paths
+    (paths.npy): reading an image is a slice of a memory map instead of opening a file. Written by pack().
+    The memory map is opened lazily in every process, so the store can be passed to DataLoader workers.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.offsets = np.load(os.path.join(store_dir, "offsets.npy"))
+        self.paths = np.load(os.path.join(store_dir, "paths.npy"))
+        self.data = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getstate__(self):
+        return {**self.__dict__, "data": None}
+
+    def __getitem__(self, row):
+        if self.data is None:
+            self.data = np.memmap(os.path.join(self.store_dir, "images.bin"), dtype=np.uint8, mode="r")
+        return self.data[self.offsets[row] : self.offsets[row + 1]].tobytes()
+
+    def rows(self, paths):
+        """
+        Store row of every relative image path
+        """
+        lookup = {path: row for row, path in enumerate(self.paths)}
+        missing = [path for path in paths if path not in lookup]
+        if missing:
+            raise ValueError(f"{len(missing)} images are not in {self.store_dir}, e.g. {missing[0]}")
+        return np.array([lookup[path] for path in paths], dtype=np.int64)
+
+    @staticmethod
+    def pack(img_data_dir, paths, store_dir):
+        """
+        Copy the files img_data_dir + path (each path once) into a new store; as in CheXpertDataset, a missing
+        image is read from its png copy
+        """
+        paths = list(dict.fromkeys(str(path) for path in paths))
+        os.makedirs(store_dir, exist_ok=True)
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        with open(os.path.join(store_dir, "images.bin"), "wb") as f:
+            for row, path in enumerate(paths):
+                file = img_data_dir + path
+                if not os.path.exists(file):
+                    file = file.replace("jpg", "png")
+                with open(file, "rb") as image:
+                    offsets[row + 1] = offsets[row] + f.write(image.read())
+        np.save(os.path.join(store_dir, "offsets.npy"), offsets)
+        np.save(os.path.join(store_dir, "paths.npy"), np.array(paths))
+        return PackedImages(store_dir)
+
+
+class CheXpertDataset(Dataset):
+    def __init__(
+        self,
+        img_data_dir,
+        csv_file_img,
+        image_size,
+        augmentation=False,
+        pseudo_rgb=True,
+        path_col="path_preproc",
+        indices=None,
+        query=None,
+        targets=None,
+        return_path=False,
+        profile=False,
+        decoder="skimage",
+        packed_dir=None,
+    ):
+        """
+        csv_file_img: csv or manifest file, or an already loaded table shared by several views.
+        indices/query select the rows of the view (see select_rows); only the image paths, targets and
+        demographics of those rows are kept.
+        targets: batch key -> "disease" (the 14 labels as multi-hot float32) or a column of class indices
+        (int64, e.g. "race_label"); default {"label": "disease"}. return_path adds "image_path" to the samples.
+        profile: time imread and augmentation of every sample ("stage_times", see stage_profiler.py; batch with
+        profiled_collate to time the collation too)
+        decoder: one of decoders; packed_dir: read the images from a PackedImages store of the path_col files
+        instead of img_data_dir
+        """
+        import pandas as pd
+
+        self.image_size = image_size
+        self.do_augment = augmentation
+        self.pseudo_rgb = pseudo_rgb
+        self.path_col = path_col
+        self.img_data_dir = img_data_dir
+        self.return_path = return_path
+        self.profile = profile
+        if decoder not in decoders:
+            raise ValueError(f"decoder must be one of {list(decoders)}, not {decoder}")
+        self.decoder = decoder
+        self.labels = list(labels)
+        self.target_columns = {"label": "disease"} if targets is None else dict(targets)
+
+        self.augment = None
+        if augmentation:
+            import torchvision.transforms as T
+
+            self.augment = T.Compose(
+                [
+                    T.RandomHorizontalFlip(p=0.5),
+                    T.RandomApply(
+                        transforms=[T.RandomAffine(degrees=15, scale=(0.9, 1.1))], p=0.5
+                    ),
+                ]
+            )
+
+        data = csv_file_img if isinstance(csv_file_img, pd.DataFrame) else read_table(csv_file_img)
+        self.rows = select_rows(data, indices, query)
+        columns = [self.path_col]
+        for column in self.target_columns.values():
+            columns += self.labels if column == "disease" else [column]
+        columns += [c for c in demographic_columns if c in data]
+        view = data[list(dict.fromkeys(columns))].iloc[self.rows].reset_index(drop=True)
+        self.image_paths = (self.img_data_dir + view[self.path_col].astype(str)).values
+        self.targets = {
+            key: (view[self.labels].values == 1).astype(np.float32)
+            if column == "disease"
+            else view[column].values.astype(np.int64)
+            for key, column in self.target_columns.items()
+        }
+        self.demographics = view[[c for c in demographic_columns if c in view]]
+        self.packed = None
+        if packed_dir:
+            self.packed = PackedImages(packed_dir)
+            self.packed_rows = self.packed.rows(view[self.path_col].astype(str))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, item):
+        times = {"pid": os.getpid()} if self.profile else None
+        start = perf_counter()
+        sample = self.get_sample(item)
+        if times is not None:
+            times["imread"] = torch.tensor([start, perf_counter()], dtype=torch.float64)
+
+        image = torch.from_numpy(sample.pop("image"))
+        if len(image.shape) == 2:
+            image = image.unsqueeze(0)
+        if self.do_augment:
+            start = perf_counter()
+            image = self.augment(image)
+            if times is not None:
+                times["augment"] = torch.tensor([start, perf_counter()], dtype=torch.float64)
+        if self.pseudo_rgb:
+            if image.shape[2] == 3:
+                image = image.permute(2, 0, 1)
+            elif image.shape[0] == 3:
+                image = image
+            elif image.shape[0] == 1:
+                image = image.repeat(3, 1, 1)
+            else:
+                raise ValueError(f"Image shape {image.shape} not supported")
+
+        sample = {"image": image, **{key: torch.as_tensor(target) for key, target in sample.items()}, "index": item}
+        if self.return_path:
+            sample["image_path"] = self.image_paths[item]
+        if times is not None:
+            sample["stage_times"] = times
+        return sample
+
+    def get_sample(self, item):
+        decode = decoders[self.decoder]
+        if self.packed is not None:
+            image = decode(self.packed[self.packed_rows[item]]).astype(np.float32)
+        else:
+            try:
+                image = decode(self.image_paths[item]).astype(np.float32)
+            except FileNotFoundError:  # a png copy of the image
+                image = decode(self.image_paths[item].replace("jpg", "png")).astype(np.float32)
+
+        return {"image": image, **{key: targets[item] for key, targets in self.targets.items()}}
+
+
+def profiled_collate(samples):
+    """
+    default_collate that adds its own start and end time to the "stage_times" of the batch
+    """
+    start = perf_counter()
+    batch = default_collate(samples)
+    end = perf_counter()
+    if isinstance(batch, dict) and "stage_times" in batch:
+        batch["stage_times"]["collate"] = torch.tensor([[start, end]], dtype=torch.float64)
+    return batch
@@ -1,22 +1,20 @@
 import os
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils.data import DataLoader, Dataset
 import pandas as pd
 import numpy as np
-import torchvision
-import torchvision.transforms as T
-from torchvision import models
 import pytorch_lightning as pl
 
 from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.callbacks import ModelCheckpoint
-from skimage.io import imread
 from skimage.io import imsave
 from tqdm import tqdm
 from argparse import ArgumentParser
 
+from chexpert_core import CheXpertDataModule, DenseNet, ResNet, load_checkpoint
+from chexpert_inference import test, tta_cost
+from stage_profiler import StageProfiler, stage
+from streaming_metrics import StreamingMetrics
+
 device_type = "mps"
 random_seed = 42
 img_size = 128
@@ -26,6 +24,21 @@ batch_size = 150
 epochs = 20
 num_workers = 4
 MODEL_TYPE = "DenseNet" # DenseNet, ResNet
+tta_views = 0  # number of test-time augmentation views (chexpert_inference.tta_transforms), 0 or 1 disables TTA
+# score histogram resolution of the constant-memory per-subgroup test metrics (streaming_metrics.py), e.g. 1000
+# for very large test sets; 0 disables them
+streaming_bins = 0
+streaming_only = False  # constant-memory testing: only the streaming metrics (needs streaming_bins), no predictions csv
+# columnar manifest (notebooks/manifest.py) with a split column, used instead of the csv files below if set
+manifest_file = ""
+train_filter = ""  # e.g. "race == 'White'" to train and validate on a subgroup (as the .train.white csv files)
+# row ids of the test set (.idx.npy, e.g. the resampled test set of notebooks/resample.py) to test on instead of all
+# rows, e.g. "../datafiles/chexpert/chexpert.resample_128.test.idx.npy" with the matching sample csv as csv_test_img
+test_indices_file = ""
+# time imread, augmentation, collation, transfer, forward/backward, optimizer, logging and csv writing, with a
+# breakdown table at the end (stage_profiler.py); profile_trace: Chrome trace file in the output directory
+profile_stages = False
+profile_trace = ""  # e.g. "trace.json"
 
 img_data_dir = "/Users/felixkrones/python_projects/data/ChestXpert/"
 
@@ -47,287 +60,7 @@ if mode == "test":
     run_embeddings = False
 
 
-class CheXpertDataset(Dataset):
-    def __init__(self, img_data_dir, csv_file_img, image_size, augmentation=False, pseudo_rgb=True, path_col="path_preproc"):
-        self.data = pd.read_csv(csv_file_img)
-        self.image_size = image_size
-        self.do_augment = augmentation
-        self.pseudo_rgb = pseudo_rgb
-        self.path_col = path_col
-        self.img_data_dir = img_data_dir
-
-        self.labels = [
-            "No Finding",
-            "Enlarged Cardiomediastinum",
-            "Cardiomegaly",
-            "Lung Opacity",
-            "Lung Lesion",
-            "Edema",
-            "Consolidation",
-            "Pneumonia",
-            "Atelectasis",
-            "Pneumothorax",
-            "Pleural Effusion",
-            "Pleural Other",
-            "Fracture",
-            "Support Devices",
-        ]
-
-        self.augment = T.Compose(
-            [
-                T.RandomHorizontalFlip(p=0.5),
-                T.RandomApply(
-                    transforms=[T.RandomAffine(degrees=15, scale=(0.9, 1.1))], p=0.5
-                ),
-            ]
-        )
-
-        self.samples = []
-        for idx, _ in enumerate(tqdm(range(len(self.data)), desc="Loading Data")):
-            img_path = self.img_data_dir + self.data.loc[idx, self.path_col]
-            img_label = np.zeros(len(self.labels), dtype="float32")
-            for i in range(0, len(self.labels)):
-                img_label[i] = np.array(
-                    self.data.loc[idx, self.labels[i].strip()] == 1, dtype="float32"
-                )
-
-            sample = {"image_path": img_path, "label": img_label}
-            self.samples.append(sample)
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, item):
-        sample = self.get_sample(item)
-
-        image = torch.from_numpy(sample["image"])#.unsqueeze(0)
-        label = torch.from_numpy(sample["label"])
-        if len(image.shape) == 2:
-            image = image.repeat(3, 1, 1)
-        if self.do_augment:
-            image = self.augment(image)
-        if self.pseudo_rgb:
-            if image.shape[2] == 3:
-                image = image.permute(2, 0, 1)
-            elif image.shape[0] == 3:
-                image = image
-            elif image.shape[0] == 1:
-                image = image.repeat(3, 1, 1)
-            else:
-                raise ValueError(f"Image shape {image.shape} not supported")
-
-        return {"image": image, "label": label}
-
-    def get_sample(self, item):
-        sample = self.samples[item]
-        image = imread(sample["image_path"]).astype(np.float32)
-
-        return {"image": image, "label": sample["label"]}
-
-
-class CheXpertDataModule(pl.LightningDataModule):
-    def __init__(
-        self,
-        img_data_dir,
-        csv_train_img,
-        csv_val_img,
-        csv_test_img,
-        image_size,
-        pseudo_rgb,
-        batch_size,
-        num_workers,
-        path_col_test="path_preproc",
-    ):
-        super().__init__()
-        self.csv_train_img = csv_train_img
-        self.csv_val_img = csv_val_img
-        self.csv_test_img = csv_test_img
-        self.image_size = image_size
-        self.batch_size = batch_size
-        self.num_workers = num_workers
-        self.path_col_test = path_col_test
-        self.img_data_dir = img_data_dir
-
-        self.train_set = CheXpertDataset(
-            self.img_data_dir,
-            self.csv_train_img,
-            self.image_size,
-            augmentation=True,
-            pseudo_rgb=pseudo_rgb,
-        )
-        self.val_set = CheXpertDataset(self.img_data_dir,
-            self.csv_val_img, self.image_size, augmentation=False, pseudo_rgb=pseudo_rgb
-        )
-        self.test_set = CheXpertDataset(
-            self.img_data_dir,
-            self.csv_test_img,
-            self.image_size,
-            augmentation=False,
-            pseudo_rgb=pseudo_rgb,
-            path_col=self.path_col_test
-        )
-
-        print("#train: ", len(self.train_set))
-        print("#val:   ", len(self.val_set))
-        print("#test:  ", len(self.test_set))
-
-    def train_dataloader(self):
-        return DataLoader(
-            self.train_set, self.batch_size, shuffle=True, num_workers=self.num_workers
-        )
-
-    def val_dataloader(self):
-        return DataLoader(
-            self.val_set, self.batch_size, shuffle=False, num_workers=self.num_workers
-        )
-
-    def test_dataloader(self):
-        return DataLoader(
-            self.test_set, self.batch_size, shuffle=False, num_workers=self.num_workers
-        )
-
-
-class ResNet(pl.LightningModule):
-    def __init__(self, num_classes):
-        super().__init__()
-        self.num_classes = num_classes
-        self.model = models.resnet34(pretrained=True)
-        # freeze_model(self.model)
-        num_features = self.model.fc.in_features
-        self.model.fc = nn.Linear(num_features, self.num_classes)
-
-    def remove_head(self):
-        num_features = self.model.fc.in_features
-        id_layer = nn.Identity(num_features)
-        self.model.fc = id_layer
-
-    def forward(self, x):
-        return self.model.forward(x)
-
-    def configure_optimizers(self):
-        params_to_update = []
-        for param in self.parameters():
-            if param.requires_grad == True:
-                params_to_update.append(param)
-        optimizer = torch.optim.Adam(params_to_update, lr=0.001)
-        return optimizer
-
-    def unpack_batch(self, batch):
-        return batch["image"], batch["label"]
-
-    def process_batch(self, batch):
-        img, lab = self.unpack_batch(batch)
-        out = self.forward(img)
-        prob = torch.sigmoid(out)
-        loss = F.binary_cross_entropy(prob, lab)
-        return loss
-
-    def training_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log("train_loss", loss)
-        grid = torchvision.utils.make_grid(
-            batch["image"][0:4, ...], nrow=2, normalize=True
-        )
-        self.logger.experiment.add_image("images", grid, self.global_step)
-        return loss
-
-    def validation_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log("val_loss", loss)
-
-    def test_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log("test_loss", loss)
-
-
-class DenseNet(pl.LightningModule):
-    def __init__(self, num_classes):
-        super().__init__()
-        self.num_classes = num_classes
-        self.model = models.densenet121(pretrained=True)
-        # freeze_model(self.model)
-        num_features = self.model.classifier.in_features
-        self.model.classifier = nn.Linear(num_features, self.num_classes)
-
-    def remove_head(self):
-        num_features = self.model.classifier.in_features
-        id_layer = nn.Identity(num_features)
-        self.model.classifier = id_layer
-
-    def forward(self, x):
-        return self.model.forward(x)
-
-    def configure_optimizers(self):
-        params_to_update = []
-        for param in self.parameters():
-            if param.requires_grad == True:
-                params_to_update.append(param)
-        optimizer = torch.optim.Adam(params_to_update, lr=0.001)
-        return optimizer
-
-    def unpack_batch(self, batch):
-        return batch["image"], batch["label"]
-
-    def process_batch(self, batch):
-        img, lab = self.unpack_batch(batch)
-        out = self.forward(img)
-        prob = torch.sigmoid(out)
-        loss = F.binary_cross_entropy(prob, lab)
-        return loss
-
-    def training_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log("train_loss", loss)
-        grid = torchvision.utils.make_grid(
-            batch["image"][0:4, ...], nrow=2, normalize=True
-        )
-        self.logger.experiment.add_image("images", grid, self.global_step)
-        return loss
-
-    def validation_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log("val_loss", loss)
-
-    def test_step(self, batch, batch_idx):
-        loss = self.process_batch(batch)
-        self.log("test_loss", loss)
-
-
-def freeze_model(model):
-    for param in model.parameters():
-        param.requires_grad = False
-
-
-def test(model, data_loader, device):
-    model.eval()
-    logits = []
-    preds = []
-    targets = []
-
-    with torch.no_grad():
-        for index, batch in enumerate(tqdm(data_loader, desc="Test-loop")):
-            img, lab = batch["image"].to(device), batch["label"].to(device)
-            out = model(img)
-            pred = torch.sigmoid(out)
-            logits.append(out)
-            preds.append(pred)
-            targets.append(lab)
-
-        logits = torch.cat(logits, dim=0)
-        preds = torch.cat(preds, dim=0)
-        targets = torch.cat(targets, dim=0)
-
-        counts = []
-        for i in range(0, num_classes):
-            t = targets[:, i] == 1
-            c = torch.sum(t)
-            counts.append(c)
-        print(counts)
-
-    return preds.cpu().numpy(), targets.cpu().numpy(), logits.cpu().numpy()
-
-
-def embeddings(model, data_loader, device):
+def embeddings(model, data_loader, device, profiler=None):
     model.eval()
 
     embeds = []
@@ -335,7 +68,10 @@ def embeddings(model, data_loader, device):
 
     with torch.no_grad():
         for index, batch in enumerate(tqdm(data_loader, desc="Test-loop")):
-            img, lab = batch["image"].to(device), batch["label"].to(device)
+            if profiler is not None:
+                profiler.add_worker_times(batch)
+            with stage(profiler, "transfer"):
+                img, lab = batch["image"].to(device), batch["label"].to(device)
             emb = model(img)
             embeds.append(emb)
             targets.append(lab)
@@ -349,6 +85,7 @@ def embeddings(model, data_loader, device):
 def main(hparams):
     # sets seeds for numpy, torch, python.random and PYTHONHASHSEED.
     pl.seed_everything(random_seed, workers=True)
+    profiler = StageProfiler() if profile_stages else None
 
     # data
     data = CheXpertDataModule(
@@ -361,11 +98,16 @@ def main(hparams):
         batch_size=batch_size,
         num_workers=num_workers,
         path_col_test=path_col_test,
+        manifest=manifest_file,
+        train_filter=train_filter,
+        profile=profile_stages,
+        test_indices=np.load(test_indices_file) if test_indices_file else None,
     )
 
     # model
     model_type = eval(MODEL_TYPE)
     model = model_type(num_classes=num_classes)
+    model.profiler = profiler
 
     # Create output directory
     out_dir = "chexpert/disease/" + out_name
@@ -399,12 +141,13 @@ def main(hparams):
         trainer.logger._default_hp_metric = False
         trainer.fit(model, data)
 
-        model = model_type.load_from_checkpoint(
-            trainer.checkpoint_callback.best_model_path, num_classes=num_classes
+        model = load_checkpoint(
+            model_type, trainer.checkpoint_callback.best_model_path, num_classes=num_classes
         )
 
     elif mode == "test":
-        model = model_type.load_from_checkpoint(
+        model = load_checkpoint(
+            model_type,
             os.path.join(out_dir, "best.ckpt") if model_path is None else model_path,
             num_classes=num_classes,
         )
@@ -416,6 +159,7 @@ def main(hparams):
     device = torch.device("cuda:" + str(hparams.dev) if use_cuda else device_type)
 
     model.to(device)
+    model.profiler = profiler
 
     cols_names_classes = ["class_" + str(i) for i in range(0, num_classes)]
     cols_names_logits = ["logit_" + str(i) for i in range(0, num_classes)]
@@ -423,36 +167,84 @@ def main(hparams):
 
     if mode == "train":
         print("VALIDATION")
-        preds_val, targets_val, logits_val = test(model, data.val_dataloader(), device)
+        preds_val, targets_val, logits_val = test(
+            model, data.val_dataloader(), device, tta=tta_views, profiler=profiler
+        )
         df = pd.DataFrame(data=preds_val, columns=cols_names_classes)
         df_logits = pd.DataFrame(data=logits_val, columns=cols_names_logits)
         df_targets = pd.DataFrame(data=targets_val, columns=cols_names_targets)
         df = pd.concat([df, df_logits, df_targets], axis=1)
-        df.to_csv(os.path.join(out_dir, "predictions.val.csv"), index=False)
+        with stage(profiler, "csv"):
+            df.to_csv(os.path.join(out_dir, "predictions.val.csv"), index=False)
+
+    if tta_views > 1:
+        cost = tta_cost(model, data.test_dataloader(), device, tta_views)
+        print(
+            f"TTA cost: {cost['plain']:.3f} ms/sample plain, {cost['tta']:.3f} ms/sample "
+            f"with {tta_views} views ({cost['ratio']:.2f}x)"
+        )
 
     print("TESTING")
-    preds_test, targets_test, logits_test = test(model, data.test_dataloader(), device)
-    df = pd.DataFrame(data=preds_test, columns=cols_names_classes)
-    df_logits = pd.DataFrame(data=logits_test, columns=cols_names_logits)
-    df_targets = pd.DataFrame(data=targets_test, columns=cols_names_targets)
-    df = pd.concat([df, df_logits, df_targets], axis=1)
-    df.to_csv(os.path.join(out_dir, "predictions.test.csv"), index=False)
+    if streaming_only and streaming_bins <= 0:
+        raise ValueError("streaming_only requires streaming_bins > 0")
+    metrics = None
+    if streaming_bins > 0:
+        test_data = data.test_set.demographics
+        group_masks = {
+            g: (test_data[col] == g).values
+            for col, groups in [("race", ["White", "Asian", "Black"]), ("sex", ["Female", "Male"])]
+            if col in test_data
+            for g in groups
+        }
+        metrics = StreamingMetrics(num_classes, group_masks, streaming_bins)
+    preds_test, targets_test, logits_test = test(
+        model,
+        data.test_dataloader(),
+        device,
+        tta=tta_views,
+        metrics=metrics,
+        keep_predictions=not streaming_only,
+        profiler=profiler,
+    )
+    if metrics is not None:
+        metrics_df = metrics.compute()
+        with stage(profiler, "csv"):
+            metrics_df.to_csv(os.path.join(out_dir, "metrics.test.streaming.csv"), index=False)
+        print(metrics_df.groupby("group", sort=False)[["AUC", "auc_error", "TPR", "FPR"]].mean())
+    if not streaming_only:
+        df = pd.DataFrame(data=preds_test, columns=cols_names_classes)
+        df_logits = pd.DataFrame(data=logits_test, columns=cols_names_logits)
+        df_targets = pd.DataFrame(data=targets_test, columns=cols_names_targets)
+        df = pd.concat([df, df_logits, df_targets], axis=1)
+        with stage(profiler, "csv"):
+            df.to_csv(os.path.join(out_dir, "predictions.test.csv"), index=False)
 
     if run_embeddings:
         print("EMBEDDINGS")
         model.remove_head()
         if mode == "train":
-            embeds_val, targets_val = embeddings(model, data.val_dataloader(), device)
+            embeds_val, targets_val = embeddings(model, data.val_dataloader(), device, profiler)
             df = pd.DataFrame(data=embeds_val)
             df_targets = pd.DataFrame(data=targets_val, columns=cols_names_targets)
             df = pd.concat([df, df_targets], axis=1)
-            df.to_csv(os.path.join(out_dir, "embeddings.val.csv"), index=False)
+            with stage(profiler, "csv"):
+                df.to_csv(os.path.join(out_dir, "embeddings.val.csv"), index=False)
+                np.save(os.path.join(out_dir, "embeddings.val.npy"), embeds_val.astype(np.float32))
 
-        embeds_test, targets_test = embeddings(model, data.test_dataloader(), device)
+        embeds_test, targets_test = embeddings(model, data.test_dataloader(), device, profiler)
         df = pd.DataFrame(data=embeds_test)
         df_targets = pd.DataFrame(data=targets_test, columns=cols_names_targets)
         df = pd.concat([df, df_targets], axis=1)
-        df.to_csv(os.path.join(out_dir, "embeddings.test.csv"), index=False)
+        with stage(profiler, "csv"):
+            df.to_csv(os.path.join(out_dir, "embeddings.test.csv"), index=False)
+            # binary copy for notebooks/embedding_analysis.py, which memory-maps it
+            np.save(os.path.join(out_dir, "embeddings.test.npy"), embeds_test.astype(np.float32))
+
+    if profiler is not None:
+        profiler.print_table()
+        if profile_trace:
+            profiler.save_trace(os.path.join(out_dir, profile_trace))
+            print(f"Chrome trace saved to {os.path.join(out_dir, profile_trace)}")
 
 
 if __name__ == "__main__":
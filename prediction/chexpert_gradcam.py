@@ -0,0 +1,261 @@
+import os
+import torch
+import numpy as np
+import pandas as pd
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from torch.utils.data import DataLoader, Subset
+from tabulate import tabulate
+from tqdm import tqdm
+from time import perf_counter
+from argparse import ArgumentParser
+
+from chexpert_core import CheXpertDataset, synchronize
+from chexpert_server import load_model, served_models
+from streaming_saliency import StreamingSaliency, save_heatmaps
+
+device_type = "cpu"
+img_size = 128
+image_size = (img_size, img_size)
+batch_size = 32
+num_workers = 4  # data loader processes
+num_writers = 4  # overlay encoding/writing processes, 0 writes in the main process
+max_images = None  # None: all images of csv_test_img
+overlay_alpha = 0.5
+overlay_colormap = "jet"
+save_overlays = True
+save_cams = True  # raw maps at layer resolution, cams.<model>.npy (float16, image x class x h x w)
+# mean/variance maps per subgroup and class, accumulated over all images (streaming_saliency.py); {} disables
+saliency_groups = {"race": ["White", "Asian", "Black"], "sex": ["Female", "Male"]}
+saliency_positives = False  # disease maps of a label averaged over the images positive for that label only
+cam_batched = False  # True: gradients of all classes in one vectorized backward (is_grads_batched), for GPUs
+
+img_data_dir = "/Users/felixkrones/python_projects/data/ChestXpert/"
+csv_test_img = f"../datafiles/chexpert/chexpert.sample_{img_size}_from_train_filtered_True.test.csv"
+path_col_test = "path_preproc"  # cropped_image_path, fake_image_path, path_preproc
+out_dir = f"chexpert/gradcam/densenet-all_{img_size}"
+
+# models of chexpert_server.served_models to explain, with target layer and classes (all from one forward)
+# layer: "model.features.denseblock4.denselayer16" for DenseNet, "model.layer4" for ResNet
+# disease: 3 = Lung Opacity, 13 = Support Devices; race: white 0, asian 1, black 2; sex: male 0, female 1
+cam_targets = {
+    "disease": {"layer": "model.features.denseblock4.denselayer16", "class_ids": [3, 13]},
+    "sex": {"layer": "model.features.denseblock4.denselayer16", "class_ids": [0]},
+    "race": {"layer": "model.features.denseblock4.denselayer16", "class_ids": [1]},
+}
+
+
+def normalize_cams(cams):
+    """
+    Scale every map to [0, 1] (min-max over its spatial dimensions, constant maps become 0), as torchcam does
+    """
+    flat = cams.flatten(start_dim=-2)
+    cams = cams - flat.min(dim=-1).values[..., None, None]
+    cams = cams / cams.flatten(start_dim=-2).max(dim=-1).values[..., None, None]
+    return cams.nan_to_num(nan=0.0)
+
+
+class GradCAM:
+    """
+    Grad-CAM (Selvaraju et al., 2017) of one layer for whole batches, equivalent to torchcam.methods.GradCAM:
+    the layer output is captured by a forward hook, the channel weights are the spatially averaged gradients of the
+    class score, and the weighted sum of the channels is rectified and normalized per image.
+    The maps of several classes share one forward: the activations are kept and only the part of the graph
+    between them and the scores is back-propagated once per class.
+    """
+
+    def __init__(self, model, layer):
+        self.model = model
+        self.activations = None
+        self.hook = model.get_submodule(layer).register_forward_hook(self._store)
+
+    def _store(self, module, inputs, output):
+        self.activations = output
+
+    def remove(self):
+        self.hook.remove()
+
+    def __call__(self, images, class_ids, batched=cam_batched):
+        """
+        Maps at layer resolution, (B, h, w) for one class id or (B, len(class_ids), h, w) for a list, and the model
+        outputs (B, num_classes), both detached. batched: all class gradients in one vectorized backward
+        (vmap over one-hot output gradients) instead of one backward per class on the retained graph.
+        """
+        single = isinstance(class_ids, int)
+        class_ids = [class_ids] if single else list(class_ids)
+        with torch.enable_grad():
+            scores = self.model(images)
+            activations, self.activations = self.activations, None
+            # samples are independent in eval mode, so the gradient of the batch sum is the per-sample gradient
+            if batched and len(class_ids) > 1:
+                one_hot = torch.zeros((len(class_ids),) + scores.shape, dtype=scores.dtype, device=scores.device)
+                one_hot[torch.arange(len(class_ids)), :, class_ids] = 1
+                grads = torch.autograd.grad(scores, activations, one_hot, is_grads_batched=True)[0].transpose(0, 1)
+            else:
+                grads = torch.stack(
+                    [torch.autograd.grad(scores[:, c].sum(), activations, retain_graph=True)[0] for c in class_ids],
+                    dim=1,
+                )
+        weights = grads.mean(dim=(3, 4))
+        cams = torch.relu(torch.einsum("bck,bkhw->bchw", weights, activations.detach()))
+        cams = normalize_cams(cams)
+        return cams[:, 0] if single else cams, scores.detach()
+
+
+def overlay(image, cam, alpha=overlay_alpha, colormap=overlay_colormap):
+    """
+    Colored map (bicubic upsampling to the image size) blended with the image, as torchcam.utils.overlay_mask
+    image: H x W x 3 uint8, cam: h x w in [0, 1]
+    """
+    from matplotlib import colormaps  # only needed in the writer processes
+
+    mask = Image.fromarray(np.asarray(cam, dtype=np.float32), mode="F").resize(
+        (image.shape[1], image.shape[0]), resample=Image.BICUBIC
+    )
+    colored = (255 * colormaps[colormap](np.asarray(mask) ** 2)[:, :, :3]).astype(np.uint8)
+    return Image.fromarray((alpha * image + (1 - alpha) * colored).astype(np.uint8))
+
+
+def write_overlays(images, cams, out_paths, alpha=overlay_alpha, colormap=overlay_colormap):
+    """
+    cams: (B, n_classes, h, w), out_paths: per image one path per class
+    """
+    for image, image_cams, image_paths in zip(images, cams, out_paths):
+        for cam, out_path in zip(image_cams, image_paths):
+            overlay(image, cam, alpha, colormap).save(out_path)
+    return sum(len(paths) for paths in out_paths)
+
+
+def overlay_name(model_name, class_id, image_path):
+    # as the gradcam notebook: <model>_class_<class id>_[fake_]<image file name>
+    fake = "fake_" if "fake" in image_path else ""
+    return f"{model_name}_class_{class_id}_{fake}{os.path.basename(image_path)}"
+
+
+def main(hparams):
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:" + str(hparams.dev) if use_cuda else device_type)
+
+    test_set = CheXpertDataset(
+        img_data_dir,
+        csv_test_img,
+        image_size,
+        augmentation=False,
+        pseudo_rgb=True,
+        path_col=path_col_test,
+    )
+    dataset = test_set if max_images is None else Subset(test_set, range(min(max_images, len(test_set))))
+    data_loader = DataLoader(dataset, batch_size, shuffle=False, num_workers=num_workers)
+    n_images = len(dataset)
+
+    group_masks = {
+        g: (test_set.demographics[col] == g).values
+        for col, groups in saliency_groups.items()
+        if col in test_set.demographics
+        for g in groups
+    }
+    extractors, stores, saliency = {}, {}, {}
+    for name, target in cam_targets.items():
+        print(f"Loading {name} model from {served_models[name]['model_path']}")
+        extractors[name] = GradCAM(load_model(served_models[name], device), target["layer"])
+        if saliency_groups:
+            saliency[name] = StreamingSaliency(target["class_ids"], group_masks)
+
+    os.makedirs(out_dir, exist_ok=True)
+    scores = {name: np.empty((n_images, len(t["class_ids"])), dtype=np.float32) for name, t in cam_targets.items()}
+    cam_seconds = {name: 0.0 for name in cam_targets}
+    write_seconds = 0.0  # main process time spent waiting for, or doing, the writing
+    pending = deque()
+    pool = ProcessPoolExecutor(num_writers) if num_writers > 0 and save_overlays else None
+
+    start = perf_counter()
+    for batch in tqdm(data_loader, desc="Grad-CAM"):
+        images = batch["image"].to(device)
+        index = batch["index"].numpy()
+        images_uint8 = batch["image"].clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).numpy()
+
+        for name, extractor in extractors.items():
+            class_ids = cam_targets[name]["class_ids"]
+            synchronize(device)
+            cam_start = perf_counter()
+            cams, outs = extractor(images, class_ids)
+            synchronize(device)
+            cam_seconds[name] += perf_counter() - cam_start
+
+            cams = cams.cpu().numpy()
+            if served_models[name]["activation"] == "sigmoid":
+                scores[name][index] = torch.sigmoid(outs[:, class_ids]).cpu().numpy()
+            else:
+                scores[name][index] = torch.softmax(outs, dim=1)[:, class_ids].cpu().numpy()
+            if name in saliency:
+                positives = saliency_positives and served_models[name]["activation"] == "sigmoid"
+                saliency[name].update(cams, index, batch["label"][:, class_ids] == 1 if positives else None)
+            if save_cams:
+                if name not in stores:
+                    stores[name] = np.lib.format.open_memmap(
+                        os.path.join(out_dir, f"cams.{name}.npy"),
+                        mode="w+",
+                        dtype=np.float16,
+                        shape=(n_images,) + cams.shape[1:],
+                    )
+                stores[name][index] = cams
+            if save_overlays:
+                out_paths = [
+                    [os.path.join(out_dir, overlay_name(name, c, test_set.image_paths[i])) for c in class_ids]
+                    for i in index
+                ]
+                write_start = perf_counter()
+                if pool is None:
+                    write_overlays(images_uint8, cams, out_paths)
+                else:
+                    pending.append(pool.submit(write_overlays, images_uint8, cams, out_paths))
+                    while len(pending) > 2 * num_writers:  # bounds the batches held in memory
+                        pending.popleft().result()
+                write_seconds += perf_counter() - write_start
+
+    write_start = perf_counter()
+    for future in pending:
+        future.result()
+    if pool is not None:
+        pool.shutdown()
+    write_seconds += perf_counter() - write_start
+    total_seconds = perf_counter() - start
+
+    for store in stores.values():
+        store.flush()
+    df = pd.DataFrame({"path": test_set.image_paths[: n_images]})
+    for name, target in cam_targets.items():
+        for column, class_id in enumerate(target["class_ids"]):
+            df[f"{name}_class_{class_id}"] = scores[name][:, column]
+    df.to_csv(os.path.join(out_dir, "gradcam.scores.csv"), index=False)
+    for name, aggregate in saliency.items():
+        aggregate.save(os.path.join(out_dir, f"saliency.{name}.npz"))
+        save_heatmaps(aggregate.compute(), os.path.join(out_dir, "saliency"), name, image_size, overlay_colormap)
+        counts = pd.DataFrame(aggregate.count, index=aggregate.groups, columns=aggregate.class_names)
+        print(f"\nImages per subgroup and class in the {name} saliency maps (saliency.{name}.npz)")
+        print(tabulate(counts, headers=counts.columns))
+
+    throughput = pd.DataFrame(
+        {
+            "cam_ms_per_image": {name: 1000 * s / n_images for name, s in cam_seconds.items()},
+            "cam_img_per_s": {name: n_images / s for name, s in cam_seconds.items()},
+        }
+    )
+    n_maps = n_images * sum(len(t["class_ids"]) for t in cam_targets.values())
+    print(f"\n{n_images} images x {len(cam_targets)} models in {total_seconds:.1f}s")
+    print(tabulate(throughput, headers=throughput.columns, floatfmt=".2f"))
+    print(
+        f"Overall: {n_images / total_seconds:.1f} images/s, {n_maps / total_seconds:.1f} maps/s; "
+        f"main process blocked on writing {write_seconds:.1f}s ({num_writers} writers)"
+    )
+    print(f"Saved to {out_dir}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--dev", default=0)
+    args = parser.parse_args()
+
+    main(args)
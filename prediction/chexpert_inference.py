@@ -0,0 +1,136 @@
+"""
+Test loop and test-time augmentation (TTA) of the disease detection models, shared by chexpert_disease.py and
+chexpert_quantize.py. Importing this module runs no configuration; torchvision is imported only for TTA.
+"""
+from time import perf_counter
+
+import torch
+from tqdm import tqdm
+
+try:  # imported as prediction.chexpert_inference (notebooks)
+    from .chexpert_core import synchronize
+    from .stage_profiler import stage
+except ImportError:  # imported from prediction/ (scripts)
+    from chexpert_core import synchronize
+    from stage_profiler import stage
+
+# (horizontal flip, rotation in degrees, scale), within the ranges of the training augmentation
+tta_transforms = [
+    (False, 0.0, 1.0),
+    (True, 0.0, 1.0),
+    (False, 10.0, 1.0),
+    (False, -10.0, 1.0),
+    (True, 10.0, 1.0),
+    (True, -10.0, 1.0),
+    (False, 0.0, 1.05),
+    (False, 0.0, 0.95),
+    (True, 0.0, 1.05),
+    (True, 0.0, 0.95),
+]
+
+
+def tta_expand(img, k):
+    """
+    Stack the first k deterministic views of a batch along the batch dimension, giving k * B images
+    """
+    import torchvision.transforms.functional as TF
+
+    if k > len(tta_transforms):
+        raise ValueError(f"At most {len(tta_transforms)} TTA views are supported, got {k}")
+    views = []
+    for flip, angle, scale in tta_transforms[:k]:
+        view = TF.hflip(img) if flip else img
+        if angle != 0.0 or scale != 1.0:
+            view = TF.affine(view, angle=angle, translate=[0, 0], scale=scale, shear=[0.0])
+        views.append(view)
+    return torch.cat(views, dim=0)
+
+
+def forward_tta(model, img, k):
+    """
+    One forward over all k views of the batch, logits averaged over the views on the device
+    """
+    if k <= 1:
+        return model(img)
+    out = model(tta_expand(img, k))
+    return out.view(k, img.shape[0], -1).mean(dim=0)
+
+
+def tta_cost(model, data_loader, device, k, n_batches=10):
+    """
+    Per-sample forward time in ms of plain inference and of k-view TTA on the first batches of the loader
+    """
+    model.eval()
+    times = {"plain": 0.0, "tta": 0.0}
+    n_samples = 0
+    with torch.no_grad():
+        for index, batch in enumerate(data_loader):
+            if index == n_batches:
+                break
+            img = batch["image"].to(device)
+            if index == 0:
+                forward_tta(model, img, k)  # warm-up
+            for name, views in [("plain", 1), ("tta", k)]:
+                synchronize(device)
+                start = perf_counter()
+                forward_tta(model, img, views)
+                synchronize(device)
+                times[name] += perf_counter() - start
+            n_samples += img.shape[0]
+
+    cost = {name: 1000 * t / n_samples for name, t in times.items()}
+    cost["ratio"] = cost["tta"] / cost["plain"]
+    return cost
+
+
+def test(model, data_loader, device, tta=0, metrics=None, keep_predictions=True, profiler=None):
+    """
+    Predictions, targets and logits on data_loader, with tta views per image (0 or 1: no TTA). If a
+    StreamingMetrics is given it is updated per batch; with keep_predictions=False nothing is collected (constant
+    memory) and None is returned for all three. With a StageProfiler the worker stages of the batches and the
+    transfer are recorded.
+    """
+    model.eval()
+    logits = []
+    preds = []
+    targets = []
+    forward_time = 0.0
+
+    with torch.no_grad():
+        for index, batch in enumerate(tqdm(data_loader, desc="Test-loop")):
+            if profiler is not None:
+                profiler.add_worker_times(batch)
+            with stage(profiler, "transfer"):
+                img, lab = batch["image"].to(device), batch["label"].to(device)
+            synchronize(device)
+            start = perf_counter()
+            out = forward_tta(model, img, tta)
+            synchronize(device)
+            forward_time += perf_counter() - start
+            pred = torch.sigmoid(out)
+            if metrics is not None:
+                metrics.update(pred, lab, batch["index"])
+            if keep_predictions:
+                logits.append(out)
+                preds.append(pred)
+                targets.append(lab)
+
+        if not keep_predictions:
+            return None, None, None
+
+        logits = torch.cat(logits, dim=0)
+        preds = torch.cat(preds, dim=0)
+        targets = torch.cat(targets, dim=0)
+
+        counts = []
+        for i in range(0, targets.shape[1]):
+            t = targets[:, i] == 1
+            c = torch.sum(t)
+            counts.append(c)
+        print(counts)
+        print(
+            f"Forward time: {1000 * forward_time / len(targets):.3f} ms/sample"
+            + (f" ({tta} TTA views)" if tta > 1 else "")
+        )
+
+    return preds.cpu().numpy(), targets.cpu().numpy(), logits.cpu().numpy()
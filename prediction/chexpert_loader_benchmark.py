@@ -0,0 +1,204 @@
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import pandas as pd
+
+from datetime import datetime, timezone
+from time import perf_counter
+from tabulate import tabulate
+from argparse import SUPPRESS, ArgumentParser
+
+from chexpert_data import CheXpertDataset, PackedImages, decoders
+
+img_size = 128
+image_size = (img_size, img_size)
+img_data_dir = "/Users/felixkrones/python_projects/data/ChestXpert/"
+csv_file_img = f"../datafiles/chexpert/chexpert.sample_{img_size}_from_train_filtered_True.train.csv"
+path_col = "path_preproc"
+out_dir = "chexpert/loader_benchmark"
+
+metric_columns = [
+    "samples",
+    "wall_s",
+    "startup_s",
+    "samples_per_s",
+    "cpu_s",
+    "cpu_cores",
+    "cpu_pct",
+    "peak_rss_main_mb",
+    "peak_rss_worker_mb",
+]
+
+
+def _peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def _cpu_seconds():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def run_config(config):
+    """
+    Iterate the loader of one configuration with a no-op model and measure it. Runs in a fresh process per
+    configuration (see main), so that peak RSS and CPU time belong to this configuration only: the main process is
+    RUSAGE_SELF, the DataLoader workers are RUSAGE_CHILDREN once they are joined.
+    """
+    import torch
+    from torch.utils.data import DataLoader
+
+    dataset = CheXpertDataset(
+        config["img_data_dir"],
+        config["csv_file_img"],
+        image_size,
+        augmentation=config["augmentation"],
+        pseudo_rgb=True,
+        path_col=path_col,
+        decoder=config["decoder"],
+        packed_dir=config["packed_dir"] if config["storage"] == "packed" else None,
+    )
+    # as CheXpertDataModule: training loaders shuffle and augment
+    loader = DataLoader(
+        dataset, config["batch_size"], shuffle=config["augmentation"], num_workers=config["num_workers"]
+    )
+    model = torch.nn.Identity()
+
+    cpu_start = _cpu_seconds()
+    start = perf_counter()
+    first_batch, n_samples, n_first = None, 0, 0
+    iterator = iter(loader)
+    for index, batch in enumerate(iterator):
+        model(batch["image"])
+        n_samples += len(batch["image"])
+        if first_batch is None:
+            first_batch, n_first = perf_counter(), n_samples
+        if index + 1 == config["max_batches"]:
+            break
+    end = perf_counter()
+    del iterator  # joins the workers, which adds their CPU time and peak RSS to RUSAGE_CHILDREN
+    wall = perf_counter() - start
+    cpu = _cpu_seconds() - cpu_start
+
+    steady = end - first_batch
+    return {
+        "samples": n_samples,
+        "wall_s": wall,
+        "startup_s": first_batch - start,
+        # after the first batch, which includes the worker start-up
+        "samples_per_s": (n_samples - n_first) / steady if steady > 0 else float("nan"),
+        "cpu_s": cpu,
+        "cpu_cores": cpu / wall,
+        "cpu_pct": 100 * cpu / wall / os.cpu_count(),
+        "peak_rss_main_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+        "peak_rss_worker_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN) if config["num_workers"] > 0 else 0.0,
+    }
+
+
+def git_commit():
+    """
+    Short hash of the checked-out commit, with "-dirty" for uncommitted changes ("" outside a repository)
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=cwd, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=cwd, capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+    return commit + ("-dirty" if status.strip() else "")
+
+
+def sweep(args):
+    grid = itertools.product(args.storage, args.decoders, args.num_workers, args.batch_sizes, args.augmentation)
+    for storage, decoder, num_workers, batch_size, augmentation in grid:
+        yield {
+            "storage": storage,
+            "decoder": decoder,
+            "num_workers": num_workers,
+            "batch_size": batch_size,
+            "augmentation": augmentation == "on",
+            "max_batches": args.max_batches,
+            "img_data_dir": args.img_data_dir,
+            "csv_file_img": args.csv,
+            "packed_dir": args.packed_dir,
+        }
+
+
+def main(args):
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    if "packed" in args.storage and (args.repack or not os.path.exists(os.path.join(args.packed_dir, "paths.npy"))):
+        start = perf_counter()
+        paths = pd.read_csv(args.csv, usecols=[path_col])[path_col].astype(str)
+        store = PackedImages.pack(args.img_data_dir, paths, args.packed_dir)
+        print(f"Packed {len(store)} images into {args.packed_dir} in {perf_counter() - start:.1f}s")
+
+    run_info = {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "csv_file_img": args.csv,
+    }
+    rows = []
+    for config in sweep(args):
+        # one process per configuration, see run_config
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--config", json.dumps(config)],
+            capture_output=True,
+            text=True,
+        )
+        if out.returncode != 0:
+            raise RuntimeError(f"Configuration {config} failed:\n{out.stderr}")
+        metrics = json.loads(out.stdout.strip().splitlines()[-1])
+        row = {**run_info, **{k: config[k] for k in ["storage", "decoder", "num_workers", "batch_size"]}}
+        row["augmentation"] = config["augmentation"]
+        row.update(metrics)
+        rows.append(row)
+        print(
+            f"{config['storage']:>6} {config['decoder']:>11} workers={config['num_workers']:<2} "
+            f"batch={config['batch_size']:<4} augmentation={'on' if config['augmentation'] else 'off':<3} "
+            f"{metrics['samples_per_s']:8.1f} samples/s"
+        )
+
+    results = pd.DataFrame(rows)
+    # appended, so that runs on different commits end up in one file
+    results.to_csv(args.out, mode="a", header=not os.path.exists(args.out), index=False)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    table = results[["storage", "decoder", "num_workers", "batch_size", "augmentation"] + metric_columns]
+    print(tabulate(table, headers=table.columns, showindex=False, floatfmt=".1f"))
+    print(f"Appended {len(results)} rows to {args.out}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Throughput of CheXpertDataset loaders without model compute")
+    parser.add_argument("--img_data_dir", default=img_data_dir)
+    parser.add_argument("--csv", default=csv_file_img, help="sample csv with the image paths (path_preproc)")
+    parser.add_argument("--storage", nargs="+", default=["jpeg", "packed"], choices=["jpeg", "packed"])
+    parser.add_argument("--packed_dir", default=os.path.join(out_dir, "packed"), help="PackedImages store")
+    parser.add_argument("--repack", action="store_true", help="rebuild the packed store")
+    parser.add_argument("--decoders", nargs="+", default=list(decoders), choices=list(decoders))
+    parser.add_argument("--num_workers", nargs="+", default=[0, 4], type=int)
+    parser.add_argument("--batch_sizes", nargs="+", default=[150], type=int)
+    parser.add_argument("--augmentation", nargs="+", default=["off", "on"], choices=["off", "on"])
+    parser.add_argument("--max_batches", default=50, type=int, help="batches per configuration, 0: one epoch")
+    parser.add_argument("--out", default=os.path.join(out_dir, "loader_benchmark.csv"))
+    parser.add_argument("--json", default="", help="also write this run's rows as json")
+    parser.add_argument("--config", default="", help=SUPPRESS)  # one configuration, see main
+    args = parser.parse_args()
+
+    if args.config:
+        print(json.dumps(run_config(json.loads(args.config))))
+    else:
+        main(args)
@@ -0,0 +1,258 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+import pytorch_lightning as pl
+
+try:  # imported as prediction.chexpert_modules (notebooks)
+    from .chexpert_core import freeze_model, read_table
+    from .chexpert_data import CheXpertDataset, profiled_collate
+    from .stage_profiler import stage
+except ImportError:  # imported from prediction/ (scripts)
+    from chexpert_core import freeze_model, read_table
+    from chexpert_data import CheXpertDataset, profiled_collate
+    from stage_profiler import stage
+
+
+class CheXpertDataModule(pl.LightningDataModule):
+    def __init__(
+        self,
+        img_data_dir,
+        csv_train_img,
+        csv_val_img,
+        csv_test_img,
+        image_size,
+        pseudo_rgb,
+        batch_size,
+        num_workers,
+        path_col_test="path_preproc",
+        manifest=None,
+        train_filter=None,
+        targets=None,
+        return_path=False,
+        profile=False,
+        decoder="skimage",
+        packed_dir=None,
+        train_indices=None,
+        val_indices=None,
+        test_indices=None,
+    ):
+        """
+        With a manifest (file with a split column) the three sets are views of it, read once, instead of the
+        csv files; train_filter (a DataFrame.eval expression) restricts the training and validation sets.
+        train/val/test_indices: row positions within each set (after the split and filter), e.g. the resampled
+        test row ids of notebooks/resample.py; repeated rows are allowed.
+        targets, return_path, decoder and packed_dir are passed to the datasets (see CheXpertDataset).
+        profile: the batches carry the time spent on imread, augmentation and collation in the workers
+        (see stage_profiler.py).
+        """
+        super().__init__()
+        self.csv_train_img = csv_train_img
+        self.csv_val_img = csv_val_img
+        self.csv_test_img = csv_test_img
+        self.image_size = image_size
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.path_col_test = path_col_test
+        self.img_data_dir = img_data_dir
+        self.collate_fn = profiled_collate if profile else None
+
+        queries = {"train": None, "validate": None, "test": None}
+        if manifest:
+            table = read_table(manifest)
+            self.csv_train_img = self.csv_val_img = self.csv_test_img = table
+            queries = {split: f"split == '{split}'" for split in queries}
+        if train_filter:
+            for split in ["train", "validate"]:
+                queries[split] = f"({queries[split]}) and ({train_filter})" if queries[split] else train_filter
+
+        common = {
+            "pseudo_rgb": pseudo_rgb,
+            "targets": targets,
+            "return_path": return_path,
+            "profile": profile,
+            "decoder": decoder,
+            "packed_dir": packed_dir,
+        }
+        self.train_set = CheXpertDataset(
+            self.img_data_dir,
+            self.csv_train_img,
+            self.image_size,
+            augmentation=True,
+            indices=train_indices,
+            query=queries["train"],
+            **common,
+        )
+        self.val_set = CheXpertDataset(
+            self.img_data_dir,
+            self.csv_val_img,
+            self.image_size,
+            augmentation=False,
+            indices=val_indices,
+            query=queries["validate"],
+            **common,
+        )
+        self.test_set = CheXpertDataset(
+            self.img_data_dir,
+            self.csv_test_img,
+            self.image_size,
+            augmentation=False,
+            path_col=self.path_col_test,
+            indices=test_indices,
+            query=queries["test"],
+            **common,
+        )
+
+        print("#train: ", len(self.train_set))
+        print("#val:   ", len(self.val_set))
+        print("#test:  ", len(self.test_set))
+
+    def train_dataloader(self):
+        return DataLoader(
+            self.train_set,
+            self.batch_size,
+            shuffle=True,
+            num_workers=self.num_workers,
+            collate_fn=self.collate_fn,
+        )
+
+    def val_dataloader(self):
+        return DataLoader(
+            self.val_set,
+            self.batch_size,
+            shuffle=False,
+            num_workers=self.num_workers,
+            collate_fn=self.collate_fn,
+        )
+
+    def test_dataloader(self):
+        return DataLoader(
+            self.test_set,
+            self.batch_size,
+            shuffle=False,
+            num_workers=self.num_workers,
+            collate_fn=self.collate_fn,
+        )
+
+
+class Classifier(pl.LightningModule):
+    """
+    A torchvision network (self.model) whose classification layer (attribute head of the network) is replaced
+    by a num_classes output layer. multi_label: independent sigmoid outputs trained with binary cross-entropy
+    (disease labels), else softmax classes trained with (class_weights weighted) cross-entropy.
+    With a StageProfiler as self.profiler, transfer, forward, backward, optimizer step and logging are timed.
+    """
+
+    head = None
+
+    def __init__(self, num_classes, model, multi_label=True, class_weights=None):
+        super().__init__()
+        self.num_classes = num_classes
+        self.multi_label = multi_label
+        self.class_weights = None if class_weights is None else torch.FloatTensor(class_weights)
+        self.model = model
+        self.profiler = None
+        num_features = getattr(self.model, self.head).in_features
+        setattr(self.model, self.head, nn.Linear(num_features, self.num_classes))
+
+    def remove_head(self):
+        num_features = getattr(self.model, self.head).in_features
+        setattr(self.model, self.head, nn.Identity(num_features))
+
+    def forward(self, x):
+        with stage(self.profiler, "forward"):
+            return self.model.forward(x)
+
+    def on_before_batch_transfer(self, batch, dataloader_idx):
+        if self.profiler is not None:
+            self.profiler.add_worker_times(batch)
+        return batch
+
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        with stage(self.profiler, "transfer"):
+            return super().transfer_batch_to_device(batch, device, dataloader_idx)
+
+    def backward(self, loss, *args, **kwargs):
+        with stage(self.profiler, "backward"):
+            super().backward(loss, *args, **kwargs)
+
+    def optimizer_step(self, *args, **kwargs):
+        # the closure runs forward and backward, which are counted in their own stages
+        with stage(self.profiler, "optimizer"):
+            super().optimizer_step(*args, **kwargs)
+
+    def configure_optimizers(self):
+        params_to_update = []
+        for param in self.parameters():
+            if param.requires_grad == True:
+                params_to_update.append(param)
+        optimizer = torch.optim.Adam(params_to_update, lr=0.001)
+        return optimizer
+
+    def unpack_batch(self, batch):
+        return batch["image"], batch["label"]
+
+    def process_batch(self, batch):
+        img, lab = self.unpack_batch(batch)
+        out = self.forward(img)
+        if self.multi_label:
+            prob = torch.sigmoid(out)
+            return F.binary_cross_entropy(prob, lab)
+        weight = None if self.class_weights is None else self.class_weights.type_as(img)
+        return F.cross_entropy(out, lab, weight=weight)
+
+    def training_step(self, batch, batch_idx):
+        from torchvision.utils import make_grid
+
+        loss = self.process_batch(batch)
+        with stage(self.profiler, "logger"):
+            self.log("train_loss", loss)
+            grid = make_grid(batch["image"][0:4, ...], nrow=2, normalize=True)
+            self.logger.experiment.add_image("images", grid, self.global_step)
+        return loss
+
+    def validation_step(self, batch, batch_idx):
+        loss = self.process_batch(batch)
+        with stage(self.profiler, "logger"):
+            self.log("val_loss", loss)
+
+    def test_step(self, batch, batch_idx):
+        loss = self.process_batch(batch)
+        with stage(self.profiler, "logger"):
+            self.log("test_loss", loss)
+
+
+class ResNet(Classifier):
+    head = "fc"
+
+    def __init__(self, num_classes, pretrained=True, multi_label=True, class_weights=None):
+        from torchvision import models
+
+        super().__init__(num_classes, models.resnet34(pretrained=pretrained), multi_label, class_weights)
+
+
+class DenseNet(Classifier):
+    head = "classifier"
+
+    def __init__(self, num_classes, pretrained=True, multi_label=True, class_weights=None):
+        from torchvision import models
+
+        super().__init__(num_classes, models.densenet121(pretrained=pretrained), multi_label, class_weights)
+
+
+class SplitResNet(Classifier):
+    """
+    SPLIT: a new softmax classifier (self.classifier) on the frozen network of a trained model, e.g.
+    SplitResNet(3, disease_model.model) to predict race from the features of a ResNet disease model
+    """
+
+    head = "fc"
+
+    def __init__(self, num_classes, backbone):
+        freeze_model(backbone)
+        super().__init__(num_classes, backbone, multi_label=False)
+        self.classifier = getattr(self.model, self.head)
+
+
+class SplitDenseNet(SplitResNet):
+    head = "classifier"
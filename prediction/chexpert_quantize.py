@@ -0,0 +1,242 @@
+import copy
+import io
+import os
+import time
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+import pandas as pd
+import numpy as np
+import pytorch_lightning as pl
+
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from sklearn.metrics import roc_auc_score
+from tabulate import tabulate
+from tqdm import tqdm
+from argparse import ArgumentParser
+
+from chexpert_core import CheXpertDataset, DenseNet, ResNet, load_checkpoint
+from chexpert_inference import test
+
+random_seed = 42
+img_size = 128
+image_size = (img_size, img_size)
+num_classes = 14
+batch_size = 32
+num_workers = 4
+MODEL_TYPE = "DenseNet" # DenseNet, ResNet
+quant_modes = ["dynamic", "static"]  # dynamic, static
+quant_backend = "fbgemm"  # fbgemm (x86), qnnpack (arm)
+num_calibration_samples = 512
+num_benchmark_batches = 20
+num_threads = None  # None keeps the torch default
+
+img_data_dir = "/Users/felixkrones/python_projects/data/ChestXpert/"
+
+csv_val_img = f"../datafiles/chexpert/chexpert.sample_{img_size}_from_train_filtered_True.val.csv"
+csv_test_img = f"../datafiles/chexpert/chexpert.sample_{img_size}_from_train_filtered_True.test.csv"
+path_col_test = "path_preproc"  # cropped_image_path, fake_image_path, path_preproc
+
+model_path = f"chexpert/disease/models/{MODEL_TYPE.lower()}-all_{img_size}/version_0/checkpoints/epoch=9-step=5090.ckpt"
+out_name = f"quantized/{MODEL_TYPE.lower()}-all_{img_size}"
+
+subgroups = {
+    "race": ["White", "Asian", "Black"],
+    "sex": ["Female", "Male"],
+}
+
+
+def model_size_mb(model):
+    """
+    Size of the serialized state dict in MB, as it would be written to disk
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1e6
+
+
+def quantize_dynamic_model(model):
+    """
+    Dynamic INT8 quantization: weights are quantized ahead of time, activations on the fly.
+    PyTorch only supports this for nn.Linear (and RNNs), so for DenseNet/ResNet only the classifier head is quantized.
+    """
+    model_q = copy.deepcopy(model).cpu().eval()
+    model_q.model = quantize_dynamic(model_q.model, {nn.Linear}, dtype=torch.qint8)
+    return model_q
+
+
+def quantize_static_model(model, calibration_loader, backend=quant_backend):
+    """
+    Post-training static INT8 quantization (FX graph mode) of the full backbone.
+    Activation ranges are observed on the calibration loader before conversion.
+    """
+    torch.backends.quantized.engine = backend
+    model_q = copy.deepcopy(model).cpu().eval()
+
+    example_inputs = (next(iter(calibration_loader))["image"],)
+    prepared = prepare_fx(
+        model_q.model, get_default_qconfig_mapping(backend), example_inputs
+    )
+    with torch.no_grad():
+        for batch in tqdm(calibration_loader, desc="Calibration"):
+            prepared(batch["image"])
+
+    model_q.model = convert_fx(prepared)
+    return model_q
+
+
+def benchmark(model, data_loader, n_batches=num_benchmark_batches):
+    """
+    Latency and throughput of the forward pass only, on images that are already decoded
+    """
+    model.eval()
+    images = []
+    for batch in data_loader:
+        images.append(batch["image"])
+        if len(images) == n_batches:
+            break
+
+    latencies = []
+    n_images = 0
+    with torch.no_grad():
+        model(images[0])  # warm-up
+        for img in images:
+            start = time.perf_counter()
+            model(img)
+            latencies.append(time.perf_counter() - start)
+            n_images += img.shape[0]
+
+    latencies = np.array(latencies)
+    return {
+        "latency_ms_per_batch": 1000 * np.median(latencies),
+        "latency_ms_per_image": 1000 * latencies.sum() / n_images,
+        "throughput_img_per_s": n_images / latencies.sum(),
+    }
+
+
+def subgroup_aucs(preds, targets, data):
+    """
+    Per-label AUC for the full test set and for every race/sex subgroup
+    """
+    results = {}
+    masks = {"all": np.ones(len(data), dtype=bool)}
+    for col, groups in subgroups.items():
+        for g in groups:
+            masks[g] = (data[col] == g).values
+
+    for group, mask in masks.items():
+        for label in range(0, num_classes):
+            t, p = targets[mask, label], preds[mask, label]
+            results[(group, label)] = (
+                roc_auc_score(t, p) if 0 < t.sum() < len(t) else np.nan
+            )
+    return pd.Series(results)
+
+
+def main(hparams):
+    pl.seed_everything(random_seed, workers=True)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    val_set = CheXpertDataset(
+        img_data_dir, csv_val_img, image_size, augmentation=False, pseudo_rgb=True
+    )
+    test_set = CheXpertDataset(
+        img_data_dir,
+        csv_test_img,
+        image_size,
+        augmentation=False,
+        pseudo_rgb=True,
+        path_col=path_col_test,
+    )
+
+    rng = np.random.default_rng(random_seed)
+    calibration_ids = rng.permutation(len(val_set))[:num_calibration_samples]
+    calibration_loader = DataLoader(
+        Subset(val_set, calibration_ids),
+        batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+    )
+    test_loader = DataLoader(
+        test_set, batch_size, shuffle=False, num_workers=num_workers
+    )
+
+    model_type = eval(MODEL_TYPE)
+    model_fp32 = load_checkpoint(model_type, model_path, num_classes=num_classes)
+    model_fp32.eval()
+
+    models_q = {"fp32": model_fp32}
+    if "dynamic" in quant_modes:
+        models_q["dynamic"] = quantize_dynamic_model(model_fp32)
+    if "static" in quant_modes:
+        models_q["static"] = quantize_static_model(model_fp32, calibration_loader)
+
+    out_dir = "chexpert/disease/" + out_name
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    device = torch.device("cpu")
+    cols_names_classes = ["class_" + str(i) for i in range(0, num_classes)]
+    cols_names_targets = ["target_" + str(i) for i in range(0, num_classes)]
+
+    perf, aucs = {}, {}
+    for name, model in models_q.items():
+        print(f"EVALUATING {name.upper()}")
+        perf[name] = {"size_mb": model_size_mb(model), **benchmark(model, test_loader)}
+
+        preds_test, targets_test, _ = test(model, test_loader, device)
+        aucs[name] = subgroup_aucs(preds_test, targets_test, test_set.demographics)
+
+        df = pd.DataFrame(data=preds_test, columns=cols_names_classes)
+        df_targets = pd.DataFrame(data=targets_test, columns=cols_names_targets)
+        df = pd.concat([df, df_targets], axis=1)
+        df.to_csv(os.path.join(out_dir, f"predictions.test.{name}.csv"), index=False)
+
+    if "static" in models_q:
+        torch.save(
+            models_q["static"].model.state_dict(),
+            os.path.join(out_dir, "static_int8.state_dict.pt"),
+        )
+
+    # Performance report
+    perf_df = pd.DataFrame.from_dict(perf, orient="index")
+    perf_df["speedup"] = (
+        perf_df.loc["fp32", "latency_ms_per_image"] / perf_df["latency_ms_per_image"]
+    )
+    perf_df["compression"] = perf_df.loc["fp32", "size_mb"] / perf_df["size_mb"]
+    perf_df.to_csv(os.path.join(out_dir, "quantization.performance.csv"))
+    print(f"\nPerformance ({torch.get_num_threads()} threads, batch size {batch_size})")
+    print(tabulate(perf_df, headers=perf_df.columns, floatfmt=".3f"))
+
+    # AUC report: per label and subgroup, with the difference to fp32
+    auc_df = pd.DataFrame(aucs)
+    auc_df.index.names = ["group", "label"]
+    for name in models_q:
+        if name != "fp32":
+            auc_df[f"delta_{name}"] = auc_df[name] - auc_df["fp32"]
+    auc_df.to_csv(os.path.join(out_dir, "quantization.auc.csv"))
+
+    # Shift of the subgroup gaps (max - min AUC within an attribute) per label
+    gaps = {}
+    for col, groups in subgroups.items():
+        for name in models_q:
+            per_group = auc_df[name].unstack("group")[groups]
+            gaps[(col, name)] = per_group.max(axis=1) - per_group.min(axis=1)
+    gap_df = pd.DataFrame(gaps)
+    gap_df.to_csv(os.path.join(out_dir, "quantization.subgroup_gap.csv"))
+
+    summary = auc_df.groupby("group").mean()
+    print("\nMean AUC over labels per subgroup")
+    print(tabulate(summary, headers=summary.columns, floatfmt=".4f"))
+    print("\nSubgroup AUC gap (max - min) per label")
+    print(tabulate(gap_df, headers=[" ".join(c) for c in gap_df.columns], floatfmt=".4f"))
+
+
+if __name__ == "__main__":
+    # no --gpus/--dev: the quantized models run on CPU only, and fp32 is measured on CPU to be comparable
+    parser = ArgumentParser()
+    args = parser.parse_args()
+
+    main(args)
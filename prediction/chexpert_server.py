@@ -0,0 +1,273 @@
+import io
+import json
+import queue
+import threading
+import time
+import torch
+import numpy as np
+
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from skimage.io import imread
+from skimage.transform import resize
+from argparse import ArgumentParser
+
+import chexpert_core
+
+device_type = "cpu"
+img_size = 128
+image_size = (img_size, img_size)
+host = "127.0.0.1"
+port = 8080
+max_batch_size = 32
+max_latency_ms = 10  # how long the first request of a batch may wait for others
+metrics_window = 10000  # number of recent requests used for the latency percentiles
+
+labels_disease = [
+    "No Finding",
+    "Enlarged Cardiomediastinum",
+    "Cardiomegaly",
+    "Lung Opacity",
+    "Lung Lesion",
+    "Edema",
+    "Consolidation",
+    "Pneumonia",
+    "Atelectasis",
+    "Pneumothorax",
+    "Pleural Effusion",
+    "Pleural Other",
+    "Fracture",
+    "Support Devices",
+]
+
+# name -> model to keep warm; sigmoid heads are multi-label (disease), softmax heads are single-label (sex/race)
+served_models = {
+    "disease": {
+        "model_type": "DenseNet",
+        "model_path": f"chexpert/disease/models/densenet-all_{img_size}/version_0/checkpoints/epoch=9-step=5090.ckpt",
+        "activation": "sigmoid",
+        "labels": labels_disease,
+    },
+    "sex": {
+        "model_type": "DenseNet",
+        "model_path": f"chexpert/sex/models/densenet-all_{img_size}/version_0/checkpoints/epoch=13-step=7126.ckpt",
+        "activation": "softmax",
+        "labels": ["Male", "Female"],
+    },
+    "race": {
+        "model_type": "DenseNet",
+        "model_path": f"chexpert/race/models/densenet-all_{img_size}/version_2/checkpoints/epoch=10-step=5599.ckpt",
+        "activation": "softmax",
+        "labels": ["White", "Asian", "Black"],
+    },
+}
+
+
+def load_model(spec, device):
+    num_classes = len(spec["labels"])
+    model = chexpert_core.load_checkpoint(
+        getattr(chexpert_core, spec["model_type"]),
+        spec["model_path"],
+        num_classes=num_classes,
+        multi_label=spec["activation"] == "sigmoid",
+    )
+    model.eval()
+    return model.to(device)
+
+
+def decode_image(data):
+    """
+    Decode an encoded image (JPEG/PNG bytes) into the 3 x H x W float tensor the models are trained on
+    """
+    image = imread(io.BytesIO(data)).astype(np.float32)
+    if image.shape[:2] != image_size:
+        image = resize(image, output_shape=image_size, preserve_range=True).astype(
+            np.float32
+        )
+    image = torch.from_numpy(image)
+    if len(image.shape) == 2:
+        image = image.unsqueeze(0)
+    if image.shape[2] == 3:
+        image = image.permute(2, 0, 1)
+    elif image.shape[0] == 1:
+        image = image.repeat(3, 1, 1)
+    elif image.shape[0] != 3:
+        raise ValueError(f"Image shape {image.shape} not supported")
+    return image
+
+
+class Metrics:
+    def __init__(self, window=metrics_window):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.n_requests = 0
+        self.n_batches = 0
+        self.started = time.time()
+
+    def add_request(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.n_requests += 1
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batch_sizes[size] += 1
+            self.n_batches += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            n_batched = sum(k * v for k, v in self.batch_sizes.items())
+            return {
+                "requests": self.n_requests,
+                "batches": self.n_batches,
+                "uptime_s": time.time() - self.started,
+                "latency_ms_p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "latency_ms_p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "batch_size_mean": n_batched / self.n_batches if self.n_batches else None,
+                "batch_size_hist": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            }
+
+
+class MicroBatcher:
+    """
+    Groups concurrent requests for one model into a single forward pass.
+    A batch is closed when it reaches max_batch_size or when its first request has waited max_latency_ms.
+    """
+
+    def __init__(self, model, activation, device, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms):
+        self.model = model
+        self.activation = activation
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.queue = queue.Queue()
+        self.metrics = Metrics()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def predict(self, image):
+        request = {"image": image, "done": threading.Event(), "start": time.perf_counter()}
+        self.queue.put(request)
+        request["done"].wait()
+        self.metrics.add_request(time.perf_counter() - request["start"])
+        if "error" in request:
+            raise request["error"]
+        return request["result"]
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                img = torch.stack([r["image"] for r in batch]).to(self.device)
+                with torch.no_grad():
+                    out = self.model(img)
+                    if self.activation == "sigmoid":
+                        prob = torch.sigmoid(out)
+                    else:
+                        prob = torch.softmax(out, dim=1)
+                prob = prob.cpu().numpy()
+                for r, p in zip(batch, prob):
+                    r["result"] = p
+            except Exception as e:
+                for r in batch:
+                    r["error"] = e
+            self.metrics.add_batch(len(batch))
+            for r in batch:
+                r["done"].set()
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    # set by serve()
+    batchers = {}
+    specs = {}
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "models": list(self.batchers)})
+        elif self.path == "/metrics":
+            self.send_json(200, {name: b.metrics.summary() for name, b in self.batchers.items()})
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        # POST /predict/<model> with the encoded image as request body
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "predict" or parts[1] not in self.batchers:
+            self.send_json(404, {"error": f"unknown path {self.path}, models: {list(self.batchers)}"})
+            return
+        name = parts[1]
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            image = decode_image(data)
+        except Exception as e:
+            self.send_json(400, {"error": f"could not decode image: {e}"})
+            return
+        try:
+            prob = self.batchers[name].predict(image)
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        labels = self.specs[name]["labels"]
+        self.send_json(200, {"model": name, "probabilities": dict(zip(labels, prob.tolist()))})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(hparams):
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:" + str(hparams.dev) if use_cuda else device_type)
+
+    InferenceHandler.specs = served_models
+    InferenceHandler.batchers = {}
+    for name, spec in served_models.items():
+        print(f"Loading {name} model from {spec['model_path']}")
+        model = load_model(spec, device)
+        InferenceHandler.batchers[name] = MicroBatcher(
+            model, spec["activation"], device, hparams.max_batch_size, hparams.max_latency_ms
+        )
+
+    server = ThreadingHTTPServer((hparams.host, hparams.port), InferenceHandler)
+    server.daemon_threads = True
+    print(f"Serving {list(served_models)} on http://{hparams.host}:{hparams.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--dev", default=0)
+    parser.add_argument("--host", default=host)
+    parser.add_argument("--port", default=port, type=int)
+    parser.add_argument("--max_batch_size", default=max_batch_size, type=int)
+    parser.add_argument("--max_latency_ms", default=max_latency_ms, type=float)
+    args = parser.parse_args()
+
+    serve(args)
@@ -0,0 +1,96 @@
+import glob
+import json
+import threading
+import time
+import urllib.request
+import numpy as np
+
+from argparse import ArgumentParser
+
+img_data_dir = "/Users/felixkrones/python_projects/data/ChestXpert/"
+image_glob = "preproc_128x128*/*.jpg"
+
+
+def post_image(url, data):
+    request = urllib.request.Request(
+        url, data=data, headers={"Content-Type": "application/octet-stream"}
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def get_json(url):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read())
+
+
+def run_load_test(url, model, images, concurrency, n_requests):
+    """
+    Send n_requests single-image requests from `concurrency` client threads and collect client-side latencies
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(n_requests))
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                post_image(f"{url}/predict/{model}", images[i % len(images)])
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "duration_s": duration,
+        "throughput_req_per_s": len(latencies) / duration,
+        "latency_ms_p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+        "latency_ms_p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--model", default="disease")
+    parser.add_argument("--images", default=img_data_dir + image_glob)
+    parser.add_argument("--max_images", default=256, type=int)
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated list of client thread counts")
+    parser.add_argument("--requests", default=500, type=int)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.images))[: args.max_images]
+    if not paths:
+        raise ValueError(f"No images found for {args.images}")
+    images = []
+    for p in paths:
+        with open(p, "rb") as f:
+            images.append(f.read())
+
+    print(get_json(f"{args.url}/health"))
+    post_image(f"{args.url}/predict/{args.model}", images[0])  # warm-up
+
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        print(json.dumps(run_load_test(args.url, args.model, images, concurrency, args.requests)))
+
+    print(json.dumps(get_json(f"{args.url}/metrics"), indent=2))
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+import numpy as np
+
+# stages timed in the DataLoader workers (chexpert_data.py), shipped to the main process inside the batches
+worker_stages = ["imread", "augment", "collate"]
+
+
+class StageProfiler:
+    """
+    Opt-in wall-clock profile of the stages of a run. Main-process stages (transfer, forward, backward, optimizer,
+    logger, csv, ...) are timed with stage(); nested stages are subtracted from the enclosing one, so every second
+    is counted once. The worker stages (imread, augment, collate) are timed in the DataLoader workers of a dataset
+    with profile=True and collected from the batches with add_worker_times(). Timestamps are perf_counter seconds,
+    a system-wide monotonic clock, so main and worker events share one timeline in the Chrome trace.
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.pid = os.getpid()
+        self.events = []  # (stage, pid, tid, start, end, exclusive seconds)
+        self.local = threading.local()
+
+    @contextmanager
+    def stage(self, name):
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)  # time spent in nested stages
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            end = perf_counter()
+            nested = stack.pop()
+            if stack:
+                stack[-1] += end - start
+            self.events.append((name, self.pid, threading.get_ident(), start, end, end - start - nested))
+
+    def add_worker_times(self, batch):
+        """
+        Pop the worker timings ("stage_times", see chexpert_data.py) from a batch and record them
+        """
+        times = batch.pop("stage_times", None)
+        if times is None:
+            return batch
+        pids = times["pid"].tolist()
+        for name in worker_stages:
+            if name not in times:
+                continue
+            spans = times[name].tolist()
+            for pid, (start, end) in zip(pids, spans):
+                self.events.append((name, pid, pid, start, end, end - start))
+        return batch
+
+    def summary(self):
+        """
+        One row per stage: calls, total and mean seconds, and total as a percentage of the wall time. Worker stages
+        run in parallel and can add up to num_workers x 100%: when they approach it, the run is bound by the data
+        loading. "other" is the main-process time outside all stages (waiting for batches, framework overhead).
+        """
+        import pandas as pd
+
+        wall = perf_counter() - self.start
+        events = pd.DataFrame(self.events, columns=["stage", "pid", "tid", "start", "end", "seconds"])
+        events["process"] = np.where(events["pid"] == self.pid, "main", "worker")
+        rows = events.groupby(["process", "stage"], sort=False)["seconds"].agg(["count", "sum", "mean"])
+        rows = rows.reset_index().rename(columns={"count": "calls", "sum": "total_s", "mean": "mean_ms"})
+        rows["mean_ms"] *= 1000
+        main_stages = rows["process"] == "main"
+        other = wall - rows.loc[main_stages, "total_s"].sum()
+        rows = pd.concat(
+            [
+                rows,
+                pd.DataFrame(
+                    [{"process": "main", "stage": "other", "calls": 0, "total_s": other, "mean_ms": np.nan}]
+                ),
+            ],
+            ignore_index=True,
+        )
+        rows["pct"] = 100 * rows["total_s"] / wall
+        return rows.sort_values(["process", "total_s"], ascending=[True, False], ignore_index=True)
+
+    def print_table(self):
+        from tabulate import tabulate
+
+        rows = self.summary()
+        n_workers = len({pid for _, pid, *_ in self.events if pid != self.pid})
+        print(f"\nStage profile: {perf_counter() - self.start:.1f}s wall, {n_workers} worker processes")
+        print(tabulate(rows, headers=rows.columns, showindex=False, floatfmt=".2f"))
+
+    def save_trace(self, path):
+        """
+        Chrome trace (chrome://tracing, Perfetto) of all recorded stages, one track per process and thread
+        """
+        trace = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": 1e6 * (start - self.start),
+                "dur": 1e6 * (end - start),
+                "pid": pid,
+                "tid": tid,
+            }
+            for name, pid, tid, start, end, _ in self.events
+        ]
+        for pid in sorted({event["pid"] for event in trace}):
+            process = "main" if pid == self.pid else f"worker {pid}"
+            trace.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": process}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+def stage(profiler, name):
+    """
+    profiler.stage(name), or a no-op context without profiler
+    """
+    return nullcontext() if profiler is None else profiler.stage(name)
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+
+class StreamingMetrics:
+    """
+    Constant-memory evaluation of predicted probabilities in [0, 1]: per label, subgroup and class (neg/pos),
+    scores are counted in n_bins equal-width bins, so memory is (n_groups + 1) x n_labels x 2 x n_bins counts
+    regardless of the number of samples.
+
+    Thresholds are restricted to the bin edges k / n_bins. The error against exact computation
+    (roc_auc_score / roc_curve on all predictions) is bounded per label and group, and reported by compute():
+    - AUC: pairs of a positive and a negative in different bins are ordered exactly, pairs sharing a bin count 1/2,
+      so |AUC - exact AUC| <= 0.5 * sum_b pos_b * neg_b / (P * N)  (auc_error).
+    - TPR/FPR at target_fpr: the edges k and k + 1 whose FPRs bracket target_fpr are both exact ROC points, so
+      the exact ROC point closest to target_fpr has its threshold inside bin k. The returned point is one of the
+      two edges of that bin, so TPR/FPR differ from the exact ones by at most the share of positives/negatives
+      in bin k (tpr_error/fpr_error). Subgroup rates are taken at the global threshold with the same bound.
+    """
+
+    def __init__(self, num_classes, group_masks=None, n_bins=1000):
+        """
+        group_masks: subgroup name -> boolean mask over the rows of the evaluated dataset, looked up by the
+        sample index passed to update()
+        """
+        self.num_classes = num_classes
+        self.n_bins = n_bins
+        group_masks = group_masks or {}
+        self.groups = ["all"] + list(group_masks)
+        self.masks = None
+        if group_masks:
+            self.masks = np.stack([np.asarray(m, dtype=bool) for m in group_masks.values()])
+        self.hist = np.zeros((len(self.groups), num_classes, 2, n_bins), dtype=np.int64)
+
+    def update(self, preds, targets, index=None):
+        """
+        Add a batch: preds and targets of shape (batch, num_classes), index the dataset rows for subgroups
+        """
+        preds = _to_numpy(preds).reshape(len(preds), -1)
+        targets = _to_numpy(targets).reshape(len(targets), -1) == 1
+        bins = np.clip((preds * self.n_bins).astype(np.int64), 0, self.n_bins - 1)
+        labels = np.arange(self.num_classes)
+        flat = ((labels[None, :] * 2 + targets) * self.n_bins + bins).ravel()
+        size = self.num_classes * 2 * self.n_bins
+
+        self.hist[0] += np.bincount(flat, minlength=size).reshape(self.hist.shape[1:])
+        if self.masks is not None and index is not None:
+            member = self.masks[:, _to_numpy(index)]
+            for g in range(len(self.groups) - 1):
+                sel = np.repeat(member[g], self.num_classes)
+                self.hist[g + 1] += np.bincount(flat[sel], minlength=size).reshape(self.hist.shape[1:])
+
+    def compute(self, target_fpr=0.2):
+        """
+        AUC, and TPR/FPR/Youden at the global bin-edge threshold with FPR closest to target_fpr, with error bounds.
+        Returns a DataFrame with one row per group and label.
+        """
+        rows = []
+        # counts of scores at or above each edge k / n_bins, k = 0..n_bins (edge n_bins: nothing predicted positive)
+        above = np.concatenate(
+            [np.cumsum(self.hist[..., ::-1], axis=-1)[..., ::-1], np.zeros(self.hist.shape[:-1] + (1,), np.int64)],
+            axis=-1,
+        )
+        totals = above[..., 0]
+        for label in range(self.num_classes):
+            with np.errstate(invalid="ignore", divide="ignore"):
+                fpr_edges = above[0, label, 0] / totals[0, label, 0]
+            k = np.argmin(np.abs(fpr_edges - target_fpr))
+            # bin whose edges bracket target_fpr (fpr_edges is decreasing in k)
+            bracket = min(np.searchsorted(-fpr_edges, -target_fpr, side="right") - 1, self.n_bins - 1)
+            bracket = max(bracket, 0)
+
+            for g, group in enumerate(self.groups):
+                neg_hist, pos_hist = self.hist[g, label]
+                n_neg, n_pos = totals[g, label]
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    neg_lower = n_neg - above[g, label, 0, 1:] - neg_hist
+                    auc = np.sum(pos_hist * (neg_lower + 0.5 * neg_hist)) / (n_pos * n_neg)
+                    auc_error = 0.5 * np.sum(pos_hist * neg_hist) / (n_pos * n_neg)
+                    tpr = above[g, label, 1, k] / n_pos if n_pos > 0 else 0.0
+                    fpr = above[g, label, 0, k] / n_neg if n_neg > 0 else 0.0
+                    tpr_error = pos_hist[bracket] / n_pos if n_pos > 0 else 0.0
+                    fpr_error = neg_hist[bracket] / n_neg if n_neg > 0 else 0.0
+                rows.append(
+                    {
+                        "group": group,
+                        "label": label,
+                        "n_pos": n_pos,
+                        "n_neg": n_neg,
+                        "AUC": auc,
+                        "auc_error": auc_error,
+                        "threshold": k / self.n_bins,
+                        "TPR": tpr,
+                        "FPR": fpr,
+                        "Youden": tpr - fpr,
+                        "tpr_error": tpr_error,
+                        "fpr_error": fpr_error,
+                    }
+                )
+        return pd.DataFrame(rows)
+
+
+def _to_numpy(x):
+    if hasattr(x, "detach"):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x)
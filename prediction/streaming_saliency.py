@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+
+class StreamingSaliency:
+    """
+    Constant-memory mean (and variance) of saliency maps per subgroup and class: per group and class the running
+    count, mean and sum of squared deviations are kept, and every batch is merged into them (Chan et al.), so memory
+    is (n_groups + 1) x n_classes x h x w regardless of the number of images. Group "all" holds every image.
+    """
+
+    def __init__(self, class_names, group_masks=None, variance=True):
+        """
+        class_names: one name per map of an image (e.g. the CAM class ids of a model)
+        group_masks: subgroup name -> boolean mask over the rows of the dataset, looked up by the index of update()
+        """
+        self.class_names = list(class_names)
+        group_masks = group_masks or {}
+        self.groups = ["all"] + list(group_masks)
+        self.masks = None
+        if group_masks:
+            self.masks = np.stack([np.asarray(m, dtype=bool) for m in group_masks.values()])
+        self.variance = variance
+        self.count = np.zeros((len(self.groups), len(self.class_names)), dtype=np.int64)
+        self.mean = None  # allocated on the first batch, when the map size is known
+        self.m2 = None
+
+    def update(self, cams, index=None, weights=None):
+        """
+        Add a batch: cams of shape (batch, n_classes, h, w), index the dataset rows for subgroups, weights an
+        optional boolean (batch, n_classes) selecting the maps that count (e.g. targets == 1: only the images
+        positive for a label)
+        """
+        cams = _to_numpy(cams).astype(np.float64)
+        if self.mean is None:
+            self.mean = np.zeros(self.count.shape + cams.shape[2:])
+            self.m2 = np.zeros_like(self.mean) if self.variance else None
+        member = np.ones((1, len(cams)), dtype=bool)
+        if self.masks is not None and index is not None:
+            member = np.concatenate([member, self.masks[:, _to_numpy(index)]])
+        selected = member[:, :, None].astype(np.float64)  # (groups, batch, 1)
+        if weights is not None:
+            selected = selected * (_to_numpy(weights).reshape(len(cams), -1) != 0)[None]
+        groups = slice(0, len(member))
+
+        n_batch = selected.sum(axis=1)  # (groups, classes)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_batch = np.einsum("gbc,bchw->gchw", selected, cams) / n_batch[..., None, None]
+        mean_batch = np.nan_to_num(mean_batch)
+        n_before = self.count[groups]
+        n_after = n_before + n_batch
+        with np.errstate(invalid="ignore", divide="ignore"):
+            share = np.nan_to_num(n_batch / n_after)[..., None, None]
+        delta = mean_batch - self.mean[groups]
+        if self.variance:
+            m2_batch = np.einsum("gbc,bchw->gchw", selected, cams**2) - n_batch[..., None, None] * mean_batch**2
+            self.m2[groups] += m2_batch + delta**2 * n_before[..., None, None] * share
+        self.mean[groups] += delta * share
+        self.count[groups] = n_after
+
+    def compute(self):
+        """
+        Arrays of the groups x classes summary: count, mean maps and (with variance) the sample variance maps
+        """
+        result = {
+            "groups": np.array(self.groups),
+            "classes": np.array(self.class_names, dtype=str),
+            "count": self.count,
+            "mean": self.mean,
+        }
+        if self.variance:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result["variance"] = self.m2 / (self.count - 1)[..., None, None]
+        return result
+
+    def save(self, path):
+        np.savez_compressed(path, **self.compute())
+
+
+def save_heatmaps(result, out_dir, prefix, size=None, colormap="jet"):
+    """
+    One png per group, class and statistic (mean, and std with variance) of a StreamingSaliency result,
+    upsampled (bicubic) to size. Colors share one scale per class and statistic, so that groups are comparable.
+    """
+    from matplotlib import colormaps
+
+    os.makedirs(out_dir, exist_ok=True)
+    stats = {"mean": result["mean"]}
+    if "variance" in result:
+        stats["std"] = np.sqrt(np.maximum(result["variance"], 0))
+    paths = []
+    for stat, maps in stats.items():
+        for c, class_name in enumerate(result["classes"]):
+            scale = np.nanmax(maps[:, c]) or 1.0
+            for g, group in enumerate(result["groups"]):
+                heatmap = Image.fromarray(np.nan_to_num(maps[g, c] / scale).astype(np.float32), mode="F")
+                if size is not None:
+                    heatmap = heatmap.resize(size, resample=Image.BICUBIC)
+                colored = (255 * colormaps[colormap](np.clip(np.asarray(heatmap), 0, 1))[:, :, :3]).astype(np.uint8)
+                path = os.path.join(out_dir, f"{prefix}_class_{class_name}_{group}_{stat}.png")
+                Image.fromarray(colored).save(path)
+                paths.append(path)
+    return paths
+
+
+def _to_numpy(x):
+    if hasattr(x, "detach"):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x)